@@ -9,6 +9,41 @@ m3u8_timeout = 5
 m3u8_retry_times = 3
 segment_timeout = 10
 segment_retry_times = 3
+segment_workers = 16
+segment_workers_per_host = 8
+segment_workers_per_task = 8
+# adjust the number of concurrent segment requests to what the origin takes (see mym3u8/adaptive.py),
+# segment_workers becomes the upper bound
+adaptive_concurrency = False
+segment_chunk_size = 64 * 1024
+# contiguous sub-ranges (EXT-X-BYTERANGE) of one url are downloaded with one Range request of at most this many bytes
+range_coalesce_bytes = 16 * 1024 * 1024
+decrypt_segments = False
+# hash segments while downloading, re-download truncated ones and .ts files without TS sync bytes
+verify_segments = True
+# turn off for sources that disguise their .ts segments (e.g. behind an image header)
+verify_ts_sync = True
+# also download the audio / video / subtitles renditions (EXT-X-MEDIA) of the selected variant
+fetch_renditions = False
+playlist_workers = 8
+merge_segments = False
+# process every downloaded file in a process pool (see mym3u8/postprocess.py): names of its step functions
+# such as ["sha256"] or ["remux"], the results are written to postprocess.jsonl in the task dir
+post_steps = []
+# a directory shared by all tasks, files downloaded by one task are hardlinked into the others (see mym3u8/store.py)
+store_root = None
+store_max_bytes = 20 * 1024 ** 3
+# download metrics (see mym3u8/metrics.py): a file in the task dir (the save_root for --batch) written
+# every metrics_interval seconds (a JSON line appended if it ends with .jsonl, otherwise Prometheus text),
+# and / or an HTTP endpoint on 127.0.0.1:metrics_port
+metrics_file = None
+metrics_interval = 5
+metrics_port = None
+
+retry_base_delay = 0.5
+retry_max_delay = 30
+breaker_failure_threshold = 5
+breaker_cooldown = 5
 
 editor = "vim"
 
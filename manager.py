@@ -12,8 +12,17 @@ master playlist 可以和 media playlist 处于不同的目录，所以不能以
 import mym3u8.download_core as download_core
 import config
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional, Union, Callable
 import mym3u8
+from mym3u8.downloader import jobs_from_assigner
+from mym3u8.manifest import CompletionManifest
+from mym3u8.merge import Merger, segment_paths
+from mym3u8.playlist import write_rendered, absolute_uri, resolve_uri
+from mym3u8.master_playlist import fetch_playlists
+from mym3u8.verify import SegmentVerifier
+from mym3u8.store import SegmentStore
+from mym3u8.adaptive import AIMDController
+from mym3u8.metrics import DownloadMetrics, MetricsReporter, serve
 import json
 import logging
 import copy
@@ -23,18 +32,21 @@ download_core.headers = download_core.parse_header(config.header_file)
 logger = logging.getLogger(__name__)
 
 
-def save_arg(task_dir: Path, m3u8_url: str, task_name: str):
-    task_dir.mkdir(exist_ok=True)
+def save_arg(task_dir: Path, m3u8_url: str, task_name: str, overwrite: Optional[bool] = None):
+    """if `overwrite` is None, ask the user whether to overwrite an existing arg file"""
+    task_dir.mkdir(parents=True, exist_ok=True)
     arg_file = task_dir / "launch_args.json"
     if arg_file.exists():
-        a = input(
-            f"arg file: {arg_file} exists. Do you want to overwrite this arg file? (Y or N)"
-        ).lower()
-        while a not in ["y", "n"]:
+        if overwrite is None:
             a = input(
                 f"arg file: {arg_file} exists. Do you want to overwrite this arg file? (Y or N)"
             ).lower()
-        if a == "n":
+            while a not in ["y", "n"]:
+                a = input(
+                    f"arg file: {arg_file} exists. Do you want to overwrite this arg file? (Y or N)"
+                ).lower()
+            overwrite = a == "y"
+        if not overwrite:
             return
 
     with arg_file.open("w", encoding="utf8") as f:
@@ -46,73 +58,438 @@ def save_arg(task_dir: Path, m3u8_url: str, task_name: str):
         )
 
 
+def m3u8_path(task_dir: Path, cache, form: str) -> Path:
+    """where dump_m3u8 writes the `form` (original, absolute or local) of a playlist"""
+    return task_dir / f"m3u8/{cache.idx}.{form}.{cache.ext}"
+
+
 def dump_m3u8(
     task_dir: Path, playlist: mym3u8.Playlist, assigner: mym3u8.CacheNameAssigner
 ):
     (task_dir / "m3u8").mkdir(exist_ok=True)
     cache = assigner.get_cache(playlist.url)
-    original = task_dir / f"m3u8/{cache.idx}.original.{cache.ext}"
-    original.write_text(
-        "".join(line.line_text + "\n" for line in playlist.lines),
-        encoding="utf8",
-    )
-
-    absolute = task_dir / f"m3u8/{cache.idx}.absolute.{cache.ext}"
-    absolute.write_text(
-        "".join(line.line_text + "\n" for line in playlist.to_abs_playlist().lines),
-        encoding="utf8",
-    )
-
-    local = task_dir / f"m3u8/{cache.idx}.local.{cache.ext}"
-    local.write_text(
-        "".join(
-            line.line_text + "\n"
-            for line in mym3u8.to_local_playlist(playlist, assigner).lines
-        ),
-        encoding="utf8",
+    original = m3u8_path(task_dir, cache, "original")
+    absolute = m3u8_path(task_dir, cache, "absolute")
+    local = m3u8_path(task_dir, cache, "local")
+    write_rendered(
+        playlist,
+        [(original, None), (absolute, absolute_uri), (local, assigner.cache_name)],
     )
     return original, absolute, local
 
 
 
 
-def launch_task(m3u8_url, task_name):
-    task_dir = config.save_root / task_name
-    save_arg(task_dir, m3u8_url, task_name)
-    logger.info(f"task dir: {task_dir}")
-    config.dictConfig(task_dir)
+def load_playlists(
+    task_dir: Path, m3u8_url: str, variant: Union[int, str, None] = None
+) -> Tuple[mym3u8.CacheNameAssigner, mym3u8.Playlist]:
+    """
+    Download the playlists of a task (or load them if they were downloaded before).
+    Return the cache name assigner of all their URIs and the media playlist.
+    `variant` selects a sub playlist of a master playlist: an index or a policy spec
+    (see mym3u8.master_playlist.parse_policy). If it is None, ask the user.
+    """
     playlists: List[mym3u8.Playlist] = []
     cna = mym3u8.CacheNameAssigner()
     local_m3u8_link: Path = task_dir / "local.m3u8"
     abs_m3u8_link: Path = task_dir / "fq.m3u8"
-    cna_path: Path = task_dir / "cache_assigner.json"
-    if abs_m3u8_link.exists() and cna_path.exists():
+    cna_path: Path = task_dir / "cache_assigner.jsonl"
+    legacy_cna_path: Path = task_dir / "cache_assigner.json"
+    if abs_m3u8_link.exists() and (cna_path.exists() or legacy_cna_path.exists()):
         logger.info(
-            "fq.m3u8 and cache_assigner.json exists. Load them instead of download them."
+            "fq.m3u8 and cache_assigner.jsonl exists. Load them instead of download them."
         )
         content = abs_m3u8_link.read_text("utf8")
         playlist = mym3u8.Playlist(m3u8_url, content)
         cna = mym3u8.CacheNameAssigner()
-        cna.load(cna_path)
+        if cna_path.exists():
+            cna.load_journal(cna_path)
+        else:
+            cna.load(legacy_cna_path)
+            cna.save_journal(cna_path)
     else:
         logger.info("Cache does not exists. Downlonding...")
+        renditions: List[mym3u8.Playlist] = []
+        playlist = mym3u8.Playlist(m3u8_url)
         while True:
-            playlist = mym3u8.Playlist(m3u8_url)
             playlists.append(playlist)
             cna.register_playlist_uri(playlist)
             if playlist.is_master_playlist():
                 logger.info(
-                    f"{playlist!r} is a master playlist. Ask user to select a sub playlist"
+                    f"{playlist!r} is a master playlist. Select a sub playlist"
                 )
-                playlist = mym3u8.MasterPlaylist(playlist)
-                m3u8_url = playlist.select_playlist()
+                master = mym3u8.MasterPlaylist(playlist)
+                m3u8_url = master.select_playlist(variant)
+                urls = [m3u8_url]
+                if config.fetch_renditions:
+                    urls += [rendition.uri for rendition in master.renditions(m3u8_url)]
+                    logger.info(f"{len(urls) - 1} renditions of {m3u8_url}")
+                playlist, *fetched = fetch_playlists(urls)
+                renditions.extend(fetched)
             else:
                 break
-        cna.dump(cna_path)
-        for playlist in playlists:
-            _, fq, local = dump_m3u8(task_dir, playlist, cna)
-        abs_m3u8_link.write_bytes(fq.read_bytes())
-        local_m3u8_link.write_bytes(local.read_bytes())
+        for rendition in renditions:
+            playlists.append(rendition)
+            cna.register_playlist_uri(rendition)
+        if renditions:
+            (task_dir / "renditions.json").write_text(
+                json.dumps([rendition.url for rendition in renditions], indent=4), encoding="utf8"
+            )
+        cna.save_journal(cna_path)
+        for dumped in playlists:
+            _, fq, local = dump_m3u8(task_dir, dumped, cna)
+            if dumped is playlist:
+                abs_m3u8_link.write_bytes(fq.read_bytes())
+                local_m3u8_link.write_bytes(local.read_bytes())
+    logger.debug(f"URI resolution cache: {resolve_uri.cache_info()}")
+    return cna, playlist
+
+
+def load_renditions(task_dir: Path, cna: mym3u8.CacheNameAssigner) -> List[mym3u8.Playlist]:
+    """the rendition playlists fetched by load_playlists (see config.fetch_renditions)"""
+    path = task_dir / "renditions.json"
+    if not path.exists():
+        return []
+    renditions = []
+    for url in json.loads(path.read_text("utf8")):
+        absolute = m3u8_path(task_dir, cna.get_cache(url), "absolute")
+        renditions.append(mym3u8.Playlist(url, absolute.read_text("utf8")))
+    return renditions
+
+
+def prepare_decryption(
+    task_dir: Path, playlist: mym3u8.Playlist, cna: mym3u8.CacheNameAssigner, decrypter, main: bool = True
+):
+    """
+    segments are decrypted while downloading, so the local forms of `playlist` must not ask players
+    to decrypt them: m3u8/<idx>.local.m3u8 (which the local form of the master playlist points to),
+    and local.m3u8 if it is the `main` media playlist of the task
+    """
+    from mym3u8.decrypt import strip_key_tags
+
+    decrypter.add_playlist(playlist)
+    paths = [m3u8_path(task_dir, cna.get_cache(playlist.url), "local")]
+    if main:
+        paths.append(task_dir / "local.m3u8")
+    for local in paths:
+        local.write_text(strip_key_tags(local.read_text("utf8")), encoding="utf8")
+
+
+def prepare_rendition_decryption(task_dir: Path, cna: mym3u8.CacheNameAssigner, decrypter):
+    for rendition in load_renditions(task_dir, cna):
+        prepare_decryption(task_dir, rendition, cna, decrypter, main=False)
+
+
+def create_verifier() -> Optional[SegmentVerifier]:
+    if not config.verify_segments:
+        return None
+    return SegmentVerifier(decrypted=config.decrypt_segments, ts_sync=config.verify_ts_sync)
+
+
+def create_store() -> Optional[SegmentStore]:
+    if config.store_root is None:
+        return None
+    return SegmentStore(Path(config.store_root), config.store_max_bytes)
+
+
+def create_controller(workers: int = None) -> Optional[AIMDController]:
+    if not config.adaptive_concurrency:
+        return None
+    return AIMDController(maximum=workers or config.segment_workers)
+
+
+def create_post_steps() -> list:
+    from mym3u8 import postprocess
+
+    return [getattr(postprocess, step) if isinstance(step, str) else step for step in config.post_steps]
+
+
+def create_post_processor():
+    if not config.post_steps:
+        return None
+    from mym3u8.postprocess import PostProcessor
+
+    return PostProcessor(create_post_steps())
+
+
+def create_metrics(out_dir: Path) -> Tuple[Optional[DownloadMetrics], Callable[[], None]]:
+    """DownloadMetrics exported as config says (nowhere: None), and the function that stops exporting it"""
+    if config.metrics_file is None and config.metrics_port is None:
+        return None, lambda: None
+    metrics = DownloadMetrics()
+    reporter = None
+    server = None
+    if config.metrics_file is not None:
+        reporter = MetricsReporter(metrics, out_dir / config.metrics_file, config.metrics_interval).start()
+    if config.metrics_port is not None:
+        server = serve(metrics, config.metrics_port)
+        logger.info(f"metrics: http://127.0.0.1:{config.metrics_port}/metrics")
+
+    def close():
+        if reporter is not None:
+            reporter.close()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    return metrics, close
+
+
+def prepare_verification(task_dir: Path, playlist: mym3u8.Playlist, cna: mym3u8.CacheNameAssigner, verifier: SegmentVerifier):
+    """segments that stay encrypted must not be checked as TS"""
+    if verifier.decrypted:
+        return
+    verifier.add_playlist(playlist)
+    for rendition in load_renditions(task_dir, cna):
+        verifier.add_playlist(rendition)
 
 
+def create_merger(task_dir: Path, playlist: mym3u8.Playlist, cna: mym3u8.CacheNameAssigner) -> Merger:
+    if not config.decrypt_segments and any(
+        line.line_text.startswith("#EXT-X-KEY:") and "METHOD=NONE" not in line.line_text
+        for line in playlist.lines
+    ):
+        logger.warning(f"{playlist!r} is encrypted, the merged file will be encrypted too")
+    paths = segment_paths(task_dir, playlist, cna)
+    ext = paths[-1].suffix if paths else ".ts"
+    return Merger(task_dir / f"merged{ext}", paths).start()
 
+
+def launch_task(m3u8_url, task_name, variant: Union[int, str, None] = None):
+    task_dir = config.save_root / task_name
+    save_arg(task_dir, m3u8_url, task_name)
+    logger.info(f"task dir: {task_dir}")
+    config.dictConfig(task_dir)
+    cna, playlist = load_playlists(task_dir, m3u8_url, variant)
+    if not playlist.has_endlist():
+        logger.warning(
+            f"{playlist!r} has no EXT-X-ENDLIST, it may be live. Only its current segments are downloaded, use --live to record it"
+        )
+    kwargs = {}
+    if config.decrypt_segments:
+        from mym3u8.decrypt import SegmentDecrypter
+
+        kwargs["transform"] = SegmentDecrypter()
+        prepare_decryption(task_dir, playlist, cna, kwargs["transform"])
+        prepare_rendition_decryption(task_dir, cna, kwargs["transform"])
+    verifier = create_verifier()
+    if verifier is not None:
+        prepare_verification(task_dir, playlist, cna, verifier)
+        kwargs["verify"] = verifier
+    kwargs["store"] = create_store()
+    kwargs["controller"] = create_controller()
+    kwargs["post_steps"] = create_post_steps()
+    kwargs["metrics"], close_metrics = create_metrics(task_dir)
+    merger = None
+    if config.merge_segments:
+        merger = create_merger(task_dir, playlist, cna)
+        kwargs["on_complete"] = [merger.on_complete]
+    try:
+        mym3u8.download_segments(task_dir, cna, **kwargs)
+    finally:
+        if merger is not None:
+            merger.close()
+        close_metrics()
+
+
+def launch_live(m3u8_url, task_name, variant: Union[int, str, None] = None, duration: float = None):
+    """
+    Record a live playlist until it ends, `duration` seconds have passed or Ctrl-C.
+    New segments are downloaded while the playlist is being polled.
+    """
+    from mym3u8.live import LiveRecorder
+
+    task_dir = config.save_root / task_name
+    save_arg(task_dir, m3u8_url, task_name)
+    logger.info(f"task dir: {task_dir}")
+    config.dictConfig(task_dir)
+    cna = mym3u8.CacheNameAssigner(min_digits=6)
+    cna_path = task_dir / "cache_assigner.jsonl"
+    if cna_path.exists():
+        # an earlier recording of this task, LiveRecorder continues it
+        cna.load_journal(cna_path)
+    playlist = mym3u8.Playlist(m3u8_url)
+    while playlist.is_master_playlist():
+        cna.register_uri(playlist.url, ext="m3u8")
+        logger.info(f"{playlist!r} is a master playlist. Select a sub playlist")
+        playlist = mym3u8.Playlist(mym3u8.MasterPlaylist(playlist).select_playlist(variant))
+    if config.merge_segments:
+        logger.warning("merge_segments is not supported for live recording, segments are kept as they are")
+
+    decrypter = None
+    if config.decrypt_segments:
+        from mym3u8.decrypt import SegmentDecrypter
+
+        decrypter = SegmentDecrypter()
+    manifest = CompletionManifest(task_dir / "completed.jsonl")
+    verifier = create_verifier()
+    metrics, close_metrics = create_metrics(task_dir)
+    post = create_post_processor()
+    if post is not None:
+        post.add_task("", task_dir / "postprocess.jsonl")
+    downloader = mym3u8.SegmentDownloader(
+        manifest=manifest,
+        controller=create_controller(),
+        on_complete=[post.on_complete] if post is not None else [],
+        transform=decrypter,
+        verify=verifier,
+        store=create_store(),
+        metrics=metrics,
+    )
+    recorder = LiveRecorder(
+        task_dir, playlist.url, downloader, cna, decrypter=decrypter, verifier=verifier, duration=duration
+    )
+    downloader.start()
+    try:
+        recorder.update(playlist)
+        if not recorder.ended:
+            recorder.run()
+        elif recorder.written:
+            recorder.finish()
+    finally:
+        failed = downloader.join()
+        manifest.close()
+        if post is not None:
+            failed.extend(post.join())
+            post.dump()
+        close_metrics()
+    if failed:
+        logger.error(f"{len(failed)} of {downloader.total} files failed to download")
+    else:
+        logger.info(f"All {downloader.total} files downloaded")
+    return failed
+
+
+def parse_variant(variant: Union[int, str, None]) -> Union[int, str, None]:
+    """an index given as a digit string (by --variant or a task file) becomes an int"""
+    if isinstance(variant, str) and variant.isdigit():
+        return int(variant)
+    return variant
+
+
+def read_task_file(task_file: Path) -> List[Dict]:
+    """
+    One task per line, in the same format as launch_args.json:
+        {"task_name": "...", "m3u8_url": "...", "variant": 0}
+    "variant" selects the sub playlist to use if m3u8_url is a master playlist (default 0):
+    its index, or a policy such as "highest", "resolution=1280x720", "max-bandwidth=3000000" or "fastest".
+    Blank lines and lines starting with '#' are ignored.
+    """
+    tasks = []
+    for line in task_file.read_text("utf8").splitlines():
+        line = line.strip()
+        if len(line) == 0 or line.startswith("#"):
+            continue
+        tasks.append(json.loads(line))
+    return tasks
+
+
+def launch_batch(task_file: Path, workers: int = None, per_task: int = None):
+    """
+    Run all tasks of `task_file` without asking anything.
+    Playlists are downloaded task by task, while the segments of all tasks
+    are downloaded by one shared SegmentDownloader, taking turns between tasks.
+    """
+    tasks = read_task_file(task_file)
+    config.save_root.mkdir(parents=True, exist_ok=True)
+    config.dictConfig(config.save_root)
+    logger.info(f"{len(tasks)} tasks in {task_file}")
+
+    decrypter = None
+    if config.decrypt_segments:
+        from mym3u8.decrypt import SegmentDecrypter
+
+        decrypter = SegmentDecrypter()
+    verifier = create_verifier()
+    metrics, close_metrics = create_metrics(config.save_root)
+    mergers: Dict[str, Merger] = dict()
+    post = create_post_processor()
+
+    def merge(job, size):
+        if job.task in mergers:
+            mergers[job.task].on_complete(job, size)
+
+    downloader = mym3u8.SegmentDownloader(
+        workers=workers,
+        per_task=per_task or config.segment_workers_per_task,
+        controller=create_controller(workers),
+        transform=decrypter,
+        verify=verifier,
+        store=create_store(),
+        metrics=metrics,
+        on_complete=[merge] if post is None else [merge, post.on_complete],
+    )
+    manifests: Dict[str, CompletionManifest] = dict()
+    failed_tasks: List[str] = []
+    downloader.start()
+    try:
+        for task in tasks:
+            task_name, m3u8_url = task["task_name"], task["m3u8_url"]
+            task_dir = config.save_root / task_name
+            try:
+                save_arg(task_dir, m3u8_url, task_name, overwrite=True)
+                cna, playlist = load_playlists(task_dir, m3u8_url, parse_variant(task.get("variant", 0)))
+                if decrypter is not None:
+                    prepare_decryption(task_dir, playlist, cna, decrypter)
+                    prepare_rendition_decryption(task_dir, cna, decrypter)
+                if verifier is not None:
+                    prepare_verification(task_dir, playlist, cna, verifier)
+                if config.merge_segments:
+                    mergers[task_name] = create_merger(task_dir, playlist, cna)
+            except Exception:
+                logger.exception(f"Failed to prepare task {task_name!r}")
+                failed_tasks.append(task_name)
+                continue
+            manifests[task_name] = CompletionManifest(task_dir / "completed.jsonl")
+            downloader.add_task(task_name, manifests[task_name])
+            if post is not None:
+                post.add_task(task_name, task_dir / "postprocess.jsonl")
+            jobs = jobs_from_assigner(task_dir, cna, task=task_name)
+            if decrypter is not None:
+                jobs = decrypter.take_key_jobs(jobs)
+            logger.info(f"task {task_name!r}: {len(jobs)} files")
+            downloader.submit_many(jobs)
+    finally:
+        failed = downloader.join()
+        for manifest in manifests.values():
+            manifest.close()
+        if post is not None:
+            failed.extend(post.join())
+            post.dump()
+        for task_name, merger in mergers.items():
+            if not merger.close() and task_name not in failed_tasks:
+                failed_tasks.append(task_name)
+        close_metrics()
+
+    for job, e in failed:
+        if job.task not in failed_tasks:
+            failed_tasks.append(job.task)
+    logger.info(f"{len(tasks) - len(failed_tasks)} of {len(tasks)} tasks finished")
+    if failed_tasks:
+        logger.error(f"failed tasks: {failed_tasks}")
+    return failed_tasks
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=Path, help="task file, one JSON task per line")
+    parser.add_argument("--live", action="store_true", help="keep polling a live playlist")
+    parser.add_argument("--duration", type=float, help="stop recording a live playlist after this many seconds")
+    parser.add_argument(
+        "--variant",
+        help="sub playlist of a master playlist: an index, highest, lowest, resolution=WxH, max-bandwidth=BPS or fastest",
+    )
+    parser.add_argument("m3u8_url", nargs="?")
+    parser.add_argument("task_name", nargs="?")
+    args = parser.parse_args()
+    args.variant = parse_variant(args.variant)
+    if args.batch is not None:
+        launch_batch(args.batch)
+    elif args.live and args.m3u8_url and args.task_name:
+        launch_live(args.m3u8_url, args.task_name, args.variant, args.duration)
+    elif args.m3u8_url and args.task_name:
+        launch_task(args.m3u8_url, args.task_name, args.variant)
+    else:
+        parser.error("either --batch or m3u8_url and task_name is required")
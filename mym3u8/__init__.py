@@ -1,6 +1,7 @@
 from .playlist import Playlist, URILine, CacheNameAssigner,to_local_playlist
 from .master_playlist import MasterPlaylist
 from .media_playlist import MediaPlaylist
+from .downloader import SegmentDownloader, download_segments
 from . import playlist, tag
 
-__all__ = ['tag', 'Playlist', 'MasterPlaylist', 'MediaPlaylist', 'CacheNameAssigner', 'to_local_playlist']
\ No newline at end of file
+__all__ = ['tag', 'Playlist', 'MasterPlaylist', 'MediaPlaylist', 'CacheNameAssigner', 'to_local_playlist', 'SegmentDownloader', 'download_segments']
\ No newline at end of file
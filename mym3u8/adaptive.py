@@ -0,0 +1,148 @@
+"""
+AIMD 并发控制
+
+固定的并发数要么喂不饱带宽大的链路，要么把限流的源站压垮。
+AIMDController 把下载过程切成一个个 `interval` 秒的采样窗口，每个窗口结束时：
+    出现超时 / 429 / 503 等错误       -> window *= decrease（乘性减）
+    延迟没有明显上涨，吞吐没有下降    -> window += increase（加性增）
+    其他情况                         -> 保持不变
+开始时处于慢启动阶段，不等采样窗口结束，每完成 window 个请求（一轮）就 window += 1，以便尽快收敛；
+第一次出现 429 / 503 等错误（退回多出的那一个请求）或者延迟上涨（window 减半）就立即结束慢启动。
+窗口每轮只多放一个请求试探，不会一下子翻过头招来一串 429 把 circuit breaker 打开
+延迟的基准是目前为止采样窗口中位数延迟的最小值，超过基准的 latency_tolerance 倍即认为延迟上涨
+
+worker 在发请求之前 acquire，结束之后 release，同时在途的请求数不会超过 int(window)
+"""
+from typing import List, Optional, Dict
+import statistics
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AIMDController:
+    congestion_statuses = frozenset({429, 503})
+
+    def __init__(
+        self,
+        initial: float = 2,
+        minimum: float = 1,
+        maximum: float = 64,
+        increase: float = 1,
+        decrease: float = 0.5,
+        interval: float = 1.0,
+        latency_tolerance: float = 1.5,
+        slow_start: bool = True,
+    ) -> None:
+        self.window = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.interval = interval
+        self.latency_tolerance = latency_tolerance
+        self.slow_start = slow_start
+        self.in_flight = 0
+        # requests finished since the window last grew in slow start
+        self.round_done = 0
+        self.cond = threading.Condition()
+
+        self.base_latency: Optional[float] = None
+        self.last_mb_per_s = 0.0
+        self.last_latency: Optional[float] = None
+        self.sample_start = time.monotonic()
+        self.sample_bytes = 0
+        self.sample_errors = 0
+        self.sample_latencies: List[float] = []
+        self.history: List[Dict[str, float]] = []
+
+    @property
+    def limit(self) -> int:
+        return max(int(self.window), 1)
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, nbytes: int = 0, latency: Optional[float] = None):
+        """one request finished. latency is None if it didn't produce a usable sample"""
+        with self.cond:
+            self.in_flight -= 1
+            self.sample_bytes += nbytes
+            if latency is not None:
+                self.sample_latencies.append(latency)
+                self.round_done += 1
+                if self.slow_start and self.round_done >= self.limit:
+                    self.window = min(self.window + 1, self.maximum)
+                    self.round_done = 0
+            self._maybe_adjust(force=self.slow_start and self._latency_rose())
+            self.cond.notify_all()
+
+    def record_error(self, status: Optional[int] = None):
+        """
+        a request attempt failed. status is None for timeouts and connection errors.
+        Only those and throttling responses count as congestion.
+        """
+        if status is not None and status not in self.congestion_statuses:
+            return
+        with self.cond:
+            self.sample_errors += 1
+            self._maybe_adjust(force=self.slow_start)
+
+    def _latency_rose(self) -> bool:
+        """the median latency of (at least) a window of requests of this sample is above the tolerance"""
+        if self.base_latency is None or len(self.sample_latencies) < self.limit:
+            return False
+        return statistics.median(self.sample_latencies) > self.base_latency * self.latency_tolerance
+
+    def _maybe_adjust(self, force: bool = False):
+        """adjust the window at the end of a sample, or right now if `force`"""
+        now = time.monotonic()
+        elapsed = now - self.sample_start
+        if elapsed < self.interval and not force:
+            return
+        mb_per_s = self.sample_bytes / max(elapsed, 1e-6) / 1e6
+        latency = statistics.median(self.sample_latencies) if self.sample_latencies else None
+        if latency is not None and (self.base_latency is None or latency < self.base_latency):
+            self.base_latency = latency
+
+        if self.sample_errors > 0:
+            if self.slow_start:
+                # the request the window grew by last was one too many
+                self.window = max(self.window - 1, self.minimum)
+            else:
+                self.window = max(self.window * self.decrease, self.minimum)
+            self.slow_start = False
+        elif latency is not None and latency > self.base_latency * self.latency_tolerance:
+            if self.slow_start:
+                self.window = max(self.window / 2, self.minimum)
+                self.slow_start = False
+        elif not self.slow_start and latency is not None and mb_per_s >= self.last_mb_per_s * 0.95:
+            self.window = min(self.window + self.increase, self.maximum)
+
+        self.history.append(
+            {"time": now, "window": self.window, "mb_per_s": mb_per_s, "errors": self.sample_errors}
+        )
+        logger.debug(
+            f"window={self.window:.1f} {mb_per_s:.2f} MB/s latency={latency} errors={self.sample_errors}"
+        )
+        self.last_mb_per_s = mb_per_s
+        self.last_latency = latency
+        self.sample_start = now
+        self.sample_bytes = 0
+        self.sample_errors = 0
+        self.sample_latencies = []
+
+    def snapshot(self) -> Dict[str, float]:
+        with self.cond:
+            return {
+                "window": self.window,
+                "in_flight": self.in_flight,
+                "mb_per_s": self.last_mb_per_s,
+                "latency": self.last_latency,
+                "base_latency": self.base_latency,
+            }
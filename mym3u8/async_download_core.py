@@ -0,0 +1,180 @@
+"""
+download_core 的 asyncio 版本
+
+所有请求共用一个 aiohttp.ClientSession，连接池按 origin 复用 HTTP/1.1 keep-alive 连接，
+避免每个 segment 都重新做一次 TCP/TLS 握手。重试和超时的语义与 download_core.download 一致
+"""
+from . import download_core, retry
+from .downloader import DownloadJob
+from .retry import RetryPolicy
+from typing import Dict, List, Tuple, Iterable, Callable, Awaitable, TypeVar
+from collections import defaultdict
+from pathlib import Path
+import urllib.parse
+import os
+import requests
+import asyncio
+import aiohttp
+import logging
+import config
+
+logger = logging.getLogger(__name__)
+T = TypeVar('T')
+
+
+def create_session(
+    limit: int = None, limit_per_host: int = None, keepalive_timeout: float = 30
+) -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=limit or config.segment_workers,
+        limit_per_host=limit_per_host or config.segment_workers_per_host,
+        keepalive_timeout=keepalive_timeout,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+async def retrying(url: str, max_retry_times, attempt: Callable[[], Awaitable[T]], policy: RetryPolicy = None) -> T:
+    """async version of download_core.retrying, sharing the same circuit breakers"""
+    if max_retry_times <= 0:
+        raise ValueError(f'Retry times can not less than 0 ({max_retry_times} is given)')
+    policy = policy or retry.default_policy
+    breaker = retry.get_breaker(urllib.parse.urlsplit(url).netloc)
+    errors = []
+    for retry_time in range(max_retry_times + 1):
+        wait = breaker.acquire()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = breaker.acquire()
+        try:
+            result = await attempt()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            errors.append(e)
+            status = e.status if isinstance(e, aiohttp.ClientResponseError) else None
+            if not policy.should_retry(status):
+                breaker.release()
+                raise
+            retry_after = None
+            if isinstance(e, aiohttp.ClientResponseError) and e.headers is not None:
+                retry_after = retry.parse_retry_after(e.headers.get('Retry-After'))
+            breaker.record_failure(retry_after)
+            if retry_time < max_retry_times:
+                await asyncio.sleep(policy.delay(retry_time, retry_after))
+        except BaseException:
+            breaker.release()
+            raise
+        else:
+            breaker.record_success()
+            return result
+    raise requests.exceptions.RetryError(f'retry too many times for {url}') from errors[-1]
+
+
+async def download(
+    session: aiohttp.ClientSession,
+    url: str,
+    headers: Dict[str, str],
+    timeout,
+    max_retry_times,
+    policy: RetryPolicy = None,
+) -> bytes:
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+
+    async def attempt():
+        async with session.get(url, headers=headers, timeout=client_timeout) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+    return await retrying(url, max_retry_times, attempt, policy)
+
+
+async def download_to_file(
+    session: aiohttp.ClientSession,
+    url: str,
+    path: Path,
+    headers: Dict[str, str],
+    timeout,
+    max_retry_times,
+    chunk_size: int = None,
+    resume: bool = False,
+    policy: RetryPolicy = None,
+) -> int:
+    """async version of download_core.download_to_file"""
+    chunk_size = chunk_size or config.segment_chunk_size
+    tmp = download_core.part_path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+
+    async def attempt():
+        offset = tmp.stat().st_size if resume and tmp.exists() else 0
+        req_headers = download_core.range_headers(headers, offset)
+        resp = await session.get(url, headers=req_headers, timeout=client_timeout)
+        if resp.status == 416 and offset:
+            resp.release()
+            tmp.unlink()
+            offset = 0
+            resp = await session.get(url, headers=headers, timeout=client_timeout)
+        async with resp:
+            resp.raise_for_status()
+            if not download_core.is_resumed(resp.status, resp.headers, offset):
+                offset = 0
+            size = offset
+            with tmp.open('ab' if offset else 'wb') as f:
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    f.write(chunk)
+                    size += len(chunk)
+        os.replace(tmp, path)
+        return size
+
+    return await retrying(url, max_retry_times, attempt, policy)
+
+
+async def download_playlist(session: aiohttp.ClientSession, url: str, headers: Dict[str, str] = None):
+    from .playlist import Playlist
+
+    if headers is None:
+        headers = download_core.headers
+    content = await download(session, url, headers, config.m3u8_timeout, config.m3u8_retry_times)
+    return Playlist(url, content.decode("utf8"))
+
+
+class AsyncSegmentDownloader:
+    def __init__(
+        self,
+        workers: int = None,
+        per_host: int = None,
+        timeout: float = None,
+        retry_times: int = None,
+        headers: Dict[str, str] = None,
+        policy: RetryPolicy = None,
+    ) -> None:
+        self.workers = workers or config.segment_workers
+        self.per_host = per_host or config.segment_workers_per_host
+        self.timeout = timeout or config.segment_timeout
+        self.retry_times = retry_times or config.segment_retry_times
+        self.headers = headers
+        self.policy = policy
+        self.failed: List[Tuple[DownloadJob, Exception]] = []
+
+    async def fetch(self, session: aiohttp.ClientSession, job: DownloadJob):
+        headers = self.headers if self.headers is not None else download_core.headers
+        await download_to_file(
+            session, job.url, job.path, headers, self.timeout, self.retry_times, policy=self.policy
+        )
+
+    async def arun(self, jobs: Iterable[DownloadJob]) -> List[Tuple[DownloadJob, Exception]]:
+        workers = asyncio.Semaphore(self.workers)
+        hosts: Dict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+
+        async def run_one(session, job: DownloadJob):
+            async with workers, hosts[job.host]:
+                try:
+                    await self.fetch(session, job)
+                except Exception as e:
+                    logger.error(f"Failed to download {job.url}: {e!r}")
+                    self.failed.append((job, e))
+
+        async with create_session(self.workers, self.per_host) as session:
+            await asyncio.gather(*(run_one(session, job) for job in jobs))
+        return self.failed
+
+    def run(self, jobs: Iterable[DownloadJob]) -> List[Tuple[DownloadJob, Exception]]:
+        return asyncio.run(self.arun(jobs))
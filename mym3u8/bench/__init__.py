@@ -0,0 +1,9 @@
+"""
+本地基准测试
+
+在 repo 根目录下运行，例如:
+    python -m mym3u8.bench.download
+
+suite 依次运行主要的基准测试并把结果保存为 JSON:
+    python -m mym3u8.bench.suite --output bench.json
+"""
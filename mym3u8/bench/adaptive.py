@@ -0,0 +1,61 @@
+"""
+固定并发数与 AIMDController 在受限源站上的吞吐对比
+
+源站默认：每个请求 50ms 延迟，单连接 2 MB/s，总带宽 16 MB/s，同时超过 10 个请求返回 429
+
+    python -m mym3u8.bench.adaptive --fixed 2 4 8 16 32
+"""
+from .origin import MockOrigin
+from .download import bench_downloader
+from ..downloader import SegmentDownloader
+from ..adaptive import AIMDController
+from .. import retry
+import argparse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segments", type=int, default=300)
+    parser.add_argument("--segment-size", type=int, default=188 * 1000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--bandwidth", type=float, default=16e6)
+    parser.add_argument("--connection-bandwidth", type=float, default=2e6)
+    parser.add_argument("--max-concurrency", type=int, default=10)
+    parser.add_argument("--fixed", type=int, nargs="*", default=[2, 4, 8, 16])
+    parser.add_argument("--interval", type=float, default=0.5)
+    args = parser.parse_args(argv)
+
+    from .. import download_core
+
+    download_core.headers = {}
+    origin = MockOrigin(
+        args.segments,
+        args.segment_size,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        connection_bandwidth=args.connection_bandwidth,
+        max_concurrency=args.max_concurrency,
+    )
+    results = []
+    with origin:
+        for n in args.fixed:
+            retry.breakers.clear()
+            downloader = SegmentDownloader(workers=n, per_host=n)
+            results.append(bench_downloader(f"fixed-{n}", downloader, origin))
+        retry.breakers.clear()
+        controller = AIMDController(interval=args.interval)
+        downloader = SegmentDownloader(per_host=int(controller.maximum), controller=controller)
+        result = bench_downloader("aimd", downloader, origin)
+        result["window"] = controller.window
+        result["history"] = controller.history
+        results.append(result)
+    windows = " ".join(f"{h['window']:.0f}" for h in controller.history)
+    print(f"aimd window over time: {windows}")
+    best = max(results[:-1], key=lambda r: r["mb_per_s"], default=None)
+    if best is not None:
+        print(f"best fixed: {best['name']} {best['mb_per_s']:.1f} MB/s, aimd: {result['mb_per_s']:.1f} MB/s")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+EXT-X-BYTERANGE 的 sub-range：每个 sub-range 一个 Range 请求，和首尾相接的 sub-range 合并成一个请求对比
+请求数和耗时
+
+    python -m mym3u8.bench.byterange --segments 1000 --latency 0.02
+"""
+from .origin import MockOrigin
+from ..playlist import Playlist, CacheNameAssigner
+from ..downloader import SegmentDownloader, jobs_from_assigner
+from ..verify import SegmentVerifier
+from pathlib import Path
+import argparse
+import tempfile
+import time
+import config
+
+
+def bench(name, origin: MockOrigin, coalesce_bytes: int, workers: int) -> dict:
+    playlist = Playlist(origin.url("byterange.m3u8"))
+    cna = CacheNameAssigner()
+    cna.register_playlist_uri(playlist)
+    config.range_coalesce_bytes = coalesce_bytes
+    with tempfile.TemporaryDirectory() as tmp:
+        jobs = jobs_from_assigner(Path(tmp), cna)
+        downloader = SegmentDownloader(workers=workers, per_host=workers, verify=SegmentVerifier())
+        requests = origin.requests
+        start = time.perf_counter()
+        failed = downloader.run(jobs)
+        elapsed = time.perf_counter() - start
+        requests = origin.requests - requests
+        assert all(job.path.stat().st_size == origin.segment_size for job in jobs)
+    result = {
+        "name": name,
+        "segments": len(jobs),
+        "requests": requests,
+        "failed": len(failed),
+        "seconds": elapsed,
+        "mb_per_s": len(jobs) * origin.segment_size / elapsed / 1e6,
+    }
+    print(
+        f"{name:>10}: {len(jobs)} sub-ranges with {requests} requests in {elapsed:.3f}s, "
+        f"{result['mb_per_s']:.1f} MB/s, {len(failed)} failed"
+    )
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segments", type=int, default=1000)
+    parser.add_argument("--segment-size", type=int, default=188 * 100)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--coalesce-bytes", type=int, default=config.range_coalesce_bytes)
+    args = parser.parse_args(argv)
+
+    from .. import download_core
+
+    download_core.headers = {}
+    saved = config.range_coalesce_bytes
+    results = []
+    try:
+        with MockOrigin(args.segments, args.segment_size, latency=args.latency) as origin:
+            # a limit smaller than one sub-range keeps every sub-range in a request of its own
+            results.append(bench("per-range", origin, 1, args.workers))
+            results.append(bench("coalesced", origin, args.coalesce_bytes, args.workers))
+    finally:
+        config.range_coalesce_bytes = saved
+    print(f"requests: {results[0]['requests'] / results[1]['requests']:.0f}x fewer")
+    return results
+
+
+if __name__ == "__main__":
+    main()
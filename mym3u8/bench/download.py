@@ -0,0 +1,65 @@
+"""
+同步 SegmentDownloader 与 AsyncSegmentDownloader 的下载吞吐对比
+
+    python -m mym3u8.bench.download --segments 500 --segment-size 188000
+"""
+from .origin import MockOrigin
+from ..playlist import Playlist, CacheNameAssigner
+from ..downloader import SegmentDownloader, jobs_from_assigner
+from ..async_download_core import AsyncSegmentDownloader
+from pathlib import Path
+import argparse
+import tempfile
+import tracemalloc
+import time
+
+
+def bench_downloader(name, downloader, origin: MockOrigin):
+    playlist = Playlist(origin.url("media.m3u8"))
+    cna = CacheNameAssigner()
+    cna.register_playlist_uri(playlist)
+    with tempfile.TemporaryDirectory() as tmp:
+        jobs = jobs_from_assigner(Path(tmp), cna)
+        tracemalloc.start()
+        start = time.perf_counter()
+        failed = downloader.run(jobs)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    total = len(jobs) * origin.segment_size
+    result = {
+        "name": name,
+        "segments": len(jobs),
+        "failed": len(failed),
+        "seconds": elapsed,
+        "mb_per_s": total / elapsed / 1e6,
+        "peak_mb": peak / 1e6,
+    }
+    print(
+        f"{name:>8}: {len(jobs)} segments in {elapsed:.3f}s, {result['mb_per_s']:.1f} MB/s, "
+        f"peak {result['peak_mb']:.1f} MB, {len(failed)} failed"
+    )
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segments", type=int, default=500)
+    parser.add_argument("--segment-size", type=int, default=188 * 1000)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--per-host", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    from .. import download_core
+
+    download_core.headers = {}
+    kwargs = dict(workers=args.workers, per_host=args.per_host)
+    results = []
+    with MockOrigin(args.segments, args.segment_size) as origin:
+        results.append(bench_downloader("sync", SegmentDownloader(**kwargs), origin))
+        results.append(bench_downloader("async", AsyncSegmentDownloader(**kwargs), origin))
+    return results
+
+
+if __name__ == "__main__":
+    main()
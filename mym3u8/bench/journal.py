@@ -0,0 +1,68 @@
+"""
+CacheNameAssigner 的持久化：缩进 JSON（dump / load）与追加日志（save_journal / load_journal）对比
+
+    python -m mym3u8.bench.journal --entries 100000
+"""
+from ..playlist import CacheNameAssigner
+from pathlib import Path
+import argparse
+import tempfile
+import time
+
+
+def filled_assigner(entries: int) -> CacheNameAssigner:
+    cna = CacheNameAssigner()
+    for i in range(entries):
+        if i % 100 == 0:
+            cna.register_uri(f"https://keys.example.com/key/{i}.key")
+        cna.register_uri(f"https://cdn.example.com/hls/video/1080p/segment_{i:08d}.ts?token=abcdef")
+    return cna
+
+
+def timed(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--append", type=int, default=10, help="URIs registered between two saves")
+    args = parser.parse_args(argv)
+
+    cna = filled_assigner(args.entries)
+    n = len(cna.url2cache)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy, journal = Path(tmp) / "cache_assigner.json", Path(tmp) / "cache_assigner.jsonl"
+        for name, save, load, path in (
+            ("json", CacheNameAssigner.dump, CacheNameAssigner.load, legacy),
+            ("journal", CacheNameAssigner.save_journal, CacheNameAssigner.load_journal, journal),
+        ):
+            save_seconds = timed(save, cna, path)
+            loaded = CacheNameAssigner()
+            load_seconds = timed(load, loaded, path)
+            assert {u: c.idx for u, c in loaded.url2cache.items()} == {u: c.idx for u, c in cna.url2cache.items()}
+            # what a live poll or a resume costs once the file exists
+            for i in range(args.append):
+                loaded.register_uri(f"https://cdn.example.com/hls/video/1080p/new_{i}.ts")
+            update_seconds = timed(save, loaded, path)
+            result = {
+                "name": name,
+                "entries": n,
+                "bytes": path.stat().st_size,
+                "save_seconds": save_seconds,
+                "load_seconds": load_seconds,
+                "update_seconds": update_seconds,
+            }
+            print(
+                f"{name:>8}: {n} entries, {result['bytes'] / 1e6:.1f} MB, save {save_seconds:.3f}s, "
+                f"load {load_seconds:.3f}s, save after {args.append} new {update_seconds * 1e3:.2f}ms"
+            )
+            results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    main()
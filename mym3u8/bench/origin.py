@@ -0,0 +1,266 @@
+"""
+本地的 HLS 源站替身，用于基准测试
+
+    with MockOrigin(segments=100) as origin:
+        playlist = Playlist(origin.url("media.m3u8"))
+
+/master.m3u8     master playlist，每个 variant（/video/<i>/）和 audio rendition（/audio/<i>/）都是下面的 media playlist
+/media.m3u8      一个 VOD media playlist，引用下面的所有 segment
+                 （也可以传入 master / media 的文本，例如 suite 按行数生成的 playlist）
+/seg/<i>.ts      segment_size 字节的 TS 包（每 188 字节一个 0x47 同步字节）
+/key/<i>.key     16 字节的 key
+media playlist、segment 和 key 的路径前面可以有任意的目录，都返回同样的内容
+/byterange.m3u8  同样的 segment，用 EXT-X-BYTERANGE 指向 /all.ts 中的 sub-range
+/all.ts          所有 segment 首尾相接
+
+支持单个 `Range: bytes=a-b` 请求，requests 是收到的请求数
+
+可以模拟受限的源站：
+    latency               每个请求在返回响应头之前的等待时间
+    bandwidth             所有连接共享的总带宽（字节/秒）
+    connection_bandwidth  单个连接的带宽（字节/秒）
+    max_concurrency       同时处理的请求超过这个数时返回 429
+    error_rate            以这个概率返回 503（seed 固定时每次运行的结果相同）
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+import threading
+import random
+import time
+import re
+
+TS_PACKET_SIZE = 188
+
+
+def ts_payload(size: int) -> bytes:
+    packet = b"\x47" + b"\xff" * (TS_PACKET_SIZE - 1)
+    count = size // TS_PACKET_SIZE + 1
+    return (packet * count)[:size]
+
+
+def media_playlist_text(segments: int, target_duration: int = 10, prefix: str = "seg/") -> str:
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{target_duration}"]
+    for i in range(segments):
+        lines.append(f"#EXTINF:{target_duration}.000,")
+        lines.append(f"{prefix}{i}.ts")
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def master_playlist_text(variants: int) -> str:
+    lines = ["#EXTM3U", "#EXT-X-VERSION:4", "#EXT-X-INDEPENDENT-SEGMENTS"]
+    for i in range(variants):
+        lines.append(
+            f'#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio-{i}",NAME="audio {i}",LANGUAGE="en",'
+            f'DEFAULT=YES,AUTOSELECT=YES,CHANNELS="2",URI="audio/{i}/media.m3u8"'
+        )
+        lines.append(
+            f'#EXT-X-STREAM-INF:BANDWIDTH={(i + 1) * 400000},AVERAGE-BANDWIDTH={(i + 1) * 350000},'
+            f'RESOLUTION={(i + 1) * 64}x{(i + 1) * 36},FRAME-RATE=30.000,'
+            f'CODECS="avc1.640028,mp4a.40.2",AUDIO="audio-{i}"'
+        )
+        lines.append(f"video/{i}/media.m3u8")
+    return "\n".join(lines) + "\n"
+
+
+def byterange_playlist_text(segments: int, segment_size: int, target_duration: int = 10, uri: str = "all.ts") -> str:
+    lines = ["#EXTM3U", "#EXT-X-VERSION:4", f"#EXT-X-TARGETDURATION:{target_duration}"]
+    for i in range(segments):
+        lines.append(f"#EXTINF:{target_duration}.000,")
+        lines.append(f"#EXT-X-BYTERANGE:{segment_size}@{i * segment_size}" if i == 0 else f"#EXT-X-BYTERANGE:{segment_size}")
+        lines.append(uri)
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+class Throttle:
+    """token bucket without burst: consume(n) sleeps until n more bytes fit into `rate` bytes/s"""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.next_free = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n: int):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_free)
+            self.next_free = start + n / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    segment_re = re.compile(r"/seg/(\d+)\.ts$")
+    key_re = re.compile(r"/key/(\d+)\.key$")
+    range_re = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+    write_chunk = 16 * 1024
+
+    def do_GET(self):
+        origin = self.server.origin
+        if not origin.enter():
+            self.send_empty(429)
+            return
+        try:
+            self.handle_get(origin)
+        finally:
+            origin.exit()
+
+    def send_empty(self, status: int):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def handle_get(self, origin: "MockOrigin"):
+        if origin.fails():
+            self.send_empty(503)
+            return
+        body, content_type = origin.resolve(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        if origin.latency:
+            time.sleep(origin.latency)
+        m = self.range_re.match(self.headers.get("Range", ""))
+        if m is None:
+            self.send_response(200)
+        else:
+            start = int(m.group(1))
+            end = int(m.group(2)) if m.group(2) else len(body) - 1
+            if start >= len(body) or end < start:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(body)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            end = min(end, len(body) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+            body = body[start : end + 1]
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.write_body(origin, body)
+
+    def write_body(self, origin: "MockOrigin", body: bytes):
+        if origin.bandwidth is None and origin.connection_bandwidth is None:
+            self.wfile.write(body)
+            return
+        connection = Throttle(origin.connection_bandwidth) if origin.connection_bandwidth else None
+        view = memoryview(body)
+        for i in range(0, len(view), self.write_chunk):
+            piece = view[i : i + self.write_chunk]
+            if origin.throttle is not None:
+                origin.throttle.consume(len(piece))
+            if connection is not None:
+                connection.consume(len(piece))
+            self.wfile.write(piece)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockOrigin:
+    def __init__(
+        self,
+        segments: int = 100,
+        segment_size: int = TS_PACKET_SIZE * 1000,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        bandwidth: Optional[float] = None,
+        connection_bandwidth: Optional[float] = None,
+        max_concurrency: Optional[int] = None,
+        error_rate: float = 0.0,
+        seed: Optional[int] = None,
+        variants: int = 4,
+        master: Optional[str] = None,
+        media: Optional[str] = None,
+    ) -> None:
+        self.segments = segments
+        self.segment_size = segment_size
+        self.payload = ts_payload(segment_size)
+        self.playlist = (media or media_playlist_text(segments)).encode("utf8")
+        self.master_playlist = (master or master_playlist_text(variants)).encode("utf8")
+        self.byterange_playlist = byterange_playlist_text(segments, segment_size).encode("utf8")
+        self.all: Optional[bytes] = None
+        self.requests = 0
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.connection_bandwidth = connection_bandwidth
+        self.throttle = Throttle(bandwidth) if bandwidth else None
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.rejected = 0
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), OriginHandler)
+        self.server.daemon_threads = True
+        self.server.origin = self
+        self.thread: Optional[threading.Thread] = None
+
+    def enter(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            if self.max_concurrency is not None and self.active >= self.max_concurrency:
+                self.rejected += 1
+                return False
+            self.active += 1
+            return True
+
+    def fails(self) -> bool:
+        if not self.error_rate:
+            return False
+        with self.lock:
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                return True
+            return False
+
+    def exit(self):
+        with self.lock:
+            self.active -= 1
+
+    def resolve(self, path: str):
+        path = path.split("?", 1)[0]
+        if path == "/master.m3u8":
+            return self.master_playlist, "application/vnd.apple.mpegurl"
+        if path.endswith("/media.m3u8"):
+            return self.playlist, "application/vnd.apple.mpegurl"
+        if path == "/byterange.m3u8":
+            return self.byterange_playlist, "application/vnd.apple.mpegurl"
+        if path == "/all.ts":
+            with self.lock:
+                if self.all is None:
+                    self.all = self.payload * self.segments
+            return self.all, "video/mp2t"
+        m = OriginHandler.segment_re.search(path)
+        if m and int(m.group(1)) < self.segments:
+            return self.payload, "video/mp2t"
+        m = OriginHandler.key_re.search(path)
+        if m:
+            return int(m.group(1)).to_bytes(16, "big"), "application/octet-stream"
+        return None, None
+
+    def url(self, path: str = "") -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/{path}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
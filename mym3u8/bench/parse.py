@@ -0,0 +1,231 @@
+"""
+tag.AttributeList 的解析速度：和按字符解析的旧实现对比
+Playlist 的构造：延迟解析 tag 与构造时解析全部 tag（旧的行为）对比耗时、峰值内存、得到第一个 URI 的时间，
+以及每行常驻的内存（不含 content 本身）
+
+合成的 playlist 每个 segment 带一个 EXT-X-KEY 和一个 EXT-X-DATERANGE
+
+    python -m mym3u8.bench.parse --segments 20000
+"""
+from ..tag import Attribute, AttributeList, TagManager, TagWithAttrList
+from ..playlist import Playlist, TagLine, URILine
+from io import StringIO
+from typing import List
+import argparse
+import string
+import tracemalloc
+import time
+import re
+
+
+def tagged_playlist_text(
+    segments: int, target_duration: int = 6, key_prefix: str = "https://keys.example.com/key/"
+) -> str:
+    lines = ["#EXTM3U", "#EXT-X-VERSION:5", f"#EXT-X-TARGETDURATION:{target_duration}"]
+    for i in range(segments):
+        lines.append(
+            f'#EXT-X-KEY:METHOD=AES-128,URI="{key_prefix}{i}.key",'
+            f"IV=0x{i:032x},KEYFORMAT=\"identity\",KEYFORMATVERSIONS=\"1\""
+        )
+        lines.append(
+            f'#EXT-X-DATERANGE:ID="ad-{i}",CLASS="com.example.ad",START-DATE="2024-01-01T00:00:{i % 60:02d}Z",'
+            f'DURATION={target_duration}.0,X-AD-ID="{i},{i + 1}",X-COM-EXAMPLE-BEACON="https://beacon.example.com/{i}"'
+        )
+        lines.append(f"#EXTINF:{target_duration}.000,")
+        lines.append(f"seg/{i}.ts")
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+class LegacyAttributeList:
+    """tag.AttributeList before it was rewritten with attr_re, kept as the baseline"""
+
+    name_charset = string.ascii_uppercase + string.digits + "-"
+
+    def __init__(self, attr_text: str) -> None:
+        self.attr_text = attr_text
+        self.attr_list: List[Attribute] = []
+        self.parse(attr_text)
+
+    def parse(self, attr_text: str):
+        pivot = 0
+        state = "KEY"
+        while pivot < len(attr_text):
+            c = attr_text[pivot]
+            if state == "KEY":
+                attr_obj = Attribute(None, None)
+                attr_obj.key, pivot = self.get_until_assigner(pivot)
+                state = "KEY_END"
+            elif state == "KEY_END":
+                if c != "=":
+                    self._error_position(pivot, "Here should be a assigner")
+                state = "VALUE"
+            elif state == "VALUE":
+                if c == '"':
+                    attr_obj.value, pivot = self.get_quoted_str(pivot)
+                else:
+                    attr_obj.value, pivot = self.get_until_comma(pivot)
+                self.attr_list.append(attr_obj)
+                state = "VALUE_END"
+            elif state == "VALUE_END":
+                if c != ",":
+                    self._error_position(pivot, "Here should be a comma.")
+                state = "KEY"
+            pivot += 1
+
+    def _error_position(self, reason, start, end=None):
+        if end is None or end - start <= 0:
+            end = start
+        before_start_len = 0
+        for c in self.attr_text[:start]:
+            before_start_len += len(repr(c)) - 2  # minus 2 for quotation mark of repr
+        error_len = 0
+        for c in self.attr_text[start : end + 1]:
+            error_len += len(repr(c)) - 2
+        highlight_line = (
+            " " * (before_start_len + 1) + "~" * error_len
+        )  # plus 1 for first quotation mark
+        raise ValueError(f"{self.attr_text!r}\n{highlight_line}\n{reason}")
+
+    def get_quoted_str(self, pivot: int) -> str:
+        """
+        Return text and end pivot.
+        text starts from the first quote to the first close quote
+        pivot is pointing at the close quote.
+        """
+        buf = StringIO()
+        c = self.attr_text[pivot]
+        assert c == '"'
+        buf.write(c)
+        pivot += 1
+        forbidden_char = {"\x0A", "\x0D"}
+        while pivot < len(self.attr_text):
+            c = self.attr_text[pivot]
+            if c in forbidden_char:
+                self._error_position("forbidden character", pivot)
+            else:
+                buf.write(c)
+                if c == '"':
+                    break
+            pivot += 1
+        return buf.getvalue(), pivot
+
+    def get_until_comma(self, pivot: int):
+        """
+        Return text and end pivot.
+        text starts from the pivot to (the position that just
+        before the first comma) or (the end of the text)
+        pivot is pointing at the last character of the text.
+        """
+        buf = StringIO()
+        while pivot < len(self.attr_text):
+            c = self.attr_text[pivot]
+            if c == ",":
+                pivot -= 1
+                break
+            else:
+                buf.write(c)
+            pivot += 1
+        return buf.getvalue(), pivot
+
+    def get_until_assigner(self, pivot: int):
+        """
+        Return text and end pivot.
+        text starts from the pivot to (the position that just
+        before the first assignment sign)
+        pivot is pointing at the last character of the text.
+        """
+        buf = StringIO()
+        while pivot < len(self.attr_text):
+            c = self.attr_text[pivot]
+            if c == "=":
+                pivot -= 1
+                break
+            else:
+                if c not in self.name_charset:
+                    self._error_position(
+                        f"{c!r} is not a valid character in attribute name", pivot
+                    )
+                buf.write(c)
+            pivot += 1
+        return buf.getvalue(), pivot
+
+
+def legacy_build_tag(line: str) -> List[Attribute]:
+    """what TagWithAttrList.__init__ did: compile the pattern of the tag, then parse char by char"""
+    clazz = TagManager.name2class[line.split(":", 1)[0]]
+    re_pattern = clazz.pattern.replace(clazz.attribute_list_placeholder, "(?P<attr_list>.*)")
+    attr_text = re.match(re_pattern, line, re.S).group("attr_list")
+    return LegacyAttributeList(attr_text).attr_list
+
+
+def build_tag(line: str) -> List[Attribute]:
+    return TagManager.build_tag(line).attr_list.attr_list
+
+
+def bench(name, build, lines: List[str], repeat: int) -> dict:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            build(line)
+        best = min(best, time.perf_counter() - start)
+    result = {"name": name, "tags": len(lines), "seconds": best, "us_per_tag": best / len(lines) * 1e6}
+    print(f"{name:>8}: {len(lines)} tags in {best:.3f}s, {result['us_per_tag']:.2f} us/tag")
+    return result
+
+
+def eager_playlist(url: str, content: str) -> Playlist:
+    """a Playlist whose tags are all parsed, as Playlist.__init__ used to do"""
+    playlist = Playlist(url, content)
+    for line in playlist.lines:
+        if isinstance(line, TagLine) and isinstance(line.tag, TagWithAttrList):
+            line.tag.attr_list
+    return playlist
+
+
+def bench_playlist(name, construct, content: str) -> dict:
+    tracemalloc.start()
+    start = time.perf_counter()
+    playlist = construct("https://example.com/live.m3u8", content)
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    first_uri = next(line.get_uri() for line in playlist.lines if isinstance(line, URILine))
+    to_first_uri = time.perf_counter() - start
+    tracemalloc.stop()
+    result = {
+        "name": name,
+        "lines": len(playlist.lines),
+        "seconds": elapsed,
+        "first_uri_seconds": to_first_uri,
+        "peak_mb": peak / 1e6,
+        "bytes_per_line": retained / len(playlist.lines),
+    }
+    print(
+        f"{name:>8}: {len(playlist.lines)} lines in {elapsed:.3f}s, "
+        f"first URI {first_uri!r} after {to_first_uri:.3f}s, peak {result['peak_mb']:.1f} MB, "
+        f"{result['bytes_per_line']:.0f} bytes/line"
+    )
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segments", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    text = tagged_playlist_text(args.segments)
+    lines = [line for line in text.splitlines() if line.startswith(("#EXT-X-KEY:", "#EXT-X-DATERANGE:"))]
+    for line in lines[:1000]:
+        assert build_tag(line) == legacy_build_tag(line), line
+    legacy = bench("legacy", legacy_build_tag, lines, args.repeat)
+    current = bench("current", build_tag, lines, args.repeat)
+    print(f"speedup: {legacy['seconds'] / current['seconds']:.1f}x")
+    eager = bench_playlist("eager", eager_playlist, text)
+    lazy = bench_playlist("lazy", Playlist, text)
+    return [legacy, current, eager, lazy]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+original / absolute / local 三种形式的渲染：一次遍历直接写文件，和 deepcopy 整个 playlist 再改写 URI 的旧做法对比
+耗时和峰值内存
+
+    python -m mym3u8.bench.render --segments 20000
+"""
+from .parse import tagged_playlist_text
+from ..playlist import Playlist, CacheNameAssigner, write_rendered, absolute_uri
+from pathlib import Path
+import urllib.parse
+import tracemalloc
+import argparse
+import tempfile
+import copy
+import time
+
+
+def legacy_to_abs_playlist(playlist: Playlist) -> Playlist:
+    playlist = copy.deepcopy(playlist)
+    for line in playlist.lines:
+        uri = line.get_uri()
+        if uri is not None:
+            line.replace_uri_with(urllib.parse.urljoin(playlist.url, uri))
+    return playlist
+
+
+def legacy_to_local_playlist(playlist: Playlist, cna: CacheNameAssigner) -> Playlist:
+    playlist = copy.deepcopy(playlist)
+    for line in playlist.lines:
+        uri = line.get_uri()
+        if uri is not None:
+            line.replace_uri_with(cna.cache_name(urllib.parse.urljoin(playlist.url, uri)))
+    return playlist
+
+
+def legacy_dump(playlist: Playlist, cna: CacheNameAssigner, original: Path, absolute: Path, local: Path):
+    """what manager.dump_m3u8 did"""
+    original.write_text("".join(line.line_text + "\n" for line in playlist.lines), encoding="utf8")
+    absolute.write_text(
+        "".join(line.line_text + "\n" for line in legacy_to_abs_playlist(playlist).lines),
+        encoding="utf8",
+    )
+    local.write_text(
+        "".join(line.line_text + "\n" for line in legacy_to_local_playlist(playlist, cna).lines),
+        encoding="utf8",
+    )
+
+
+def dump(playlist: Playlist, cna: CacheNameAssigner, original: Path, absolute: Path, local: Path):
+    write_rendered(playlist, [(original, None), (absolute, absolute_uri), (local, cna.cache_name)])
+
+
+def bench(name, dump_func, text: str, cna: CacheNameAssigner, out_dir: Path) -> dict:
+    paths = [out_dir / f"{name}.{form}.m3u8" for form in ("original", "absolute", "local")]
+    # a fresh playlist for every run, lines materialized by one run must not help the other.
+    # tracemalloc slows everything down, so time and memory are measured in separate runs
+    playlist = Playlist("https://example.com/hls/media.m3u8", text)
+    start = time.perf_counter()
+    dump_func(playlist, cna, *paths)
+    elapsed = time.perf_counter() - start
+    playlist = Playlist("https://example.com/hls/media.m3u8", text)
+    tracemalloc.start()
+    dump_func(playlist, cna, *paths)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {"name": name, "lines": len(playlist.lines), "seconds": elapsed, "peak_mb": peak / 1e6}
+    print(f"{name:>8}: {len(playlist.lines)} lines in {elapsed:.3f}s, peak {result['peak_mb']:.1f} MB")
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segments", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    text = tagged_playlist_text(args.segments)
+    cna = CacheNameAssigner()
+    cna.register_playlist_uri(Playlist("https://example.com/hls/media.m3u8", text))
+    with tempfile.TemporaryDirectory() as tmp:
+        out_dir = Path(tmp)
+        legacy = bench("legacy", legacy_dump, text, cna, out_dir)
+        current = bench("current", dump, text, cna, out_dir)
+        for form in ("original", "absolute", "local"):
+            assert (out_dir / f"legacy.{form}.m3u8").read_bytes() == (
+                out_dir / f"current.{form}.m3u8"
+            ).read_bytes(), form
+    print(
+        f"speedup: {legacy['seconds'] / current['seconds']:.1f}x, "
+        f"peak memory: {legacy['peak_mb'] / current['peak_mb']:.1f}x less"
+    )
+    return [legacy, current]
+
+
+if __name__ == "__main__":
+    main()
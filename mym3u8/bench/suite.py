@@ -0,0 +1,222 @@
+"""
+整套基准测试，结果保存为 JSON，和之前保存的结果对比就能发现性能退化
+
+按行数（默认 10 ~ 100000 行）生成合成的 playlist：
+    media   每个 segment 带一个 EXT-X-KEY 和一个 EXT-X-DATERANGE（parse.tagged_playlist_text）
+    master  每个 variant 一个 EXT-X-MEDIA 和一个 EXT-X-STREAM-INF（origin.master_playlist_text）
+每种大小测量 Playlist 的解析、AttributeList 的解析、CacheNameAssigner 的注册 / dump / load / journal、
+三种形式的渲染，耗时取 repeat 次中最快的一次
+
+最后端到端地下载：本地的 MockOrigin（可以设置延迟、带宽和错误率）提供 download_lines 行的 master 和 media playlist，
+从 master 选择第一个 variant，再下载这个 media playlist 的所有 segment 和 key
+
+    python -m mym3u8.bench.suite --lines 10 1000 100000 --output bench.json
+    python -m mym3u8.bench.suite --output new.json --compare bench.json
+"""
+from .origin import MockOrigin, master_playlist_text
+from .parse import tagged_playlist_text, build_tag, eager_playlist
+from ..playlist import Playlist, CacheNameAssigner, write_rendered, absolute_uri
+from ..master_playlist import MasterPlaylist
+from ..downloader import SegmentDownloader, jobs_from_assigner
+from .. import retry
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+import subprocess
+import platform
+import argparse
+import tempfile
+import json
+import time
+import sys
+
+MEDIA_URL = "https://example.com/hls/media.m3u8"
+MASTER_URL = "https://example.com/hls/master.m3u8"
+
+
+def best_of(repeat: int, func: Callable, setup: Callable = None) -> float:
+    """the fastest of `repeat` runs of func(setup()), setup is not timed"""
+    best = float("inf")
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def media_segments(lines: int) -> int:
+    # 3 header lines, 4 lines per segment and EXT-X-ENDLIST
+    return max((lines - 4) // 4, 1)
+
+
+def media_text(lines: int, key_prefix: str = "https://keys.example.com/key/") -> str:
+    return tagged_playlist_text(media_segments(lines), key_prefix=key_prefix)
+
+
+def master_text(lines: int) -> str:
+    # 3 header lines, 3 lines per variant
+    return master_playlist_text(max((lines - 3) // 3, 1))
+
+
+def registered(text: str) -> CacheNameAssigner:
+    cna = CacheNameAssigner()
+    cna.register_playlist_uri(Playlist(MEDIA_URL, text))
+    return cna
+
+
+def bench_size(lines: int, repeat: int, out_dir: Path) -> List[dict]:
+    media, master = media_text(lines), master_text(lines)
+    tags = [line for line in media.splitlines() if line.startswith(("#EXT-X-KEY:", "#EXT-X-DATERANGE:"))]
+    cna = registered(media)
+    json_path, journal_path = out_dir / "cache_assigner.json", out_dir / "cache_assigner.jsonl"
+    render_paths = [
+        (out_dir / "original.m3u8", None),
+        (out_dir / "absolute.m3u8", absolute_uri),
+        (out_dir / "local.m3u8", cna.cache_name),
+    ]
+
+    benches: List[Tuple[str, int, Callable, Callable]] = [
+        ("parse_media_lazy", media.count("\n"), lambda: Playlist(MEDIA_URL, media), None),
+        ("parse_media_eager", media.count("\n"), lambda: eager_playlist(MEDIA_URL, media), None),
+        ("parse_master_eager", master.count("\n"), lambda: eager_playlist(MASTER_URL, master), None),
+        ("attribute_list", len(tags), lambda: [build_tag(line) for line in tags], None),
+        ("cna_register", len(cna.url2cache), lambda playlist: CacheNameAssigner().register_playlist_uri(playlist),
+         lambda: Playlist(MEDIA_URL, media)),
+        ("cna_dump", len(cna.url2cache), lambda: cna.dump(json_path), None),
+        ("cna_load", len(cna.url2cache), lambda: CacheNameAssigner().load(json_path), None),
+        # a first save_journal writes the whole journal
+        ("cna_save_journal", len(cna.url2cache), lambda: cna.compact_journal(journal_path), None),
+        ("cna_load_journal", len(cna.url2cache), lambda: CacheNameAssigner().load_journal(journal_path), None),
+        # a fresh playlist every run, lines materialized by the previous run must not help
+        ("render", media.count("\n"), lambda playlist: write_rendered(playlist, render_paths),
+         lambda: Playlist(MEDIA_URL, media)),
+    ]
+    results = []
+    for name, items, func, setup in benches:
+        seconds = best_of(repeat, func, setup)
+        result = {"name": name, "lines": lines, "items": items, "seconds": seconds, "us_per_item": seconds / items * 1e6}
+        print(f"{name:>18} {lines:>7} lines: {items:>7} items in {seconds:.4f}s, {result['us_per_item']:.2f} us/item")
+        results.append(result)
+    return results
+
+
+def bench_download(args) -> dict:
+    """master playlist -> its first variant -> the segments and keys of the variant"""
+    from .. import download_core
+
+    download_core.headers = {}
+    lines = args.download_lines
+    segments = media_segments(lines)
+    origin = MockOrigin(
+        segments,
+        args.segment_size,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        master=master_text(lines),
+        # the keys are served by the origin too
+        media=media_text(lines, key_prefix="key/"),
+    )
+    retry.breakers.clear()
+    with origin, tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        master = Playlist(origin.url("master.m3u8"))
+        playlist = Playlist(MasterPlaylist(master).select_playlist(0))
+        cna = CacheNameAssigner()
+        cna.register_playlist_uri(master)
+        cna.register_playlist_uri(playlist)
+        jobs = jobs_from_assigner(Path(tmp), cna)
+        downloader = SegmentDownloader(workers=args.workers, per_host=args.workers)
+        failed = downloader.run(jobs)
+        elapsed = time.perf_counter() - start
+        size = sum(job.path.stat().st_size for job in jobs if job.path.exists())
+    result = {
+        "name": "download",
+        "lines": lines,
+        "items": len(jobs),
+        "seconds": elapsed,
+        "us_per_item": elapsed / len(jobs) * 1e6,
+        "segments": segments,
+        "failed": len(failed),
+        "mb_per_s": size / elapsed / 1e6,
+        "requests": origin.requests,
+        "errors": origin.errors,
+    }
+    print(
+        f"{'download':>18} {lines:>7} lines: {len(jobs)} files ({segments} segments) in {elapsed:.3f}s, "
+        f"{result['mb_per_s']:.1f} MB/s, {origin.requests} requests, {origin.errors} errors, {len(failed)} failed"
+    )
+    return result
+
+
+def meta(args) -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "args": vars(args),
+    }
+
+
+def result_key(result: dict) -> Tuple[str, int]:
+    return result["name"], result["lines"]
+
+
+def compare(results: List[dict], baseline_file: Path, threshold: float):
+    """print the time ratio to the baseline of every benchmark, flag the ones slower by more than `threshold`"""
+    baseline: Dict[Tuple[str, int], dict] = {
+        result_key(r): r for r in json.loads(baseline_file.read_text(encoding="utf8"))["results"]
+    }
+    print(f"compared with {baseline_file}:")
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old is None or not old["seconds"]:
+            continue
+        ratio = result["seconds"] / old["seconds"]
+        flag = "  SLOWER" if ratio > 1 + threshold else ""
+        print(f"{result['name']:>18} {result['lines']:>7} lines: {old['seconds']:.4f}s -> {result['seconds']:.4f}s, {ratio:.2f}x{flag}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, nargs="*", default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--download-lines", type=int, default=1000, help="lines of the playlists downloaded end to end, 0 to skip"
+    )
+    parser.add_argument("--segment-size", type=int, default=188 * 1000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes/s shared by all connections")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a 503")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=None, help="save the results to this JSON file")
+    parser.add_argument("--compare", type=Path, default=None, help="JSON file of a previous run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown flagged by --compare")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for lines in args.lines:
+            results.extend(bench_size(lines, args.repeat, Path(tmp)))
+    if args.download_lines:
+        results.append(bench_download(args))
+    report = {"meta": meta(args), "results": results}
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2, default=str), encoding="utf8")
+        print(f"saved to {args.output}")
+    if args.compare is not None:
+        compare(results, args.compare, args.threshold)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+EXT-X-KEY 的 AES-128 解密
+
+segment 在下载的同时解密：download_to_file 每收到一块数据就交给 Decryptor.update，
+写入磁盘的已经是明文，不需要下载完再把所有文件读一遍
+
+每个 segment 使用它前面最近的一个 EXT-X-KEY。没有 IV 属性时，IV 是这个 segment 的
+media sequence number（EXT-X-MEDIA-SEQUENCE + 它在 playlist 中的序号）的 16 字节大端表示
+同一个 key URI 只下载一次：key 不作为普通文件下载（SegmentDecrypter.take_key_jobs），
+由 KeyStore 下载后写入 task 目录中它的 cache 文件，续传时直接读取这个文件
+
+只支持 METHOD=AES-128，SAMPLE-AES 等其他方式的 segment 保持原样
+"""
+from .playlist import Playlist, URILine, range_key
+from .tag import EXT_X_KEY
+from . import download_core
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives import padding
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Iterable
+import threading
+import logging
+import config
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SegmentKey:
+    method: str
+    uri: str
+    iv: bytes
+
+
+def parse_iv(iv: str) -> bytes:
+    """IV is a hexadecimal-sequence: 0x or 0X followed by up to 32 hex digits"""
+    if iv[:2] not in ("0x", "0X"):
+        raise ValueError(f"{iv!r} is not a hexadecimal-sequence")
+    return bytes.fromhex(iv[2:].rjust(32, "0"))
+
+
+def media_sequence_iv(sequence: int) -> bytes:
+    return sequence.to_bytes(16, "big")
+
+
+def segment_keys(playlist: Playlist) -> Dict[str, SegmentKey]:
+    """the key of every encrypted segment of a media playlist, by the cache key (see range_key) of the segment"""
+    keys: Dict[str, SegmentKey] = dict()
+    sequence = 0
+    key: Optional[EXT_X_KEY] = None
+    key_uri: Optional[str] = None
+    for text, line, fq_uri, byterange in playlist.scan_uris():
+        if text.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            sequence = int(text.split(":", 1)[1])
+        elif text.startswith(EXT_X_KEY.prefix):
+            # METHOD=NONE has no URI
+            key = None if line is None or line.tag["METHOD"] == "NONE" else line.tag
+            key_uri = fq_uri
+        elif isinstance(line, URILine):
+            if key is not None:
+                iv = parse_iv(key["IV"]) if "IV" in key else media_sequence_iv(sequence)
+                keys[range_key(fq_uri, byterange)] = SegmentKey(key["METHOD"], key_uri, iv)
+            sequence += 1
+    return keys
+
+
+def strip_key_tags(content: str) -> str:
+    """the playlist of decrypted segments must not tell players to decrypt them again"""
+    return "".join(
+        line + "\n" for line in content.splitlines() if not line.startswith("#EXT-X-KEY:")
+    )
+
+
+def read_key(path: Path) -> Optional[bytes]:
+    try:
+        key = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    return key if len(key) == 16 else None
+
+
+def write_key(path: Path, key: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(key)
+    tmp.replace(path)
+
+
+class KeyStore:
+    """download every key once, memoized by key uri, and save it to the paths added by save_to"""
+
+    def __init__(self, headers: Dict[str, str] = None) -> None:
+        self.headers = headers
+        self.keys: Dict[str, bytes] = dict()
+        self.paths: Dict[str, List[Path]] = dict()
+        self.locks: Dict[str, threading.Lock] = dict()
+        self.lock = threading.Lock()
+
+    def save_to(self, uri: str, path: Path):
+        """write the key of `uri` to `path` once it is known; a key already there is not downloaded again"""
+        with self.lock:
+            key = self.keys.get(uri)
+            if key is None:
+                self.paths.setdefault(uri, []).append(path)
+                return
+        if read_key(path) != key:
+            write_key(path, key)
+
+    def get(self, uri: str) -> bytes:
+        with self.lock:
+            if uri in self.keys:
+                return self.keys[uri]
+            uri_lock = self.locks.setdefault(uri, threading.Lock())
+        with uri_lock:
+            if uri not in self.keys:
+                with self.lock:
+                    saved = list(self.paths.get(uri, ()))
+                key = next((key for key in map(read_key, saved) if key is not None), None)
+                if key is None:
+                    headers = self.headers if self.headers is not None else download_core.headers
+                    key = download_core.download(
+                        uri, headers, config.m3u8_timeout, config.m3u8_retry_times
+                    ).content
+                    if len(key) != 16:
+                        raise ValueError(f"AES-128 key from {uri} is {len(key)} bytes long")
+                with self.lock:
+                    self.keys[uri] = key
+                    # with the paths added by save_to in the meantime
+                    paths = self.paths.pop(uri, [])
+                for path in paths:
+                    if read_key(path) != key:
+                        write_key(path, key)
+            return self.keys[uri]
+
+
+class Decryptor:
+    """AES-128-CBC with PKCS7 padding, fed chunk by chunk"""
+
+    def __init__(self, key: bytes, iv: bytes) -> None:
+        self.decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+        self.unpadder = padding.PKCS7(128).unpadder()
+
+    def update(self, data: bytes) -> bytes:
+        return self.unpadder.update(self.decryptor.update(data))
+
+    def finalize(self) -> bytes:
+        return self.unpadder.update(self.decryptor.finalize()) + self.unpadder.finalize()
+
+
+class SegmentDecrypter:
+    """
+    SegmentDownloader transform: called with a DownloadJob, returns a factory of Decryptors
+    for an AES-128 segment, None for everything else
+    """
+
+    def __init__(self, playlists: Iterable[Playlist] = (), key_store: KeyStore = None) -> None:
+        self.keys: Dict[str, SegmentKey] = dict()
+        self.key_store = key_store or KeyStore()
+        for playlist in playlists:
+            self.add_playlist(playlist)
+
+    def add_playlist(self, playlist: Playlist):
+        keys = segment_keys(playlist)
+        for method in {key.method for key in keys.values()} - {"AES-128"}:
+            logger.warning(
+                f"METHOD={method} of {playlist!r} is not supported, these segments are kept encrypted"
+            )
+        self.keys.update(keys)
+
+    def take_key_jobs(self, jobs: Iterable) -> List:
+        """
+        Leave the AES-128 keys of the added playlists out of `jobs` (DownloadJobs):
+        the key store downloads each of them once and saves it to the path of its job.
+        """
+        uris = {key.uri for key in self.keys.values() if key.method == "AES-128"}
+        rest = []
+        for job in jobs:
+            if job.url in uris and job.cache.byterange is None:
+                self.key_store.save_to(job.url, job.path)
+            else:
+                rest.append(job)
+        return rest
+
+    def __call__(self, job):
+        key = self.keys.get(job.key)
+        if key is None or key.method != "AES-128":
+            return None
+        return lambda: Decryptor(self.key_store.get(key.uri), key.iv)
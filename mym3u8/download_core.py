@@ -1,23 +1,279 @@
 import requests
 import config
-from typing import Dict
+from .retry import RetryPolicy
+from . import retry
+from typing import Dict, Callable, TypeVar, Optional, Any, Iterable, Iterator, List, Sequence, Tuple
 from pathlib import Path
+import http.cookiejar
+import urllib.parse
+import threading
+import time
+import os
 
-def download(url: str, headers: Dict[str, str], timeout, max_retry_times) -> requests.Response:
+T = TypeVar('T')
+
+_local = threading.local()
+
+def session() -> requests.Session:
+    """
+    The requests.Session of this thread, so that the connections to an origin are kept alive
+    between requests instead of opening one per segment. Cookies are not kept, as with requests.get.
+    """
+    s = getattr(_local, 'session', None)
+    if s is None:
+        s = _local.session = requests.Session()
+        s.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    return s
+
+def retrying(url: str, max_retry_times, attempt: Callable[[], T], policy: RetryPolicy = None, on_error: Callable[[Optional[int]], None] = None) -> T:
+    """
+    Call `attempt` until it succeeds, at most `max_retry_times` + 1 times.
+    Between attempts, wait as `policy` says. Every attempt first waits until the circuit
+    breaker of the url's host lets it through, and reports the outcome back to the breaker.
+    Errors that `policy` does not retry (e.g. 404) are raised immediately.
+    A body rejected by IntegrityError (other than IncompleteBody) is fetched again only once: the server
+    did answer, so it counts neither against the circuit breaker nor as an error for `on_error`,
+    and the refetch is not one of the `max_retry_times` retries.
+    `on_error` is called with the HTTP status (None for connection errors and timeouts) of every failed attempt.
+    """
     if max_retry_times <= 0:
         raise ValueError(f'Retry times can not less than 0 ({max_retry_times} is given)')
-    retry_time = 0
+    policy = policy or retry.default_policy
+    breaker = retry.get_breaker(urllib.parse.urlsplit(url).netloc)
     errors = []
+    rejected = False
+    retry_time = 0
     while retry_time <= max_retry_times:
+        wait = breaker.acquire()
+        while wait > 0:
+            time.sleep(wait)
+            wait = breaker.acquire()
         try:
-            with requests.get(url, headers=headers, timeout=timeout) as resp:
-                resp.raise_for_status()
-                return resp
+            result = attempt()
         except requests.RequestException as e:
-            retry_time += 1
             errors.append(e)
+            if isinstance(e, IntegrityError) and not isinstance(e, IncompleteBody):
+                breaker.release()
+                if rejected:
+                    raise
+                rejected = True
+                continue
+            resp = e.response
+            if on_error is not None:
+                on_error(None if resp is None else resp.status_code)
+            if not policy.should_retry(None if resp is None else resp.status_code):
+                breaker.release()
+                raise
+            retry_after = None if resp is None else retry.parse_retry_after(resp.headers.get('Retry-After'))
+            breaker.record_failure(retry_after)
+            if retry_time < max_retry_times:
+                time.sleep(policy.delay(retry_time, retry_after))
+            retry_time += 1
+        except BaseException:
+            breaker.release()
+            raise
+        else:
+            breaker.record_success()
+            return result
     raise requests.exceptions.RetryError(f'retry too many times for {url}') from errors[-1]
 
+def download(url: str, headers: Dict[str, str], timeout, max_retry_times, policy: RetryPolicy = None) -> requests.Response:
+    def attempt():
+        with session().get(url, headers=headers, timeout=timeout) as resp:
+            resp.raise_for_status()
+            return resp
+
+    return retrying(url, max_retry_times, attempt, policy)
+
+def download_if_modified(url: str, headers: Dict[str, str], timeout, max_retry_times, etag: str = None, last_modified: str = None, policy: RetryPolicy = None) -> requests.Response:
+    """
+    Conditional GET with the validators of the previous response.
+    The status code of the response is 304 if nothing has changed.
+    """
+    headers = dict(headers or {})
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return download(url, headers, timeout, max_retry_times, policy)
+
+def part_path(path: Path) -> Path:
+    return path.with_name(path.name + '.part')
+
+def range_headers(headers: Dict[str, str], offset: int) -> Dict[str, str]:
+    if offset <= 0:
+        return headers
+    return dict(headers or {}, Range=f'bytes={offset}-')
+
+def is_resumed(status: int, resp_headers, offset: int) -> bool:
+    """whether the server answered a `Range: bytes=offset-` request with the tail we asked for"""
+    return status == 206 and resp_headers.get('Content-Range', '').startswith(f'bytes {offset}-')
+
+class IntegrityError(requests.RequestException):
+    """the body is not what it should be. The partial file is dropped, and retrying fetches it again only once"""
+
+class IncompleteBody(IntegrityError):
+    """the connection closed before Content-Length bytes arrived. What has arrived is kept and resumed"""
+
+def body_length(resp_headers) -> Optional[int]:
+    """the number of body bytes iter_content yields, if the server told it"""
+    if resp_headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    length = resp_headers.get('Content-Length')
+    return int(length) if length is not None and length.isdigit() else None
+
+def counted(chunks: Iterable[bytes], expected: Optional[int], url: str) -> Iterator[bytes]:
+    """yield `chunks`, and raise IncompleteBody if they do not add up to `expected` bytes"""
+    received = 0
+    for chunk in chunks:
+        received += len(chunk)
+        yield chunk
+    if expected is not None and received != expected:
+        raise IncompleteBody(f'{received} of {expected} bytes of {url} received')
+
+def write_chunks(f, chunks: Iterable[bytes], t=None, v=None) -> int:
+    """write `chunks` through the transform `t` and the check `v` (see download_to_file). Return the bytes written"""
+    size = 0
+    for chunk in chunks:
+        if t is not None:
+            chunk = t.update(chunk)
+        if v is not None:
+            v.update(chunk)
+        f.write(chunk)
+        size += len(chunk)
+    if t is not None:
+        chunk = t.finalize()
+        if v is not None:
+            v.update(chunk)
+        f.write(chunk)
+        size += len(chunk)
+    if v is not None:
+        v.finalize()
+    return size
+
+def feed_file(path: Path, consumer, chunk_size: int):
+    with path.open('rb') as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            consumer.update(chunk)
+            chunk = f.read(chunk_size)
+
+def download_to_file(url: str, path: Path, headers: Dict[str, str], timeout, max_retry_times, chunk_size: int = None, resume: bool = False, policy: RetryPolicy = None, on_error: Callable[[Optional[int]], None] = None, transform: Callable[[], Any] = None, verify: Callable[[], Any] = None) -> int:
+    """
+    Stream the body into `path`.part chunk by chunk, then rename it to `path`.
+    Only `chunk_size` bytes of the body are held in memory at a time.
+    If `resume` is True and `path`.part already exists, only the missing tail is requested.
+    `transform` creates an object with update(bytes) -> bytes and finalize() -> bytes
+    (e.g. a decryptor) for every attempt; the transformed bytes are written instead of the body.
+    A transformed download is never resumed.
+    `verify` creates an object with update(bytes) and finalize() (e.g. verify.SegmentCheck) for every attempt,
+    it sees every byte written to `path`, including the resumed prefix, and raises IntegrityError to reject them.
+    A body shorter than its Content-Length raises IncompleteBody.
+    Return the size of the file.
+    """
+    chunk_size = chunk_size or config.segment_chunk_size
+    tmp = part_path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    def attempt():
+        offset = tmp.stat().st_size if resume and transform is None and tmp.exists() else 0
+        resp = session().get(url, headers=range_headers(headers, offset), timeout=timeout, stream=True)
+        if resp.status_code == 416 and offset:
+            # the partial file is not a prefix of this resource any more
+            resp.close()
+            tmp.unlink()
+            offset = 0
+            resp = session().get(url, headers=headers, timeout=timeout, stream=True)
+        with resp:
+            resp.raise_for_status()
+            if not is_resumed(resp.status_code, resp.headers, offset):
+                offset = 0
+            chunks = counted(resp.iter_content(chunk_size), body_length(resp.headers), url)
+            t = transform() if transform is not None else None
+            v = verify() if verify is not None else None
+            try:
+                if v is not None and offset:
+                    feed_file(tmp, v, chunk_size)
+                with tmp.open('ab' if offset else 'wb') as f:
+                    size = offset + write_chunks(f, chunks, t, v)
+            except IncompleteBody:
+                raise
+            except IntegrityError:
+                tmp.unlink(missing_ok=True)
+                raise
+        os.replace(tmp, path)
+        return size
+
+    return retrying(url, max_retry_times, attempt, policy, on_error)
+
+def download_ranges(url: str, parts: Sequence[Tuple[Path, int, int]], headers: Dict[str, str], timeout, max_retry_times, chunk_size: int = None, policy: RetryPolicy = None, on_error: Callable[[Optional[int]], None] = None, transforms: Sequence[Optional[Callable[[], Any]]] = None, verifies: Sequence[Optional[Callable[[], Any]]] = None) -> List[int]:
+    """
+    Download the byte ranges `parts` ((path, offset, length), contiguous and sorted by offset) of `url`
+    with one Range request, and split the body into their files as it streams in.
+    Every file is written like download_to_file writes it, through transforms[i] and verifies[i] if given,
+    but never resumed. A retry only requests the parts that are not written yet.
+    A server that ignores Range sends the whole resource, the bytes before the first part are skipped.
+    Return the sizes of the files.
+    """
+    chunk_size = chunk_size or config.segment_chunk_size
+    transforms = transforms or [None] * len(parts)
+    verifies = verifies or [None] * len(parts)
+    sizes: List[Optional[int]] = [None] * len(parts)
+
+    def attempt():
+        first = sizes.index(None)
+        start = parts[first][1]
+        end = parts[-1][1] + parts[-1][2]
+        with session().get(url, headers=dict(headers or {}, Range=f'bytes={start}-{end - 1}'), timeout=timeout, stream=True) as resp:
+            resp.raise_for_status()
+            if is_resumed(resp.status_code, resp.headers, start):
+                skip = 0
+                expected = body_length(resp.headers)
+            elif resp.status_code == 200:
+                skip = start
+                expected = None
+            else:
+                raise IntegrityError(f'{url} answered bytes={start}-{end - 1} with {resp.headers.get("Content-Range")!r}')
+            body = BodyReader(counted(resp.iter_content(chunk_size), expected, url), url)
+            for _ in body.take(skip):
+                pass
+            for i in range(first, len(parts)):
+                path, _, length = parts[i]
+                tmp = part_path(path)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                t = transforms[i]() if transforms[i] is not None else None
+                v = verifies[i]() if verifies[i] is not None else None
+                try:
+                    with tmp.open('wb') as f:
+                        size = write_chunks(f, body.take(length), t, v)
+                except IntegrityError:
+                    tmp.unlink(missing_ok=True)
+                    raise
+                os.replace(tmp, path)
+                sizes[i] = size
+        return sizes
+
+    return retrying(url, max_retry_times, attempt, policy, on_error)
+
+class BodyReader:
+    """cut a stream of chunks into pieces of given lengths"""
+
+    def __init__(self, chunks: Iterable[bytes], url: str) -> None:
+        self.chunks = iter(chunks)
+        self.url = url
+        self.pending = b''
+
+    def take(self, n: int) -> Iterator[bytes]:
+        """yield the next `n` bytes, in pieces no larger than the chunks"""
+        while n > 0:
+            if not self.pending:
+                self.pending = next(self.chunks, b'')
+                if not self.pending:
+                    raise IncompleteBody(f'the body of {self.url} ended {n} bytes early')
+            piece, self.pending = self.pending[:n], self.pending[n:]
+            n -= len(piece)
+            yield piece
+
 def parse_header(header_file: Path) -> Dict[str, str]:
     lines = header_file.read_text('utf8').splitlines()
     lid = 0
@@ -0,0 +1,488 @@
+"""
+segment 下载阶段
+
+CacheNameAssigner 已经给每个 URI 分配好了本地文件名，这里只负责把它们下载到 task_dir / cache_name
+m3u8 文件由 manager.dump_m3u8 负责写入，不在这里下载
+
+如果给了 CompletionManifest（批量下载时每个 task 一个），清单中已完成、文件还在且大小一致的直接跳过；
+清单中没有、但目标文件已存在的（.part 改名是原子的，所以它一定是完整的）补记到清单后跳过；
+只下载了一部分的 .part 文件用 Range 请求续传
+
+每个文件下载完成（或者之前已经下载完成而被跳过）时，依次调用 on_complete 中的回调 callback(job, size)，
+后处理、合并等后续阶段从这里接入
+
+transform(job) 可以为某个文件返回一个流式变换（例如 decrypt.SegmentDecrypter），数据在写入磁盘之前经过它
+verify(job) 可以为某个文件返回一个流式校验（例如 verify.SegmentVerifier），它看到写入磁盘的每个字节，
+校验失败的文件重新下载，通过的文件的 sha256 记录在清单中
+
+如果给了 SegmentStore（见 store.py），下载之前先在仓库中找这个 URL，找到就硬链接过来，不再下载；
+下载完成的文件加入仓库
+
+同一个 URL 的 sub-range（EXT-X-BYTERANGE）是各自独立的 job，排队之前，同一个 URL 首尾相接的
+sub-range 合并成一个 RangeJob（不超过 config.range_coalesce_bytes），用一个 Range 请求下载，
+收到的数据在本地切开，写入各自的文件（见 download_core.download_ranges）
+
+如果给了 AIMDController，同时在途的请求数由它动态决定（见 adaptive.py），workers 只是上限
+
+如果给了 DownloadMetrics（见 metrics.py），下载过程中更新它的计数、速度和每个 host 的耗时，
+有 AIMDController 的话它的 snapshot 也一起报告
+
+Scheduler 按 task、host 分组排队，每个 host 同时在下载的数量不超过 per_host，每个 task 不超过 per_task，
+多个 task 轮流取任务，保证它们的 segment 交错下载，
+worker 线程从 Scheduler 中取任务，取不到就等待，直到 Scheduler 被 close 并且队列清空
+"""
+from . import download_core
+from .playlist import Cache, CacheNameAssigner
+from .manifest import CompletionManifest
+from .retry import RetryPolicy
+from .adaptive import AIMDController
+from .store import SegmentStore
+from .metrics import DownloadMetrics
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Dict, Deque, Optional, Tuple, Iterable, Callable, Sequence, Union
+from collections import defaultdict, deque
+import urllib.parse
+import threading
+import logging
+import time
+import config
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DownloadJob:
+    cache: Cache
+    path: Path
+    task: str = ""
+
+    @property
+    def url(self) -> str:
+        return self.cache.url
+
+    @property
+    def key(self) -> str:
+        """the url, and the byte range if the job is a sub-range of it"""
+        return self.cache.key
+
+    @property
+    def host(self) -> str:
+        return urllib.parse.urlsplit(self.cache.url).netloc
+
+
+@dataclass
+class RangeJob:
+    """contiguous sub-ranges of one url, sorted by offset, downloaded with one Range request"""
+    parts: List[DownloadJob]
+
+    @property
+    def url(self) -> str:
+        return self.parts[0].url
+
+    @property
+    def task(self) -> str:
+        return self.parts[0].task
+
+    @property
+    def host(self) -> str:
+        return self.parts[0].host
+
+
+def coalesce_jobs(jobs: Iterable[DownloadJob], max_bytes: int = None) -> List[Union[DownloadJob, RangeJob]]:
+    """
+    Group the sub-range jobs of the same url and task into RangeJobs of contiguous ranges,
+    at most `max_bytes` each. Whole-resource jobs are returned as they are.
+    Every item takes the place of its first job.
+    """
+    max_bytes = max_bytes or config.range_coalesce_bytes
+    items: List[Optional[Union[DownloadJob, RangeJob]]] = []
+    ranged: Dict[Tuple[str, str], List[Tuple[int, DownloadJob]]] = defaultdict(list)
+    for job in jobs:
+        if job.cache.byterange is None:
+            items.append(job)
+        else:
+            ranged[(job.task, job.url)].append((len(items), job))
+            items.append(None)
+    for group in ranged.values():
+        group.sort(key=lambda item: item[1].cache.byterange)
+        run: List[Tuple[int, DownloadJob]] = []
+        for position, job in group:
+            offset, length = job.cache.byterange
+            if run:
+                last_offset, last_length = run[-1][1].cache.byterange
+                first_offset = run[0][1].cache.byterange[0]
+                if offset != last_offset + last_length or offset + length - first_offset > max_bytes:
+                    items[min(p for p, _ in run)] = RangeJob([j for _, j in run])
+                    run = []
+            run.append((position, job))
+        items[min(p for p, _ in run)] = RangeJob([j for _, j in run])
+    return [item for item in items if item is not None]
+
+
+def jobs_from_assigner(
+    task_dir: Path,
+    cna: CacheNameAssigner,
+    skip_exts: Iterable[str] = ("m3u8",),
+    task: str = "",
+) -> List[DownloadJob]:
+    jobs = []
+    for ext, cache_list in cna.ext2cache_list.items():
+        if ext in skip_exts:
+            continue
+        for cache in cache_list:
+            jobs.append(DownloadJob(cache, task_dir / cna.cache_name(cache.url, cache.byterange), task))
+    return jobs
+
+
+class Scheduler:
+    """
+    hand out jobs to workers, at most `per_host` jobs of the same host
+    and at most `per_task` jobs of the same task at a time.
+    Tasks take turns, and so do the hosts inside a task.
+    """
+
+    def __init__(self, per_host: int, per_task: Optional[int] = None) -> None:
+        self.per_host = per_host
+        self.per_task = per_task
+        self.pending: Dict[str, Dict[str, Deque[DownloadJob]]] = dict()
+        self.host_in_flight: Dict[str, int] = defaultdict(int)
+        self.task_in_flight: Dict[str, int] = defaultdict(int)
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def submit(self, job: DownloadJob):
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("scheduler is closed")
+            hosts = self.pending.setdefault(job.task, dict())
+            hosts.setdefault(job.host, deque()).append(job)
+            self.cond.notify()
+
+    def close(self):
+        """no more jobs will be submitted"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def acquire(self) -> Optional[DownloadJob]:
+        """block until a job is available. Return None if closed and drained."""
+        with self.cond:
+            while True:
+                job = self._pick()
+                if job is not None:
+                    self.host_in_flight[job.host] += 1
+                    self.task_in_flight[job.task] += 1
+                    return job
+                if self.closed and not self.pending:
+                    return None
+                self.cond.wait()
+
+    def release(self, job: DownloadJob):
+        with self.cond:
+            self.host_in_flight[job.host] -= 1
+            self.task_in_flight[job.task] -= 1
+            self.cond.notify_all()
+
+    def _pick(self) -> Optional[DownloadJob]:
+        for task, hosts in self.pending.items():
+            if self.per_task is not None and self.task_in_flight[task] >= self.per_task:
+                continue
+            for host, queue in hosts.items():
+                if self.host_in_flight[host] >= self.per_host:
+                    continue
+                job = queue.popleft()
+                # round robin: move this host and this task to the end
+                del hosts[host]
+                if queue:
+                    hosts[host] = queue
+                del self.pending[task]
+                if hosts:
+                    self.pending[task] = hosts
+                return job
+        return None
+
+
+class SegmentDownloader:
+    def __init__(
+        self,
+        workers: int = None,
+        per_host: int = None,
+        timeout: float = None,
+        retry_times: int = None,
+        headers: Dict[str, str] = None,
+        manifest: CompletionManifest = None,
+        policy: RetryPolicy = None,
+        controller: AIMDController = None,
+        per_task: int = None,
+        on_complete: Iterable[Callable[[DownloadJob, int], None]] = (),
+        transform: Callable[[DownloadJob], Optional[Callable]] = None,
+        verify: Callable[[DownloadJob], Optional[Callable]] = None,
+        store: SegmentStore = None,
+        metrics: DownloadMetrics = None,
+    ) -> None:
+        if workers is None and controller is not None:
+            workers = int(controller.maximum)
+        self.workers = workers or config.segment_workers
+        self.per_host = per_host or config.segment_workers_per_host
+        self.timeout = timeout or config.segment_timeout
+        self.retry_times = retry_times or config.segment_retry_times
+        self.headers = headers
+        self.policy = policy
+        self.manifests: Dict[str, CompletionManifest] = dict()
+        if manifest is not None:
+            self.manifests[""] = manifest
+        self.controller = controller
+        self.on_complete: List[Callable[[DownloadJob, int], None]] = list(on_complete)
+        self.transform = transform
+        self.verify = verify
+        self.store = store
+        self.metrics = metrics
+        if metrics is not None and controller is not None:
+            metrics.controller = controller
+        self.scheduler = Scheduler(self.per_host, per_task)
+        self.threads: List[threading.Thread] = []
+        self.failed: List[Tuple[DownloadJob, Exception]] = []
+        self.done = 0
+        self.skipped = 0
+        self.from_store = 0
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def checked(self, job: DownloadJob) -> Tuple[Optional[Callable], list]:
+        """the verify factory of `job`, and the list the checks it creates are collected in"""
+        make_check = self.verify(job) if self.verify is not None else None
+        checks = []
+        if make_check is None:
+            return None, checks
+
+        def verify():
+            checks.append(make_check())
+            return checks[-1]
+
+        return verify, checks
+
+    def fetch(self, job: DownloadJob, on_error: Callable[[Optional[int]], None] = None) -> Tuple[int, Optional[str]]:
+        """download `job`. Return its size and sha256 (None if it is not verified)"""
+        headers = self.headers if self.headers is not None else download_core.headers
+        transform = self.transform(job) if self.transform is not None else None
+        verify, checks = self.checked(job)
+        size = download_core.download_to_file(
+            job.url, job.path, headers, self.timeout, self.retry_times,
+            resume=True, policy=self.policy, on_error=on_error, transform=transform, verify=verify,
+        )
+        return size, checks[-1].hexdigest() if checks else None
+
+    def fetch_ranges(
+        self, item: RangeJob, on_error: Callable[[Optional[int]], None] = None
+    ) -> List[Tuple[DownloadJob, int, Optional[str]]]:
+        """download the parts of `item`. Return (job, size, sha256) of every part"""
+        headers = self.headers if self.headers is not None else download_core.headers
+        transforms = [self.transform(job) if self.transform is not None else None for job in item.parts]
+        verifies, checks = zip(*(self.checked(job) for job in item.parts))
+        sizes = download_core.download_ranges(
+            item.url, [(job.path, *job.cache.byterange) for job in item.parts], headers,
+            self.timeout, self.retry_times, policy=self.policy, on_error=on_error,
+            transforms=transforms, verifies=verifies,
+        )
+        return [
+            (job, size, part_checks[-1].hexdigest() if part_checks else None)
+            for job, size, part_checks in zip(item.parts, sizes, checks)
+        ]
+
+    def add_task(self, task: str, manifest: CompletionManifest):
+        """jobs whose `task` is `task` are recorded in (and skipped by) `manifest`"""
+        self.manifests[task] = manifest
+
+    def completed_size(self, job: DownloadJob) -> Optional[int]:
+        """the size of the file if it was downloaded before, otherwise None"""
+        manifest = self.manifests.get(job.task)
+        if manifest is None:
+            return None
+        if job.key in manifest:
+            size = manifest.completed[job.key]
+            try:
+                if job.path.stat().st_size == size:
+                    return size
+            except FileNotFoundError:
+                pass
+            logger.warning(f"{job.path} is missing or is not {size} bytes any more, download it again")
+            return None
+        if job.path.exists():
+            size = job.path.stat().st_size
+            manifest.mark(job.key, size)
+            return size
+        return None
+
+    def store_key(self, job: DownloadJob) -> str:
+        """transformed files differ from what the url serves"""
+        if self.transform is not None and self.transform(job) is not None:
+            return job.key + "#decrypted"
+        return job.key
+
+    def link_from_store(self, job: DownloadJob) -> Optional[int]:
+        """hardlink `job` from the store. Return its size, or None if it is not stored"""
+        try:
+            found = self.store.link(self.store_key(job), job.path)
+        except OSError as e:
+            logger.warning(f"Failed to link {job.url} from {self.store.root}: {e!r}")
+            return None
+        if found is None:
+            return None
+        size, sha256 = found
+        manifest = self.manifests.get(job.task)
+        if manifest is not None:
+            manifest.mark(job.key, size, sha256)
+        with self.lock:
+            self.from_store += 1
+        return size
+
+    def notify_complete(self, job: DownloadJob, size: int):
+        for callback in self.on_complete:
+            try:
+                callback(job, size)
+            except Exception:
+                logger.exception(f"on_complete callback {callback!r} failed for {job.url}")
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"segment-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, job: DownloadJob):
+        self.submit_many([job])
+
+    def submit_many(self, jobs: Iterable[DownloadJob]):
+        """skip the jobs downloaded before, and queue the rest with their sub-ranges coalesced"""
+        pending = []
+        for job in jobs:
+            size = self.completed_size(job)
+            if size is None and self.store is not None:
+                size = self.link_from_store(job)
+            with self.lock:
+                self.total += 1
+                if size is not None:
+                    self.skipped += 1
+            if self.metrics is not None:
+                self.metrics.submitted(job.task, 1, 0 if size is None else 1)
+            if size is not None:
+                self.notify_complete(job, size)
+            else:
+                pending.append(job)
+        for item in coalesce_jobs(pending):
+            self.scheduler.submit(item)
+
+    def join(self) -> List[Tuple[DownloadJob, Exception]]:
+        """close the scheduler and wait for all workers. Return the failed jobs."""
+        self.scheduler.close()
+        for t in self.threads:
+            t.join()
+        self.threads.clear()
+        return self.failed
+
+    def run(self, jobs: Iterable[DownloadJob]) -> List[Tuple[DownloadJob, Exception]]:
+        self.start()
+        self.submit_many(jobs)
+        return self.join()
+
+    def _worker(self):
+        while True:
+            if self.controller is not None:
+                self.controller.acquire()
+            item = self.scheduler.acquire()
+            if item is None:
+                if self.controller is not None:
+                    self.controller.release()
+                return
+            parts = item.parts if isinstance(item, RangeJob) else [item]
+            start = time.monotonic()
+            size = 0
+            done = 0
+            errors = []
+            on_error = None
+            if self.controller is not None or self.metrics is not None:
+                def on_error(status):
+                    errors.append(status)
+                    if self.controller is not None:
+                        self.controller.record_error(status)
+                    if self.metrics is not None:
+                        self.metrics.failed_attempt(item.host, status)
+            if self.metrics is not None:
+                self.metrics.request_started(item.host)
+            try:
+                if isinstance(item, RangeJob):
+                    results = self.fetch_ranges(item, on_error)
+                else:
+                    results = [(item, *self.fetch(item, on_error))]
+                manifest = self.manifests.get(item.task)
+                for job, job_size, sha256 in results:
+                    size += job_size
+                    if manifest is not None:
+                        manifest.mark(job.key, job_size, sha256)
+                    if self.store is not None:
+                        try:
+                            self.store.put(self.store_key(job), job.path, sha256)
+                        except OSError as e:
+                            logger.warning(f"Failed to store {job.url} in {self.store.root}: {e!r}")
+            except Exception as e:
+                logger.error(f"Failed to download {item.url} ({len(parts)} files): {e!r}")
+                with self.lock:
+                    self.failed.extend((job, e) for job in parts)
+            else:
+                done = len(results)
+                for job, job_size, _ in results:
+                    with self.lock:
+                        self.done += 1
+                        logger.debug(f"[{self.done}/{self.total}] {job.key} -> {job.path}")
+                    self.notify_complete(job, job_size)
+            finally:
+                self.scheduler.release(item)
+                # a fetch that was retried includes backoff sleeps, its latency tells nothing
+                latency = time.monotonic() - start if size and not errors else None
+                if self.metrics is not None:
+                    self.metrics.request_finished(item.host, item.task, done, len(parts) - done, size, latency)
+                if self.controller is not None:
+                    self.controller.release(size, latency)
+
+
+def download_segments(task_dir: Path, cna: CacheNameAssigner, post_steps: Sequence = (), **kwargs):
+    """
+    Download all files of `cna` into `task_dir`.
+    If `post_steps` is given, every downloaded file is also processed by them
+    in a process pool (see postprocess.py), and the results are written to postprocess.jsonl.
+    Files that already have a result there are not processed again
+    """
+    jobs = jobs_from_assigner(task_dir, cna)
+    transform = kwargs.get("transform")
+    if hasattr(transform, "take_key_jobs"):
+        # a decrypter fetches the keys itself, each of them once
+        jobs = transform.take_key_jobs(jobs)
+    logger.info(f"Downloading {len(jobs)} files into {task_dir}")
+    manifest = CompletionManifest(task_dir / "completed.jsonl")
+    post = None
+    if post_steps:
+        from . import postprocess
+
+        post = postprocess.PostProcessor(post_steps)
+        post.add_task("", task_dir / "postprocess.jsonl")
+        kwargs["on_complete"] = [*kwargs.get("on_complete", ()), post.on_complete]
+    downloader = SegmentDownloader(manifest=manifest, **kwargs)
+    try:
+        failed = downloader.run(jobs)
+    finally:
+        manifest.close()
+        if post is not None:
+            post_failed = post.join()
+            post.dump()
+    if post is not None:
+        failed.extend(post_failed)
+    if downloader.skipped:
+        logger.info(
+            f"{downloader.skipped} files were already downloaded, {downloader.from_store} of them linked from the store"
+        )
+    if failed:
+        logger.error(f"{len(failed)} of {len(jobs)} files failed to download")
+    else:
+        logger.info(f"All {len(jobs)} files downloaded")
+    return failed
@@ -0,0 +1,345 @@
+"""
+直播（没有 EXT-X-ENDLIST 的 media playlist）录制
+
+直播的 playlist 是一个滑动窗口：服务器不断在末尾追加新的 segment，同时从开头删掉旧的，
+EXT-X-MEDIA-SEQUENCE 是窗口中第一个 segment 的序号。所以：
+    每隔 EXT-X-TARGETDURATION 秒重新请求一次 playlist（没有变化时隔一半的时间，RFC 8216 6.3.4）
+    序号大于上一次最后一个 segment 的才是新 segment，交给正在运行的 SegmentDownloader
+    CacheNameAssigner 只追加新的 URI，已有的 cache name 不变（min_digits 保证前导零的数量不变）
+    local.m3u8 / fq.m3u8 只追加新 segment 的行，录制结束时写入 EXT-X-ENDLIST
+    EXT-X-BYTERANGE 的每个 sub-range 和点播一样是一个单独的文件（cache 的 key 见 playlist.range_key），
+    local.m3u8 里没有 byte range，fq.m3u8 的 EXT-X-BYTERANGE 总是带上 offset
+
+请求 playlist 时带上一次响应的 ETag / Last-Modified，没有变化的话服务器只返回 304，没有响应体
+
+停止条件：playlist 出现 EXT-X-ENDLIST、录制时长达到 duration、Ctrl-C，
+或者连续 config.m3u8_retry_times 次请求 playlist 失败
+
+task 目录中已经有录制（fq.m3u8 和 cache_assigner.jsonl）时继续这个录制：
+从 journal 恢复 cache name，从 fq.m3u8 恢复最后一个 segment 的序号，新 segment 追加到原来的 playlist 后面，
+上次没有下载完的文件重新提交。中间漏掉的 segment 用 EXT-X-DISCONTINUITY 隔开
+"""
+from . import download_core
+from .playlist import Playlist, CacheNameAssigner, M3U8Line, TagLine, URILine, ByteRange, LINE_KINDS
+from .playlist import BYTERANGE_PREFIX, range_key, render_uri_line
+from .downloader import SegmentDownloader, DownloadJob, jobs_from_assigner
+from .tag import EXT_X_KEY, EXT_X_MAP
+from pathlib import Path
+from typing import List, Optional, Tuple
+import logging
+import time
+import config
+
+logger = logging.getLogger(__name__)
+
+# tags that apply to the whole playlist instead of the segment after them
+PLAYLIST_TAGS = (
+    "#EXTM3U",
+    "#EXT-X-VERSION",
+    "#EXT-X-TARGETDURATION",
+    "#EXT-X-MEDIA-SEQUENCE",
+    "#EXT-X-DISCONTINUITY-SEQUENCE",
+    "#EXT-X-PLAYLIST-TYPE",
+    "#EXT-X-INDEPENDENT-SEGMENTS",
+    "#EXT-X-START",
+    "#EXT-X-ALLOW-CACHE",
+    "#EXT-X-ENDLIST",
+)
+
+
+# (text, line, absolute URI, byte range), as Playlist.scan_uris yields them
+ScannedLine = Tuple[str, Optional[M3U8Line], Optional[str], Optional[ByteRange]]
+
+
+def tag_name(text: str) -> str:
+    return text.split(":", 1)[0]
+
+
+def playlist_tag(playlist: Playlist, prefix: str) -> Optional[str]:
+    """
+    the value of the playlist level tag starting with `prefix`. These tags come before the first segment,
+    the lines are scanned up to there without being turned into M3U8Line objects
+    """
+    for _, kind, text in playlist.lines.scan():
+        if kind is URILine:
+            break
+        if text.startswith(prefix):
+            return text[len(prefix) :]
+    return None
+
+
+def media_sequence(playlist: Playlist) -> int:
+    value = playlist_tag(playlist, "#EXT-X-MEDIA-SEQUENCE:")
+    return 0 if value is None else int(value)
+
+
+def target_duration(playlist: Playlist) -> Optional[float]:
+    value = playlist_tag(playlist, "#EXT-X-TARGETDURATION:")
+    return None if value is None else float(value)
+
+
+def split_segments(playlist: Playlist) -> Tuple[List[str], List[Tuple[int, List[ScannedLine]]]]:
+    """
+    Return (playlist level tags, [(media sequence number, lines of the segment)]).
+    The lines of a segment are the tags between the previous URI and its URI, and the URI itself.
+    """
+    header: List[str] = []
+    segments: List[Tuple[int, List[ScannedLine]]] = []
+    sequence = media_sequence(playlist)
+    pending: List[ScannedLine] = []
+    kinds = playlist.lines.kinds
+    for i, scanned in enumerate(playlist.scan_uris()):
+        kind = LINE_KINDS[kinds[i]]
+        if kind is TagLine and tag_name(scanned[0]) in PLAYLIST_TAGS:
+            header.append(scanned[0])
+        elif kind is URILine:
+            segments.append((sequence, pending + [scanned]))
+            sequence += 1
+            pending = []
+        elif kind is TagLine:
+            pending.append(scanned)
+    return header, segments
+
+
+class LiveRecorder:
+    def __init__(
+        self,
+        task_dir: Path,
+        m3u8_url: str,
+        downloader: SegmentDownloader,
+        cna: CacheNameAssigner = None,
+        task: str = "",
+        decrypter=None,
+        verifier=None,
+        duration: float = None,
+        min_interval: float = 1.0,
+    ) -> None:
+        """
+        `downloader` must be started, the recorder only submits jobs to it.
+        If `decrypter` (decrypt.SegmentDecrypter) is given, EXT-X-KEY is left out of local.m3u8.
+        `verifier` (verify.SegmentVerifier) is the verify hook of `downloader`, it is told about every polled playlist.
+        If `task_dir` has a recording, it is continued (see resume): `cna` must be loaded from its journal,
+        or None to load it here.
+        """
+        self.task_dir = task_dir
+        self.url = m3u8_url
+        self.downloader = downloader
+        self.local_m3u8 = task_dir / "local.m3u8"
+        self.abs_m3u8 = task_dir / "fq.m3u8"
+        self.cna_path = task_dir / "cache_assigner.jsonl"
+        if cna is None:
+            cna = CacheNameAssigner(min_digits=6)
+            if self.cna_path.exists():
+                cna.load_journal(self.cna_path)
+        self.cna = cna
+        self.cna.register_uri(m3u8_url, ext="m3u8")
+        self.task = task
+        self.decrypter = decrypter
+        self.verifier = verifier
+        self.duration = duration
+        self.min_interval = min_interval
+
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.content: Optional[str] = None
+        self.last_sequence: Optional[int] = None
+        self.written_key: Optional[str] = None
+        self.written_map: Optional[str] = None
+        self.ended = False
+        self.written = False
+        self.segments = 0
+        self.polls = 0
+        self.not_modified = 0
+        if self.abs_m3u8.exists() and self.local_m3u8.exists() and self.cna_path.exists():
+            self.resume()
+
+    def resume(self):
+        """continue the recording of an earlier run"""
+        for path in (self.local_m3u8, self.abs_m3u8):
+            lines = path.read_text("utf8").splitlines()
+            # written by finish()
+            while lines and lines[-1] in ("#EXT-X-ENDLIST", ""):
+                lines.pop()
+            path.write_text("".join(line + "\n" for line in lines), encoding="utf8")
+        recorded = Playlist(self.url, self.abs_m3u8.read_text("utf8"))
+        # the unfinished segments of the recording are decrypted and verified as they were listed
+        if self.decrypter is not None:
+            self.decrypter.add_playlist(recorded)
+        if self.verifier is not None:
+            self.verifier.add_playlist(recorded)
+        _, segments = split_segments(recorded)
+        if segments:
+            self.last_sequence = segments[-1][0]
+        self.segments = len(segments)
+        self.written = True
+        jobs = jobs_from_assigner(self.task_dir, self.cna, task=self.task)
+        if self.decrypter is not None:
+            jobs = self.decrypter.take_key_jobs(jobs)
+        # the downloader skips the finished ones
+        self.downloader.submit_many(jobs)
+        logger.info(f"Continue the recording in {self.task_dir}: {self.segments} segments, last sequence {self.last_sequence}")
+
+    def poll(self) -> Optional[Playlist]:
+        """Download the playlist again. Return None if it has not changed."""
+        self.polls += 1
+        with download_core.download_if_modified(
+            self.url, download_core.headers, config.m3u8_timeout, config.m3u8_retry_times,
+            etag=self.etag, last_modified=self.last_modified,
+        ) as resp:
+            if resp.status_code == 304:
+                self.not_modified += 1
+                return None
+            self.etag = resp.headers.get("ETag")
+            self.last_modified = resp.headers.get("Last-Modified")
+            content = resp.content.decode("utf8")
+        # servers without validators send the same playlist again
+        if content == self.content:
+            return None
+        self.content = content
+        return Playlist(self.url, content)
+
+    def update(self, playlist: Playlist) -> int:
+        """Append the new segments of `playlist`. Return how many there are."""
+        self.content = playlist.content
+        header, segments = split_segments(playlist)
+        new = [(seq, lines) for seq, lines in segments if self.last_sequence is None or seq > self.last_sequence]
+        gap = new and self.last_sequence is not None and new[0][0] > self.last_sequence + 1
+        if gap:
+            logger.warning(
+                f"segments {self.last_sequence + 1} ~ {new[0][0] - 1} left the playlist before they were polled"
+            )
+        if self.decrypter is not None:
+            self.decrypter.add_playlist(playlist)
+        if self.verifier is not None:
+            self.verifier.add_playlist(playlist)
+
+        local_lines: List[str] = []
+        abs_lines: List[str] = []
+        if not self.written:
+            first = new[0][0] if new else media_sequence(playlist)
+            for text in header:
+                if tag_name(text) == "#EXT-X-MEDIA-SEQUENCE":
+                    text = f"#EXT-X-MEDIA-SEQUENCE:{first}"
+                elif tag_name(text) in ("#EXT-X-ENDLIST", "#EXT-X-PLAYLIST-TYPE"):
+                    continue
+                local_lines.append(text)
+                abs_lines.append(text)
+
+        if gap:
+            local_lines.append("#EXT-X-DISCONTINUITY")
+            abs_lines.append("#EXT-X-DISCONTINUITY")
+
+        # EXT-X-KEY and EXT-X-MAP apply until the next one, which may be long before the new segments
+        key: Optional[ScannedLine] = None
+        map_: Optional[ScannedLine] = None
+        new_sequences = {seq for seq, _ in new}
+        for seq, lines in segments:
+            segment_lines = []
+            for scanned in lines:
+                if scanned[0].startswith(EXT_X_KEY.prefix):
+                    key = scanned
+                elif scanned[0].startswith(EXT_X_MAP.prefix):
+                    map_ = scanned
+                else:
+                    segment_lines.append(scanned)
+            if seq not in new_sequences:
+                continue
+            if key is not None and key[0] != self.written_key:
+                self.written_key = key[0]
+                self.append_line(key, local_lines, abs_lines, local=self.decrypter is None)
+            if map_ is not None and map_[0] != self.written_map:
+                self.written_map = map_[0]
+                self.append_line(map_, local_lines, abs_lines)
+            for scanned in segment_lines:
+                self.append_line(scanned, local_lines, abs_lines)
+
+        if playlist.has_endlist():
+            self.ended = True
+        if new:
+            self.last_sequence = new[-1][0]
+            self.segments += len(new)
+        self.write(local_lines, abs_lines)
+        return len(new)
+
+    def append_line(self, scanned: ScannedLine, local_lines, abs_lines, local: bool = True):
+        """
+        register the URI of a line (submitting it if it is new) and append the line to both playlists.
+        Every sub-range (EXT-X-BYTERANGE) is a file of its own, as in the playlists of download_segments:
+        local.m3u8 leaves the byte ranges out, fq.m3u8 writes them with their offsets
+        """
+        text, line, fq_uri, byterange = scanned
+        if text.startswith(BYTERANGE_PREFIX):
+            # written before its URI, once the offset is known
+            return
+        if fq_uri is None:
+            if local:
+                local_lines.append(text)
+            abs_lines.append(text)
+            return
+        is_new = range_key(fq_uri, byterange) not in self.cna.url2cache
+        cache = self.cna.register_uri(fq_uri, byterange=byterange)
+        cache_name = self.cna.cache_name(fq_uri, byterange)
+        if is_new:
+            jobs = [DownloadJob(cache, self.task_dir / cache_name, self.task)]
+            if self.decrypter is not None:
+                jobs = self.decrypter.take_key_jobs(jobs)
+            for job in jobs:
+                self.downloader.submit(job)
+        if byterange is not None and isinstance(line, URILine):
+            offset, length = byterange
+            abs_lines.append(f"{BYTERANGE_PREFIX}{length}@{offset}")
+        abs_lines.append(line.render_with_uri(fq_uri))
+        if local:
+            local_lines.append(render_uri_line(line, fq_uri, byterange, self.cna.cache_name, True))
+
+    def write(self, local_lines: List[str], abs_lines: List[str]):
+        mode = "a" if self.written else "w"
+        for path, lines in ((self.local_m3u8, local_lines), (self.abs_m3u8, abs_lines)):
+            with path.open(mode, encoding="utf8") as f:
+                f.write("".join(line + "\n" for line in lines))
+        self.written = True
+        # only the URIs of this poll are appended
+        self.cna.save_journal(self.cna_path)
+
+    def finish(self):
+        for path in (self.local_m3u8, self.abs_m3u8):
+            with path.open("a", encoding="utf8") as f:
+                f.write("#EXT-X-ENDLIST\n")
+
+    def run(self) -> int:
+        """Poll until the stream ends. Return the number of recorded segments."""
+        start = time.monotonic()
+        failures = 0
+        interval = self.min_interval
+        try:
+            while True:
+                try:
+                    playlist = self.poll()
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    logger.error(f"Failed to poll {self.url} ({failures} times in a row): {e!r}")
+                    if failures >= config.m3u8_retry_times:
+                        break
+                    playlist = None
+                if playlist is not None:
+                    n = self.update(playlist)
+                    interval = max(target_duration(playlist) or interval, self.min_interval)
+                    logger.info(f"{n} new segments, {self.segments} recorded, last sequence {self.last_sequence}")
+                    wait = interval
+                else:
+                    wait = max(interval / 2, self.min_interval)
+                if self.ended:
+                    logger.info(f"{self.url} has ended")
+                    break
+                if self.duration is not None and time.monotonic() - start + wait > self.duration:
+                    logger.info(f"Recorded for {self.duration} seconds")
+                    break
+                time.sleep(wait)
+        except KeyboardInterrupt:
+            logger.info("Recording interrupted")
+        finally:
+            if self.written:
+                self.finish()
+        logger.info(f"{self.polls} polls, {self.not_modified} were not modified")
+        return self.segments
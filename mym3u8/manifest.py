@@ -0,0 +1,70 @@
+"""
+每个 task 的下载完成清单
+
+每下载完一个文件，就往 completed.jsonl 追加一行 {"url": ..., "size": ...}，
+校验过的（见 verify.py）还有 "sha256"
+重启 task 时读取这个清单，清单中的文件只要还在、大小没变就跳过，不需要再逐个 hash；
+被删除或大小变了的文件重新下载，新的一行覆盖旧的
+最后一行可能因为进程被杀而只写了一半，读取时忽略它
+"""
+from pathlib import Path
+from typing import Dict, Optional, TextIO
+import threading
+import logging
+import json
+
+logger = logging.getLogger(__name__)
+
+
+class CompletionManifest:
+    def __init__(self, file: Path) -> None:
+        self.file = file
+        self.completed: Dict[str, int] = dict()
+        self.sha256: Dict[str, str] = dict()
+        self.lock = threading.Lock()
+        self.fp: Optional[TextIO] = None
+        self.broken_tail = False
+        if file.exists():
+            self.load()
+
+    def load(self):
+        content = self.file.read_text(encoding="utf8")
+        self.broken_tail = len(content) > 0 and not content.endswith("\n")
+        for line in content.splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Ignore broken line in {self.file}: {line!r}")
+                continue
+            self.completed[record["url"]] = record["size"]
+            if "sha256" in record:
+                self.sha256[record["url"]] = record["sha256"]
+
+    def __contains__(self, url: str):
+        return url in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def mark(self, url: str, size: int, sha256: str = None):
+        with self.lock:
+            if self.fp is None:
+                self.file.parent.mkdir(parents=True, exist_ok=True)
+                self.fp = self.file.open("a", encoding="utf8")
+                if self.broken_tail:
+                    self.fp.write("\n")
+                    self.broken_tail = False
+            record = {"url": url, "size": size}
+            if sha256 is not None:
+                record["sha256"] = sha256
+            self.fp.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.fp.flush()
+            self.completed[url] = size
+            if sha256 is not None:
+                self.sha256[url] = sha256
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
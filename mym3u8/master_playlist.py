@@ -1,17 +1,187 @@
 from dataclasses import dataclass
-from . import playlist, media_playlist
-from .playlist import CacheNameAssigner, Playlist, URILine
-from urllib.parse import urljoin
+from . import playlist, media_playlist, download_core
+from .playlist import CacheNameAssigner, Playlist, TagLine, URILine, resolve_uri
+from .tag import EXT_X_MEDIA, EXT_X_STREAM_INF, resolution
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable, List, Optional, Tuple, Union
 import logging
 import copy
+import time
+import config
 
 logger = logging.getLogger(__name__)
 
 
 @dataclass
 class VariantStream:
-    pass
+    """an EXT-X-STREAM-INF and the URI of its media playlist"""
+
+    index: int
+    uri: str
+    bandwidth: Optional[int] = None
+    average_bandwidth: Optional[int] = None
+    resolution: Optional[Tuple[int, int]] = None
+    codecs: Optional[str] = None
+    frame_rate: Optional[float] = None
+    audio: Optional[str] = None
+    video: Optional[str] = None
+    subtitles: Optional[str] = None
+    # bits per second, filled by probe()
+    measured_bandwidth: Optional[float] = None
+
+    @classmethod
+    def from_tag(cls, index: int, tag: EXT_X_STREAM_INF, uri: str) -> "VariantStream":
+        return cls(
+            index,
+            uri,
+            bandwidth=tag.get_int("BANDWIDTH"),
+            average_bandwidth=tag.get_int("AVERAGE-BANDWIDTH"),
+            resolution=tag.get_resolution("RESOLUTION"),
+            codecs=tag.get_str("CODECS"),
+            frame_rate=tag.get_float("FRAME-RATE"),
+            audio=tag.get_str("AUDIO"),
+            video=tag.get_str("VIDEO"),
+            subtitles=tag.get_str("SUBTITLES"),
+        )
+
+    @property
+    def pixels(self) -> Optional[int]:
+        return self.resolution[0] * self.resolution[1] if self.resolution else None
+
+
+@dataclass
+class Rendition:
+    """an EXT-X-MEDIA with a URI: an alternative audio, video or subtitles media playlist"""
+
+    type: str
+    group_id: str
+    uri: str
+    name: Optional[str] = None
+    language: Optional[str] = None
+    default: bool = False
+
+    @classmethod
+    def from_tag(cls, tag: EXT_X_MEDIA, uri: str) -> "Rendition":
+        return cls(
+            tag.get("TYPE"),
+            tag.get_str("GROUP-ID"),
+            uri,
+            name=tag.get_str("NAME"),
+            language=tag.get_str("LANGUAGE"),
+            default=tag.get("DEFAULT") == "YES",
+        )
+
+
+Policy = Callable[[List[VariantStream]], VariantStream]
+
+
+def highest_bandwidth(variants: List[VariantStream]) -> VariantStream:
+    return max(variants, key=lambda v: v.bandwidth or 0)
+
+
+def lowest_bandwidth(variants: List[VariantStream]) -> VariantStream:
+    return min(variants, key=lambda v: v.bandwidth or 0)
+
+
+def closest_resolution(width: int, height: int) -> Policy:
+    """the variant whose pixel count is the closest to WIDTHxHEIGHT, the higher bandwidth on a tie"""
+    target = width * height
+
+    def policy(variants: List[VariantStream]) -> VariantStream:
+        with_resolution = [v for v in variants if v.pixels is not None]
+        if not with_resolution:
+            return highest_bandwidth(variants)
+        return min(with_resolution, key=lambda v: (abs(v.pixels - target), -(v.bandwidth or 0)))
+
+    return policy
+
+
+def max_bandwidth_under(cap: int) -> Policy:
+    """the highest BANDWIDTH not above `cap`, or the lowest one if all of them are"""
+
+    def policy(variants: List[VariantStream]) -> VariantStream:
+        fitting = [v for v in variants if v.bandwidth is not None and v.bandwidth <= cap]
+        return highest_bandwidth(fitting) if fitting else lowest_bandwidth(variants)
+
+    return policy
+
+
+def fastest_sustainable(margin: float = 0.8) -> Policy:
+    """
+    the highest BANDWIDTH below `margin` times the throughput measured by probe().
+    Variants that were not probed are ignored.
+    """
+
+    def policy(variants: List[VariantStream]) -> VariantStream:
+        probed = [v for v in variants if v.measured_bandwidth is not None]
+        if not probed:
+            logger.warning("No variant was probed successfully, select the lowest bandwidth")
+            return lowest_bandwidth(variants)
+        fitting = [v for v in probed if (v.bandwidth or 0) <= v.measured_bandwidth * margin]
+        return highest_bandwidth(fitting) if fitting else lowest_bandwidth(probed)
+
+    return policy
+
+
+def parse_policy(spec: str) -> Tuple[Policy, bool]:
+    """
+    Return (policy, whether the variants need to be probed first) of a policy spec:
+        highest, lowest, resolution=1280x720, max-bandwidth=3000000, fastest
+    """
+    name, _, arg = spec.partition("=")
+    if name == "highest":
+        return highest_bandwidth, False
+    if name == "lowest":
+        return lowest_bandwidth, False
+    if name == "resolution":
+        return closest_resolution(*resolution(arg)), False
+    if name == "max-bandwidth":
+        return max_bandwidth_under(int(arg)), False
+    if name == "fastest":
+        return fastest_sustainable(float(arg) if arg else 0.8), True
+    raise ValueError(f"Unknown variant policy {spec!r}")
+
+
+def fetch_playlists(urls: List[str], workers: int = None) -> List[Playlist]:
+    """download playlists concurrently, in the order of `urls`"""
+    if len(urls) <= 1:
+        return [Playlist(url) for url in urls]
+    with ThreadPoolExecutor(workers or config.playlist_workers) as executor:
+        return list(executor.map(Playlist, urls))
+
+
+def probe_variant(variant: VariantStream, probe_bytes: int) -> Optional[float]:
+    """download the start of the first segment of `variant`, return the throughput in bits per second"""
+    playlist = Playlist(variant.uri)
+    first = next(
+        (resolve_uri(playlist.url, text) for _, kind, text in playlist.lines.scan() if kind is URILine),
+        None,
+    )
+    if first is None:
+        return None
+    headers = dict(download_core.headers or {})
+    headers["Range"] = f"bytes=0-{probe_bytes - 1}"
+    start = time.monotonic()
+    resp = download_core.download(first, headers, config.segment_timeout, 1)
+    elapsed = time.monotonic() - start
+    return len(resp.content) * 8 / elapsed
+
+
+def probe(variants: List[VariantStream], workers: int = None, probe_bytes: int = 256 * 1024):
+    """Measure the throughput of every variant concurrently, into VariantStream.measured_bandwidth."""
+    with ThreadPoolExecutor(workers or len(variants) or 1) as executor:
+        futures = {executor.submit(probe_variant, v, probe_bytes): v for v in variants}
+        for future, variant in futures.items():
+            try:
+                variant.measured_bandwidth = future.result()
+            except Exception as e:
+                logger.warning(f"Failed to probe variant [{variant.index}] {variant.uri}: {e!r}")
+                continue
+            if variant.measured_bandwidth is not None:
+                logger.info(
+                    f"[{variant.index}] declared {variant.bandwidth} bps, measured {variant.measured_bandwidth:.0f} bps"
+                )
 
 
 @dataclass
@@ -19,11 +189,77 @@ class MasterPlaylist:
     def __init__(self, playlist: Playlist):
         self.playlist = playlist
 
-    def select_playlist(self):
+    def variants(self) -> List[VariantStream]:
+        variants = []
+        stream_inf: Optional[EXT_X_STREAM_INF] = None
+        lines = self.playlist.lines
+        for i, kind, text in lines.scan():
+            if kind is TagLine and text.startswith(EXT_X_STREAM_INF.prefix):
+                stream_inf = lines[i].tag
+            elif kind is URILine and stream_inf is not None:
+                uri = resolve_uri(self.playlist.url, text)
+                variants.append(VariantStream.from_tag(len(variants), stream_inf, uri))
+                stream_inf = None
+        return variants
+
+    def renditions(self, variant_uri: str) -> List[Rendition]:
+        """the renditions with a URI in the AUDIO, VIDEO and SUBTITLES groups of the variant at `variant_uri`"""
+        variant = next((v for v in self.variants() if v.uri == variant_uri), None)
+        if variant is None:
+            return []
+        groups = {
+            (media_type, group_id)
+            for media_type, group_id in (
+                ("AUDIO", variant.audio), ("VIDEO", variant.video), ("SUBTITLES", variant.subtitles)
+            )
+            if group_id is not None
+        }
+        renditions = []
+        lines = self.playlist.lines
+        for i, kind, text in lines.scan():
+            if kind is TagLine and text.startswith(EXT_X_MEDIA.prefix):
+                tag = lines[i].tag
+                uri = tag.get_str("URI")
+                if uri is not None and (tag.get("TYPE"), tag.get_str("GROUP-ID")) in groups:
+                    renditions.append(Rendition.from_tag(tag, resolve_uri(self.playlist.url, uri)))
+        return renditions
+
+    def select_variant(self, policy: Policy, probe_first: bool = False) -> VariantStream:
+        variants = self.variants()
+        if not variants:
+            raise ValueError(f"{self.playlist!r} has no EXT-X-STREAM-INF")
+        if probe_first:
+            probe(variants)
+        variant = policy(variants)
+        logger.info(f"Select {variant}")
+        return variant
+
+    def select_playlist(self, choice: Union[int, str, Policy, None] = None):
+        """
+        Ask the user to choose a media playlist.
+        If `choice` is given, select one without asking:
+            int       the `choice`-th media playlist
+            str       a policy spec, see parse_policy
+            callable  a policy
+        """
+        if isinstance(choice, str):
+            policy, probe_first = parse_policy(choice)
+            return self.select_variant(policy, probe_first).uri
+        if callable(choice):
+            return self.select_variant(choice).uri
+        if choice is not None:
+            m3u8_urls = [
+                resolve_uri(self.playlist.url, line.line_text)
+                for line in self.playlist.lines
+                if isinstance(line, URILine)
+            ]
+            logger.info(f"Select [{choice}] {m3u8_urls[choice]}")
+            return m3u8_urls[choice]
+
         m3u8_urls = []
         for line in self.playlist.lines:
             if isinstance(line, URILine):
-                abs_line = urljoin(self.playlist.url, line.line_text)
+                abs_line = resolve_uri(self.playlist.url, line.line_text)
                 print(f"[{len(m3u8_urls)}] {abs_line}")
                 m3u8_urls.append(abs_line)
             else:
@@ -0,0 +1,148 @@
+"""
+把 segment 按 playlist 顺序拼接成一个文件
+
+拷贝由内核完成（os.copy_file_range，不支持时用 os.sendfile），数据不经过用户态；
+两者都不可用时才退回普通的 read/write
+
+Merger 接在 SegmentDownloader.on_complete 上，不需要等全部下载完：
+只要从头开始连续的若干个 segment 都已完成，就立刻把它们追加到输出文件，
+拷贝在 Merger 自己的线程中进行，不占用下载线程
+
+先写入 <output>.part，所有 segment 都追加完才改名为 output，
+中途失败（例如 segment 缺失）时已有的 output 保持不变
+
+EXT-X-MAP 指定的初始化片段（fMP4）在它之后的 segment 之前写入，变化时再写一次
+"""
+from .playlist import Playlist, CacheNameAssigner, TagLine, URILine, range_key
+from .tag import EXT_X_MAP
+from pathlib import Path
+from typing import Dict, List, Optional
+import threading
+import logging
+import errno
+import os
+
+logger = logging.getLogger(__name__)
+
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+
+def segment_paths(task_dir: Path, playlist: Playlist, cna: CacheNameAssigner) -> List[Path]:
+    """local files of a media playlist in play order, including EXT-X-MAP init sections"""
+    paths = []
+    last_map = None
+    for text, line, fq_uri, byterange in playlist.scan_uris():
+        if isinstance(line, TagLine) and text.startswith(EXT_X_MAP.prefix):
+            map_key = range_key(fq_uri, byterange)
+            if map_key == last_map:
+                continue
+            last_map = map_key
+            paths.append(task_dir / cna.cache_name(fq_uri, byterange))
+        elif isinstance(line, URILine):
+            paths.append(task_dir / cna.cache_name(fq_uri, byterange))
+    return paths
+
+
+def copy_file_range(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    return os.copy_file_range(src_fd, dst_fd, count, offset)
+
+
+def sendfile(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def read_write(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    data = os.pread(src_fd, min(count, 1024 * 1024), offset)
+    return os.write(dst_fd, data)
+
+
+class Merger:
+    def __init__(self, output: Path, paths: List[Path]) -> None:
+        self.output = output
+        self.part = output.with_name(output.name + ".part")
+        self.paths = paths
+        self.positions: Dict[Path, List[int]] = dict()
+        for i, path in enumerate(paths):
+            self.positions.setdefault(path, []).append(i)
+        self.ready = [False] * len(paths)
+        self.merged = 0
+        self.copiers = [
+            f for f, name in ((copy_file_range, "copy_file_range"), (sendfile, "sendfile"))
+            if hasattr(os, name)
+        ] + [read_write]
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+        self.error: Optional[Exception] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="merger", daemon=True)
+        self.thread.start()
+        return self
+
+    def mark_ready(self, path: Path):
+        with self.cond:
+            for i in self.positions.get(path, ()):
+                self.ready[i] = True
+            self.cond.notify()
+
+    def on_complete(self, job, size: int):
+        """SegmentDownloader callback"""
+        self.mark_ready(job.path)
+
+    def close(self) -> bool:
+        """wait for the merge thread. Return True if every segment was merged."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+        if self.merged < len(self.paths) or self.error is not None:
+            logger.error(
+                f"Only {self.merged} of {len(self.paths)} segments were merged, {self.output} is left as it was"
+            )
+            self.part.unlink(missing_ok=True)
+            return False
+        os.replace(self.part, self.output)
+        logger.info(f"{len(self.paths)} segments merged into {self.output}")
+        return True
+
+    def _run(self):
+        try:
+            with self.part.open("wb") as out:
+                while True:
+                    with self.cond:
+                        while not self.closed and not self._prefix_ready():
+                            self.cond.wait()
+                        end = self.merged
+                        while end < len(self.paths) and self.ready[end]:
+                            end += 1
+                        if end == self.merged:
+                            return
+                    for i in range(self.merged, end):
+                        self.append(self.paths[i], out.fileno())
+                        self.merged = i + 1
+        except Exception as e:
+            logger.exception(f"Failed to merge into {self.part}")
+            self.error = e
+
+    def _prefix_ready(self) -> bool:
+        return self.merged < len(self.paths) and self.ready[self.merged]
+
+    def append(self, path: Path, dst_fd: int):
+        with path.open("rb") as f:
+            src_fd = f.fileno()
+            size = os.fstat(src_fd).st_size
+            offset = 0
+            while offset < size:
+                try:
+                    n = self.copiers[0](src_fd, dst_fd, offset, size - offset)
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED or len(self.copiers) == 1:
+                        raise
+                    logger.debug(f"{self.copiers[0].__name__} is not supported here: {e!r}")
+                    self.copiers.pop(0)
+                    continue
+                if n == 0:
+                    raise IOError(f"{path} is shorter than {size} bytes")
+                offset += n
@@ -0,0 +1,316 @@
+"""
+下载过程的指标
+
+DownloadMetrics 由 SegmentDownloader 在下载过程中更新（线程安全），snapshot() 返回某一时刻的所有指标：
+    bytes / bytes_per_s   已下载的字节数，最近 window 秒的下载速度
+    segments              total / done / skipped / failed / remaining，tasks 中是每个 task 各自的
+    in_flight             正在下载的请求数（合并的 sub-range 算一个）
+    retries               失败的尝试次数，按 HTTP 状态码（连接错误、超时为 "error"，校验失败不计入）
+    hosts                 每个 host 的请求数、字节数、失败次数、在途请求数和下载耗时的直方图
+    eta_s                 剩余文件数 × 已完成文件的平均大小 ÷ 最近的速度，无法估计时为 None
+    concurrency           AIMDController（见 adaptive.py）的 snapshot：window、in_flight、mb_per_s、latency、base_latency，
+                          没有用 AIMDController 时为 None
+
+下载耗时是一个请求从开始到文件写完的时间，重试过的请求包含了退避的等待时间，不计入直方图
+
+导出（都是可选的）：
+    MetricsReporter  每隔 interval 秒把 snapshot 追加到 JSON lines 文件，
+                     或者原子地改写 Prometheus 文本文件（node_exporter 的 textfile collector 可以直接读取）
+    serve            HTTP 服务：/metrics 是 Prometheus 文本，/metrics.json 是 snapshot
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
+import threading
+import logging
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# upper bounds (seconds) of the latency histogram buckets, +Inf is implied
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self) -> dict:
+        """cumulative counts by upper bound, as Prometheus has them"""
+        buckets = []
+        total = 0
+        for bound, n in zip((*self.bounds, "+Inf"), self.counts):
+            total += n
+            buckets.append([bound, total])
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+class HostMetrics:
+    __slots__ = ("requests", "bytes", "failed_attempts", "in_flight", "latency")
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.bytes = 0
+        self.failed_attempts = 0
+        self.in_flight = 0
+        self.latency = Histogram()
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "bytes": self.bytes,
+            "retries": self.failed_attempts,
+            "in_flight": self.in_flight,
+            "latency": self.latency.to_dict(),
+        }
+
+
+class TaskMetrics:
+    __slots__ = ("total", "done", "skipped", "failed")
+
+    def __init__(self) -> None:
+        self.total = 0
+        self.done = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def to_dict(self) -> dict:
+        return {"total": self.total, "done": self.done, "skipped": self.skipped, "failed": self.failed}
+
+
+class DownloadMetrics:
+    def __init__(self, window: float = 10.0) -> None:
+        """`window`: bytes_per_s is the average speed of (about) the last `window` seconds"""
+        self.window = window
+        self.start = time.monotonic()
+        self.bytes = 0
+        self.in_flight = 0
+        self.retries: Dict[str, int] = defaultdict(int)
+        self.hosts: Dict[str, HostMetrics] = defaultdict(HostMetrics)
+        self.tasks: Dict[str, TaskMetrics] = defaultdict(TaskMetrics)
+        # (time, self.bytes) after every finished request, back to the last one before the window
+        self.samples: Deque[Tuple[float, int]] = deque([(self.start, 0)])
+        # the AIMDController of the downloader, set by SegmentDownloader
+        self.controller = None
+        self.lock = threading.Lock()
+
+    def submitted(self, task: str, total: int, skipped: int):
+        with self.lock:
+            metrics = self.tasks[task]
+            metrics.total += total
+            metrics.skipped += skipped
+
+    def request_started(self, host: str):
+        with self.lock:
+            self.in_flight += 1
+            self.hosts[host].in_flight += 1
+            self.hosts[host].requests += 1
+
+    def failed_attempt(self, host: str, status: Optional[int]):
+        with self.lock:
+            self.retries["error" if status is None else str(status)] += 1
+            self.hosts[host].failed_attempts += 1
+
+    def request_finished(self, host: str, task: str, done: int, failed: int, nbytes: int, latency: Optional[float]):
+        """`latency` is None if the request was retried (or failed)"""
+        now = time.monotonic()
+        with self.lock:
+            self.in_flight -= 1
+            host_metrics = self.hosts[host]
+            host_metrics.in_flight -= 1
+            host_metrics.bytes += nbytes
+            if latency is not None:
+                host_metrics.latency.observe(latency)
+            self.tasks[task].done += done
+            self.tasks[task].failed += failed
+            self.bytes += nbytes
+            self.samples.append((now, self.bytes))
+            self._prune(now)
+
+    def _prune(self, now: float):
+        # keep one sample at or before the window start, so the rate covers the whole window
+        while len(self.samples) > 1 and self.samples[1][0] <= now - self.window:
+            self.samples.popleft()
+
+    def bytes_per_s(self, now: float) -> float:
+        self._prune(now)
+        t, nbytes = self.samples[0]
+        if now - t <= 0:
+            return 0.0
+        return (self.bytes - nbytes) / (now - t)
+
+    def snapshot(self) -> dict:
+        concurrency = self.controller.snapshot() if self.controller is not None else None
+        now = time.monotonic()
+        with self.lock:
+            rate = self.bytes_per_s(now)
+            total = sum(t.total for t in self.tasks.values())
+            done = sum(t.done for t in self.tasks.values())
+            skipped = sum(t.skipped for t in self.tasks.values())
+            failed = sum(t.failed for t in self.tasks.values())
+            remaining = total - done - skipped - failed
+            eta = None
+            if remaining == 0:
+                eta = 0.0
+            elif done and rate > 0:
+                eta = remaining * (self.bytes / done) / rate
+            return {
+                "time": time.time(),
+                "elapsed_s": now - self.start,
+                "bytes": self.bytes,
+                "bytes_per_s": rate,
+                "segments": {
+                    "total": total,
+                    "done": done,
+                    "skipped": skipped,
+                    "failed": failed,
+                    "remaining": remaining,
+                },
+                "in_flight": self.in_flight,
+                "retries": dict(self.retries),
+                "eta_s": eta,
+                "concurrency": concurrency,
+                "tasks": {task: metrics.to_dict() for task, metrics in self.tasks.items()},
+                "hosts": {host: metrics.to_dict() for host, metrics in self.hosts.items()},
+            }
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(snapshot: dict, prefix: str = "mym3u8") -> str:
+    """the snapshot in the Prometheus text exposition format"""
+    lines: List[str] = []
+
+    def metric(name: str, kind: str, help_text: str, samples):
+        lines.append(f"# HELP {prefix}_{name} {help_text}")
+        lines.append(f"# TYPE {prefix}_{name} {kind}")
+        for suffix, labels, value in samples:
+            label_text = ",".join(f'{k}="{escape_label(str(v))}"' for k, v in labels.items())
+            lines.append(f"{prefix}_{name}{suffix}{{{label_text}}} {value}" if label_text else f"{prefix}_{name}{suffix} {value}")
+
+    metric("bytes_total", "counter", "Bytes downloaded", [("", {}, snapshot["bytes"])])
+    metric("bytes_per_second", "gauge", "Download speed of the last seconds", [("", {}, snapshot["bytes_per_s"])])
+    metric("in_flight_requests", "gauge", "Requests being downloaded", [("", {}, snapshot["in_flight"])])
+    if snapshot["eta_s"] is not None:
+        metric("eta_seconds", "gauge", "Estimated time until all files are downloaded", [("", {}, snapshot["eta_s"])])
+    concurrency = snapshot.get("concurrency")
+    if concurrency is not None:
+        metric("concurrency_window", "gauge", "Concurrent requests allowed by the AIMD controller", [("", {}, concurrency["window"])])
+        if concurrency["latency"] is not None:
+            metric("concurrency_latency_seconds", "gauge", "Median latency of the last controller sample", [("", {}, concurrency["latency"])])
+        if concurrency["base_latency"] is not None:
+            metric("concurrency_base_latency_seconds", "gauge", "Lowest median latency of the controller samples", [("", {}, concurrency["base_latency"])])
+    metric(
+        "segments", "gauge", "Files by state",
+        [("", {"task": task, "state": state}, n)
+         for task, counts in snapshot["tasks"].items() for state, n in counts.items()],
+    )
+    metric(
+        "retries_total", "counter", "Failed attempts by HTTP status (error: connection or timeout)",
+        [("", {"status": status}, n) for status, n in snapshot["retries"].items()],
+    )
+    hosts = snapshot["hosts"].items()
+    metric("host_requests_total", "counter", "Requests by host", [("", {"host": h}, m["requests"]) for h, m in hosts])
+    metric("host_bytes_total", "counter", "Bytes by host", [("", {"host": h}, m["bytes"]) for h, m in hosts])
+    metric("host_retries_total", "counter", "Failed attempts by host", [("", {"host": h}, m["retries"]) for h, m in hosts])
+    metric("host_in_flight_requests", "gauge", "Requests being downloaded by host", [("", {"host": h}, m["in_flight"]) for h, m in hosts])
+    samples = []
+    for host, m in hosts:
+        latency = m["latency"]
+        samples.extend(("_bucket", {"host": host, "le": bound}, n) for bound, n in latency["buckets"])
+        samples.append(("_sum", {"host": host}, latency["sum"]))
+        samples.append(("_count", {"host": host}, latency["count"]))
+    metric("fetch_seconds", "histogram", "Time to download a file (or coalesced sub-ranges) without retries", samples)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsReporter:
+    """write a snapshot every `interval` seconds, and a last one on close"""
+
+    def __init__(self, metrics: DownloadMetrics, path: Path, interval: float = 5.0, format: str = None) -> None:
+        """`format` is "jsonl" or "prometheus", by default "jsonl" if `path` ends with .jsonl"""
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.format = format or ("jsonl" if path.suffix == ".jsonl" else "prometheus")
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        self.thread.start()
+        return self
+
+    def write(self):
+        snapshot = self.metrics.snapshot()
+        if self.format == "jsonl":
+            with self.path.open("a", encoding="utf8") as f:
+                f.write(json.dumps(snapshot, ensure_ascii=False) + "\n")
+        else:
+            # readers must never see a half written file
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            tmp.write_text(prometheus_text(snapshot), encoding="utf8")
+            os.replace(tmp, self.path)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logger.warning(f"Failed to write metrics to {self.path}: {e!r}")
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.write()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        snapshot = self.server.metrics.snapshot()
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            body, content_type = prometheus_text(snapshot), "text/plain; version=0.0.4"
+        elif path == "/metrics.json":
+            body, content_type = json.dumps(snapshot, ensure_ascii=False), "application/json"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(metrics: DownloadMetrics, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """serve /metrics and /metrics.json in a daemon thread. Call shutdown() on the result to stop"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
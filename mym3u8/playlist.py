@@ -30,21 +30,62 @@ M3U8Line
 每个 M3U8 文件都应该纳入 CacheNameAssigner 中，所以CNA应该放到 Playlist 之外，之后统一由下载器下载
 """
 
-from .tag import TagManager, TagWithAttrList
+from .tag import Tag, TagManager, TagWithAttrList, EXT_X_MAP
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, Iterator, Callable
+from collections.abc import Sequence
+from array import array
 from io import StringIO
 import urllib.parse
 from collections import defaultdict
+import functools
 import math
-import copy
+import os
 import logging
 import json
 
 logger = logging.getLogger(__name__)
 
 
+# distinct (base, uri) pairs kept by resolve_uri, and urls kept by parse_url
+URI_CACHE_SIZE = 1 << 16
+
+
+@functools.lru_cache(maxsize=URI_CACHE_SIZE)
+def resolve_uri(base: str, uri: str) -> str:
+    """
+    urllib.parse.urljoin, memoized. The same relative URI is resolved against the same playlist url
+    by rendering, cache name assignment, decryption and merging, every time.
+    resolve_uri.cache_info() has the hit/miss counters.
+    """
+    return urllib.parse.urljoin(base, uri)
+
+
+@functools.lru_cache(maxsize=URI_CACHE_SIZE)
+def parse_url(url: str) -> urllib.parse.ParseResult:
+    return urllib.parse.urlparse(url)
+
+
+# (offset, length) of a sub-range (EXT-X-BYTERANGE, or the BYTERANGE attribute of EXT-X-MAP)
+ByteRange = Tuple[int, int]
+BYTERANGE_PREFIX = "#EXT-X-BYTERANGE:"
+
+
+def parse_byterange(spec: str, default_offset: int) -> ByteRange:
+    """<n>[@<o>]. Without @<o>, the sub-range starts at `default_offset`"""
+    length, _, offset = spec.partition("@")
+    return (int(offset) if offset else default_offset), int(length)
+
+
+def range_key(url: str, byterange: Optional[ByteRange]) -> str:
+    """the key of a cache: its url, and its byte range if it is a sub-range of the resource"""
+    if byterange is None:
+        return url
+    offset, length = byterange
+    return f"{url}#bytes={offset}-{offset + length - 1}"
+
+
 @dataclass
 class URI:
     url: str
@@ -58,7 +99,7 @@ class URI:
         return self.url.endswith(".ts")
 
     def urlparse(self):
-        return urllib.parse.urlparse(self.url)
+        return parse_url(self.url)
 
     @property
     def urlpath(self):
@@ -67,6 +108,7 @@ class URI:
 
 @dataclass
 class M3U8Line:
+    __slots__ = ("line_text",)
     line_text: str
 
     @staticmethod
@@ -88,19 +130,36 @@ class M3U8Line:
     def get_uri(self) -> str:
         pass
 
+    def render_with_uri(self, uri: str) -> str:
+        """the text of this line with its URI replaced by `uri`, without changing the line"""
+        return self.line_text
+
 
 class BlankLine(M3U8Line):
-    pass
+    __slots__ = ()
 
 
 class CommentLine(M3U8Line):
-    pass
+    __slots__ = ()
 
 
 class TagLine(M3U8Line):
+    __slots__ = ("_tag",)
+
     def __init__(self, line_text):
         super().__init__(line_text)
-        self.tag = TagManager.build_tag(line_text)
+        self._tag: Optional[Tag] = None
+
+    @property
+    def tag(self) -> Tag:
+        # most lines are never looked into, build the tag on first access
+        if self._tag is None:
+            self._tag = TagManager.build_tag(self.line_text)
+        return self._tag
+
+    @property
+    def tag_name(self) -> str:
+        return self.line_text.split(":", 1)[0]
 
     def replace_uri_with(self, uri) -> "TagLine":
         if isinstance(self.tag, TagWithAttrList):
@@ -109,18 +168,108 @@ class TagLine(M3U8Line):
                 self.line_text = str(self.tag)
 
     def get_uri(self):
+        # tags without an attribute list have no URI, no need to build them
+        if self.tag_name not in TagManager.name2class:
+            return None
         if isinstance(self.tag, TagWithAttrList):
-            if "URI" in self.tag:
-                return self.tag.attr_list["URI"].strip('"')
+            return self.tag.get_str("URI")
+
+    def render_with_uri(self, uri: str) -> str:
+        if isinstance(self.tag, TagWithAttrList) and "URI" in self.tag:
+            return self.tag.replaced("URI", f'"{uri}"')
+        return self.line_text
+
+    def render_extracted(self, uri: str) -> str:
+        """render_with_uri for a file that holds only the BYTERANGE of the URI: the attribute is left out"""
+        return self.tag.rendered({"URI": f'"{uri}"', "BYTERANGE": None})
 
 
 class URILine(M3U8Line):
+    __slots__ = ()
+
     def replace_uri_with(self, uri: str) -> "URILine":
         self.line_text = uri
 
     def get_uri(self) -> str:
         return self.line_text
 
+    def render_with_uri(self, uri: str) -> str:
+        return uri
+
+
+# the characters str.splitlines splits on
+LINE_BREAKS = "\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+LINE_KINDS = (BlankLine, CommentLine, TagLine, URILine)
+BLANK, COMMENT, TAG, URI_KIND = range(len(LINE_KINDS))
+
+
+class LineStore(Sequence):
+    """
+    The lines of a playlist, stored as offsets into its content and one kind byte per line
+    (an index into LINE_KINDS, classified the same way as M3U8Line.parse).
+    A line costs 9 bytes until it is accessed as an M3U8Line: its start and end offsets
+    (array("I"), 4 bytes each, so the content must be shorter than 4 GiB) and its kind byte.
+    Accessed lines are kept, so changes made to them (replace_uri_with) stay, like in a list.
+    text() and scan() read lines without creating M3U8Line objects.
+    """
+
+    __slots__ = ("content", "starts", "ends", "kinds", "materialized")
+
+    def __init__(self, content: str) -> None:
+        self.content = content
+        self.starts = array("I")
+        self.ends = array("I")
+        self.kinds = bytearray()
+        self.materialized: Dict[int, M3U8Line] = dict()
+        offset = 0
+        for raw in content.splitlines(True):
+            end = offset + len(raw.rstrip(LINE_BREAKS))
+            self.starts.append(offset)
+            self.ends.append(end)
+            if end == offset:
+                self.kinds.append(BLANK)
+            elif content[offset] != "#":
+                self.kinds.append(URI_KIND)
+            elif content.startswith("#EXT", offset):
+                self.kinds.append(TAG)
+            else:
+                self.kinds.append(COMMENT)
+            offset += len(raw)
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def text(self, i: int) -> str:
+        line = self.materialized.get(i)
+        if line is not None:
+            return line.line_text
+        return self.content[self.starts[i] : self.ends[i]]
+
+    def kind(self, i: int) -> type:
+        return LINE_KINDS[self.kinds[i]]
+
+    def scan(self) -> Iterator[Tuple[int, type, str]]:
+        """(index, M3U8Line subclass, text) of every line"""
+        for i in range(len(self.kinds)):
+            yield i, LINE_KINDS[self.kinds[i]], self.text(i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        line = self.materialized.get(i)
+        if line is None:
+            line = LINE_KINDS[self.kinds[i]](self.content[self.starts[i] : self.ends[i]])
+            self.materialized[i] = line
+        return line
+
+    def __setitem__(self, i: int, line: M3U8Line):
+        if i < 0:
+            i += len(self)
+        self.kinds[i] = LINE_KINDS.index(type(line))
+        self.materialized[i] = line
+
 
 class Playlist(URI):
     def __init__(self, m3u8_url: str, content: str = None):
@@ -131,100 +280,191 @@ class Playlist(URI):
         else:
             self.content = content
 
-        self.lines: List[M3U8Line] = [
-            M3U8Line.parse(line) for line in self.content.splitlines()
-        ]
+        self.lines = LineStore(self.content)
 
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}(m3u8_url={self.url!r})"
 
     def is_master_playlist(self):
-        for line in self.lines:
-            if isinstance(line, URILine):
-                if not URI(line.line_text).is_m3u:
+        for _, kind, text in self.lines.scan():
+            if kind is URILine:
+                if not URI(text).is_m3u:
                     return False
         return True
 
     def is_media_playlist(self):
-        for line in self.lines:
-            if isinstance(line, URILine):
-                if URI(line).is_m3u:
+        for _, kind, text in self.lines.scan():
+            if kind is URILine:
+                if URI(text).is_m3u:
                     return False
         return True
 
+    def has_endlist(self):
+        """a playlist without EXT-X-ENDLIST is live (or an event that is still going on)"""
+        for i in reversed(range(len(self.lines))):
+            if self.lines.text(i).strip() == "#EXT-X-ENDLIST":
+                return True
+        return False
+
     def download(self) -> str:
         from . import download_core
 
         with download_core.download(self.url, download_core.headers, 15, 1) as resp:
             return resp.content.decode("utf8")
 
+    def render(self, uri_map: Optional[Callable[[str], str]] = None) -> Iterator[str]:
+        """
+        Yield the text of every line, with every URI replaced by uri_map(absolute URI).
+        If `uri_map` is None, the lines are yielded as they are.
+        Neither the playlist nor its lines are changed or copied.
+        A uri map marked by extracts_ranges is called with (absolute URI, byte range) instead.
+        """
+        return (texts[0] for texts in render_many(self, [uri_map]) if texts[0] is not None)
+
+    def uris(self) -> Iterator[str]:
+        """the absolute URI of every line that has one, in order"""
+        return (fq_uri for _, _, fq_uri, _ in self.scan_uris() if fq_uri is not None)
+
+    def scan_uris(self) -> Iterator[Tuple[str, Optional[M3U8Line], Optional[str], Optional[ByteRange]]]:
+        """
+        Yield (text, line, absolute URI, byte range) of every line.
+        line, URI and byte range are None for lines without a URI, and the byte range is None
+        unless EXT-X-BYTERANGE (or BYTERANGE of EXT-X-MAP) gives the URI a sub-range.
+        Lines are only turned into M3U8Line objects if they may have a URI, and those are not kept.
+        """
+        lines = self.lines
+        pending: Optional[str] = None
+        # where a sub-range without offset starts: right after the previous one of the same resource
+        last_url: Optional[str] = None
+        last_end = 0
+        for i, kind, text in lines.scan():
+            if kind is URILine:
+                line = lines.materialized.get(i) or URILine(text)
+                fq_uri = resolve_uri(self.url, text)
+                byterange = None
+                if pending is not None:
+                    byterange = parse_byterange(pending, last_end if fq_uri == last_url else 0)
+                    last_url, last_end = fq_uri, byterange[0] + byterange[1]
+                    pending = None
+                yield text, line, fq_uri, byterange
+            elif kind is TagLine and text.startswith(BYTERANGE_PREFIX):
+                pending = text[len(BYTERANGE_PREFIX) :]
+                yield text, None, None, None
+            elif kind is TagLine and text.split(":", 1)[0] in TagManager.name2class:
+                line = lines.materialized.get(i) or TagLine(text)
+                uri = line.get_uri()
+                if uri is None:
+                    yield text, None, None, None
+                    continue
+                byterange = None
+                if text.startswith(EXT_X_MAP.prefix) and "BYTERANGE" in line.tag:
+                    byterange = parse_byterange(line.tag.get_str("BYTERANGE"), 0)
+                yield text, line, resolve_uri(self.url, uri), byterange
+            else:
+                yield text, None, None, None
+
     def to_abs_playlist(self) -> "Playlist":
-        playlist = copy.deepcopy(self)
-        for line in playlist.lines:
-            uri = line.get_uri()
-            if uri is not None:
-                fq_uri = urllib.parse.urljoin(playlist.url, uri)
-                line.replace_uri_with(fq_uri)
-        return playlist
+        return Playlist(self.url, "".join(line + "\n" for line in self.render(absolute_uri)))
 
 
 @dataclass
 class Cache:
+    __slots__ = ("idx", "url", "ext", "byterange")
     idx: int
     url: str
     ext: str
+    # None for the whole resource
+    byterange: Optional[ByteRange]
+
+    @property
+    def key(self) -> str:
+        return range_key(self.url, self.byterange)
 
 class CacheJsonEncoder(json.JSONEncoder):
     def default(self, o: Cache):
-        return {'idx': o.idx, 'url':o.url, 'ext':o.ext}
+        if o.byterange is None:
+            return {'idx': o.idx, 'url':o.url, 'ext':o.ext}
+        return {'idx': o.idx, 'url':o.url, 'ext':o.ext, 'byterange': list(o.byterange)}
 
 def cache_from_str(o: dict):
     try:
-        return Cache(idx=o['idx'], url=o['url'], ext=o['ext'])
+        byterange = o.get('byterange')
+        return Cache(idx=o['idx'], url=o['url'], ext=o['ext'], byterange=tuple(byterange) if byterange else None)
     except:
         return o
 
-class CacheNameAssigner:
-    """register urls and gives them"""
 
-    def __init__(self) -> None:
+def extracts_ranges(uri_map: Callable[[str, Optional[ByteRange]], str]):
+    """
+    Mark a uri map that gives every sub-range a file of its own (e.g. CacheNameAssigner.cache_name):
+    render_many calls it with (absolute URI, byte range), and leaves the byte ranges out of what it renders
+    """
+    uri_map.extracts_ranges = True
+    return uri_map
+
+class CacheNameAssigner:
+    """
+    register urls and gives them
+
+    同一个 URL 的不同 sub-range（EXT-X-BYTERANGE）是不同的 cache，各自有自己的文件，url2cache 的 key 见 range_key
+
+    持久化有两种格式：
+        dump / load                  整个 url2cache 写成一个 JSON（旧格式）
+        save_journal / load_journal  每行一个 [ext, idx, url] 的追加日志（sub-range 再加上 offset, length），
+                                     save_journal 只追加上次保存之后新注册的 URI
+    """
+
+    def __init__(self, min_digits: int = 1) -> None:
+        """
+        min_digits: the minimum width of the zero padded index in cache names.
+        Cache names only stay the same while more URIs are registered if the
+        count of an ext does not outgrow it (e.g. live playlists).
+        """
+        self.min_digits = min_digits
         self.url2cache: Dict[str, Cache] = dict()
         self.ext2cache_list: Dict[str, List[Cache]] = defaultdict(list)
         self.ext_counter: Dict[str, int] = defaultdict(int)
+        # every cache in the order they were registered, the journal is a prefix of it
+        self.cache_list: List[Cache] = []
+        self.journal: Optional[Path] = None
+        self.journaled = 0
+        self.journal_dirty = False
 
-    def register_uri(self, uri: str, ext: Optional[str] = None):
+    def register_uri(self, uri: str, ext: Optional[str] = None, byterange: Optional[ByteRange] = None):
         if ext is None:
             ext = Path(uri).suffix[1:]
         if not isinstance(ext, str) or len(ext) == 0:
             raise ValueError(f"{ext} is not a valid extension name")
-        if uri in self.url2cache:
-            return self.url2cache[uri]
+        key = range_key(uri, byterange)
+        if key in self.url2cache:
+            return self.url2cache[key]
 
         counter = self.ext_counter[ext]
         self.ext_counter[ext] += 1
-        cache = Cache(counter, uri, ext)
-        self.url2cache[uri] = cache
+        cache = Cache(counter, uri, ext, byterange)
+        self.url2cache[key] = cache
         self.ext2cache_list[ext].append(cache)
+        self.cache_list.append(cache)
         return cache
 
     def register_playlist_uri(self, playlist: Playlist):
         self.register_uri(playlist.url, ext="m3u8")
-        for line in playlist.to_abs_playlist().lines:
-            uri = line.get_uri()
-            if uri is not None:
-                self.register_uri(uri)
+        for _, _, fq_uri, byterange in playlist.scan_uris():
+            if fq_uri is not None:
+                self.register_uri(fq_uri, byterange=byterange)
 
-    def get_cache(self, uri: str):
-        return self.url2cache[uri]
+    def get_cache(self, uri: str, byterange: Optional[ByteRange] = None):
+        return self.url2cache[range_key(uri, byterange)]
 
-    def cache_name(self, uri: str):
+    @extracts_ranges
+    def cache_name(self, uri: str, byterange: Optional[ByteRange] = None):
         # 必须先调用一次 register_uri, 才能调用 cache_name
         # 目的是得到同 ext 的总数量，方便计算前导零的数量
-        cache = self.url2cache[uri]
+        cache = self.url2cache[range_key(uri, byterange)]
         counter = self.ext_counter[cache.ext]
         if counter == 0:
             raise ValueError(f"suffix {cache.ext!r} is not registered")
-        digit_num = math.floor(math.log10(counter)) + 1
+        digit_num = max(math.floor(math.log10(counter)) + 1, self.min_digits)
         if URI(uri).is_m3u:
             return f"{cache.ext}/{cache.idx:0{digit_num}d}.local.{cache.ext}"
         else:
@@ -238,16 +478,131 @@ class CacheNameAssigner:
         with file.open('r', encoding='utf8') as f:
             data = json.load(f, object_hook=cache_from_str)
         for cache in data.values():
-            self.register_uri(cache.url, cache.ext)
+            self.register_uri(cache.url, cache.ext, cache.byterange)
+
+    @staticmethod
+    def journal_line(cache: Cache) -> str:
+        if cache.byterange is None:
+            return json.dumps([cache.ext, cache.idx, cache.url], ensure_ascii=False) + "\n"
+        return json.dumps([cache.ext, cache.idx, cache.url, *cache.byterange], ensure_ascii=False) + "\n"
+
+    def save_journal(self, file: Path):
+        """
+        Append the URIs registered since the last save_journal / load_journal of `file`.
+        The whole journal is rewritten (compacted) instead if it was not loaded or saved by
+        this assigner, or if it has broken or repeated lines.
+        """
+        if self.journal != file or self.journal_dirty:
+            self.compact_journal(file)
+            return
+        if self.journaled == len(self.cache_list):
+            return
+        with file.open("a", encoding="utf8") as f:
+            f.write("".join(self.journal_line(cache) for cache in self.cache_list[self.journaled :]))
+        self.journaled = len(self.cache_list)
+
+    def compact_journal(self, file: Path):
+        """write every URI to `file` atomically"""
+        tmp = file.with_name(file.name + ".tmp")
+        with tmp.open("w", encoding="utf8") as f:
+            f.write("".join(self.journal_line(cache) for cache in self.cache_list))
+        os.replace(tmp, file)
+        self.journal = file
+        self.journaled = len(self.cache_list)
+        self.journal_dirty = False
+
+    def load_journal(self, file: Path):
+        """
+        Load the URIs of a journal into this (empty) assigner.
+        A torn last line (the process was killed while appending) and repeated URIs are skipped,
+        the next save_journal compacts the journal without them.
+        """
+        if self.url2cache:
+            raise ValueError("load_journal needs an empty CacheNameAssigner")
+        text = file.read_text("utf8")
+        lines = text.splitlines()
+        bad = 0
+        try:
+            # one json.loads for the whole file is several times faster than one per line
+            entries = json.loads("[" + ",".join(lines) + "]")
+        except ValueError:
+            entries = []
+            for line in lines:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    bad += 1
+        url2cache = self.url2cache
+        for ext, idx, url, *byterange in entries:
+            byterange = tuple(byterange) if byterange else None
+            key = range_key(url, byterange)
+            if key in url2cache:
+                bad += 1
+                continue
+            cache = Cache(idx, url, ext, byterange)
+            url2cache[key] = cache
+            self.ext2cache_list[ext].append(cache)
+            self.cache_list.append(cache)
+            if idx >= self.ext_counter[ext]:
+                self.ext_counter[ext] = idx + 1
+        if bad:
+            logger.warning(f"{bad} broken or repeated lines in {file} are skipped")
+        self.journal = file
+        self.journaled = len(self.cache_list)
+        self.journal_dirty = bad > 0 or (len(text) > 0 and not text.endswith("\n"))
             
 
 
+def absolute_uri(uri: str) -> str:
+    return uri
+
+
+def render_uri_line(line: M3U8Line, fq_uri: str, byterange: Optional[ByteRange], uri_map, extract: bool) -> str:
+    if not extract:
+        return line.render_with_uri(uri_map(fq_uri))
+    uri = uri_map(fq_uri, byterange)
+    if byterange is not None and isinstance(line, TagLine):
+        return line.render_extracted(uri)
+    return line.render_with_uri(uri)
+
+
+def render_many(
+    playlist: Playlist, uri_maps: Sequence[Optional[Callable[[str], str]]]
+) -> Iterator[Tuple[Optional[str], ...]]:
+    """
+    Render several forms of `playlist` in one pass: for every line, yield a tuple
+    with its text rendered by each of `uri_maps` (see Playlist.render).
+    The forms of uri maps marked by extracts_ranges leave byte ranges out: their
+    EXT-X-BYTERANGE lines are None, and EXT-X-MAP loses its BYTERANGE attribute.
+    """
+    extracts = [getattr(uri_map, "extracts_ranges", False) for uri_map in uri_maps]
+    for text, line, fq_uri, byterange in playlist.scan_uris():
+        if fq_uri is not None:
+            yield tuple(
+                text if uri_map is None else render_uri_line(line, fq_uri, byterange, uri_map, extract)
+                for uri_map, extract in zip(uri_maps, extracts)
+            )
+        elif text.startswith(BYTERANGE_PREFIX):
+            yield tuple(None if extract else text for extract in extracts)
+        else:
+            yield (text,) * len(uri_maps)
+
+
+def write_rendered(playlist: Playlist, targets: Sequence[Tuple[Path, Optional[Callable[[str], str]]]]):
+    """write the forms of `playlist` rendered by the uri maps of `targets` to their paths, in one pass"""
+    files = [path.open("w", encoding="utf8") for path, _ in targets]
+    try:
+        for texts in render_many(playlist, [uri_map for _, uri_map in targets]):
+            for f, text in zip(files, texts):
+                if text is not None:
+                    f.write(text)
+                    f.write("\n")
+    finally:
+        for f in files:
+            f.close()
+
+
 def to_local_playlist(playlist: Playlist, cna: CacheNameAssigner) -> Playlist:
-    playlist = copy.deepcopy(playlist)
-    for line in playlist.lines:
-        uri = line.get_uri()
-        if uri is not None:
-            fq_uri = urllib.parse.urljoin(playlist.url, uri)
-            cache_name = cna.cache_name(fq_uri)
-            line.replace_uri_with(cache_name)
-    return playlist
+    return Playlist(
+        playlist.url, "".join(line + "\n" for line in playlist.render(cna.cache_name))
+    )
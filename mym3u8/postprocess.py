@@ -0,0 +1,140 @@
+"""
+segment 的 CPU 密集型后处理（校验和、解密、转封装……）
+
+这些工作在下载线程里做会被 GIL 串行化，所以交给进程池。
+进程之间只传文件路径，不传 segment 的内容：worker 进程自己从磁盘（页缓存）读文件，
+避免把几 MB 的 bytes pickle 一遍再拷贝到另一个进程
+
+step 是形如 step(path: str) -> Optional[dict] 的函数，必须可以 pickle（模块顶层函数或 functools.partial），
+同一个文件的多个 step 在同一个 worker 进程中按顺序执行，返回的 dict 合并成这个文件的结果
+进程池用 forkserver（没有的话用 spawn）启动，调用方的入口脚本需要有 if __name__ == "__main__" 保护
+
+每个 task 的结果写入各自的 JSON lines 文件（add_task），结果里记着文件的大小。
+SegmentDownloader 对之前已经下载过的文件也会调用 on_complete，
+这些文件如果在结果文件里已经有同样大小的结果，就不再处理
+
+    post = PostProcessor([sha256])
+    post.add_task("", task_dir / "postprocess.jsonl")
+    downloader = SegmentDownloader(on_complete=[post.on_complete])
+    downloader.run(jobs)
+    failed = post.join()
+    post.dump()
+"""
+from .downloader import DownloadJob
+from concurrent.futures import ProcessPoolExecutor, Future
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import multiprocessing
+import subprocess
+import threading
+import hashlib
+import logging
+import shutil
+import json
+
+logger = logging.getLogger(__name__)
+
+Step = Callable[[str], Optional[dict]]
+
+
+def sha256(path: str, chunk_size: int = 1024 * 1024) -> dict:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return {"sha256": h.hexdigest()}
+
+
+def remux(path: str, ext: str = "mp4", ffmpeg: str = "ffmpeg") -> dict:
+    """copy the streams of `path` into a new container next to it, without re-encoding"""
+    src = Path(path)
+    dst = src.with_suffix(f".{ext}")
+    subprocess.run(
+        [ffmpeg, "-y", "-loglevel", "error", "-i", str(src), "-c", "copy", str(dst)],
+        check=True,
+    )
+    return {"remuxed": str(dst)}
+
+
+def run_steps(path: str, steps: Sequence[Step]) -> dict:
+    result = {}
+    for step in steps:
+        result.update(step(path) or {})
+    return result
+
+
+class PostProcessor:
+    def __init__(self, steps: Sequence[Step], processes: int = None) -> None:
+        if any(getattr(step, "func", step) is remux for step in steps) and shutil.which("ffmpeg") is None:
+            logger.warning("ffmpeg is not found, remux steps will fail")
+        self.steps = list(steps)
+        # download threads are running when the pool starts its processes, forking them is not safe
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self.executor = ProcessPoolExecutor(processes, mp_context=context)
+        self.futures: Dict[Future, Tuple[DownloadJob, int]] = dict()
+        # results by task and cache key, including the ones of earlier runs
+        self.results: Dict[str, Dict[str, dict]] = defaultdict(dict)
+        self.files: Dict[str, Path] = dict()
+        self.lock = threading.Lock()
+
+    def add_task(self, task: str, results_file: Path):
+        """the results of `task` are written to `results_file` by dump(), the results already there are kept"""
+        with self.lock:
+            self.files[task] = results_file
+            if results_file.exists():
+                self.results[task].update(load_results(results_file))
+
+    def processed(self, job: DownloadJob, size: int) -> bool:
+        with self.lock:
+            result = self.results[job.task].get(job.key)
+        return result is not None and result.get("size") == size
+
+    def submit(self, job: DownloadJob, size: int) -> Future:
+        future = self.executor.submit(run_steps, str(job.path), self.steps)
+        with self.lock:
+            self.futures[future] = (job, size)
+        return future
+
+    def on_complete(self, job: DownloadJob, size: int):
+        """SegmentDownloader callback"""
+        if not self.processed(job, size):
+            self.submit(job, size)
+
+    def join(self) -> List[Tuple[DownloadJob, Exception]]:
+        """
+        Wait for all submitted files, and return the failed ones.
+        Call it after the downloader has finished.
+        """
+        self.executor.shutdown(wait=True)
+        failed: List[Tuple[DownloadJob, Exception]] = []
+        for future, (job, size) in self.futures.items():
+            e = future.exception()
+            if e is None:
+                self.results[job.task][job.key] = dict(size=size, **future.result())
+            else:
+                logger.error(f"Failed to post process {job.path}: {e!r}")
+                self.results[job.task].pop(job.key, None)
+                failed.append((job, e))
+        return failed
+
+    def dump(self):
+        """write the results of every task to its file"""
+        for task, file in self.files.items():
+            dump_results(file, self.results[task])
+
+
+def load_results(file: Path) -> Dict[str, dict]:
+    results = dict()
+    for line in file.read_text(encoding="utf8").splitlines():
+        if line:
+            result = json.loads(line)
+            results[result.pop("url")] = result
+    return results
+
+
+def dump_results(file: Path, results: Dict[str, dict]):
+    with file.open("w", encoding="utf8") as f:
+        for url, result in results.items():
+            f.write(json.dumps(dict(url=url, **result), ensure_ascii=False) + "\n")
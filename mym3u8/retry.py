@@ -0,0 +1,143 @@
+"""
+重试策略与按 host 的熔断器
+
+RetryPolicy 决定一次失败之后要不要重试、等多久（指数退避 + 抖动，服务器给了 Retry-After 就按它来）
+CircuitBreaker 由同一个 host 的所有 worker 共享：连续失败太多次，或者服务器要求我们等待（429/503 + Retry-After）时，
+整个 host 暂停一段时间，冷却结束后只放一个探测请求过去（half-open），成功了才恢复
+
+CircuitBreaker.acquire 不会阻塞，只返回还需要等待的秒数，这样同步和 asyncio 的下载器都可以用
+"""
+from dataclasses import dataclass
+from typing import Dict, Optional, FrozenSet
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import threading
+import logging
+import random
+import time
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After is either delay-seconds or an HTTP-date"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+@dataclass
+class RetryPolicy:
+    base_delay: float = config.retry_base_delay
+    max_delay: float = config.retry_max_delay
+    multiplier: float = 2.0
+    jitter: float = 1.0
+    retry_statuses: FrozenSet[int] = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+    def should_retry(self, status: Optional[int]) -> bool:
+        """status is None for connection errors and timeouts"""
+        return status is None or status in self.retry_statuses
+
+    def backoff(self, attempt: int) -> float:
+        """
+        attempt starts from 0. `jitter` is the fraction of the delay that is randomized,
+        1.0 means "full jitter": uniform(0, delay)
+        """
+        delay = min(self.base_delay * self.multiplier**attempt, self.max_delay)
+        return delay - random.uniform(0, delay * self.jitter)
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return self.backoff(attempt)
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        host: str = "",
+        failure_threshold: int = config.breaker_failure_threshold,
+        cooldown: float = config.breaker_cooldown,
+        max_cooldown: float = config.retry_max_delay,
+    ) -> None:
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.failures >= self.failure_threshold or time.monotonic() < self.open_until
+
+    def acquire(self) -> float:
+        """
+        Return 0 if a request may be sent now,
+        otherwise the number of seconds to wait before calling acquire again.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.open_until:
+                return self.open_until - now
+            if self.failures < self.failure_threshold:
+                return 0.0
+            if self.probing:
+                return min(self.base_cooldown, 0.1)
+            self.probing = True  # half-open: this caller is the probe
+            return 0.0
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            self.cooldown = self.base_cooldown
+
+    def record_failure(self, retry_after: Optional[float] = None):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.failure_threshold:
+                delay = max(self.cooldown, retry_after or 0.0)
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            elif retry_after is not None:
+                delay = retry_after
+            else:
+                return
+            self.open_until = max(self.open_until, time.monotonic() + delay)
+            logger.warning(
+                f"circuit of {self.host!r} open for {delay:.1f}s after {self.failures} failures"
+            )
+
+    def release(self):
+        """the request ended in a way that says nothing about the host"""
+        with self.lock:
+            self.probing = False
+
+
+breakers: Dict[str, CircuitBreaker] = dict()
+breakers_lock = threading.Lock()
+
+
+def get_breaker(host: str) -> CircuitBreaker:
+    with breakers_lock:
+        breaker = breakers.get(host)
+        if breaker is None:
+            breaker = breakers[host] = CircuitBreaker(host)
+        return breaker
+
+
+default_policy = RetryPolicy()
@@ -0,0 +1,198 @@
+"""
+所有 task 共用的 segment 仓库（config.store_root，默认关闭）
+
+同一个 VOD 换一个 variant 重新下载、不同视频中重复出现的片头 / 广告 segment 和 key，
+只要 URL 下载过一次，就不需要再下载
+
+    objects/<sha256 前两位>/<sha256>   按内容寻址的文件，内容相同的只存一份
+    urls.jsonl                         URL 到内容的索引，每行一个 [key, sha256, size]，只追加
+
+task 目录中的文件是 objects 中文件的硬链接，不占用额外的磁盘空间；
+不在同一个文件系统、不能建硬链接时退回复制
+
+解密后的 segment 和原始的 segment 内容不同，key 是 URL 加上 "#decrypted"
+
+最近使用时间就是 object 的 mtime（命中时更新），objects 的总大小超过 max_bytes 时，
+按最久未使用的顺序删除到 max_bytes 的 90%。仍被 task 硬链接的文件只是离开仓库，数据留在 task 中
+"""
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+import threading
+import hashlib
+import logging
+import shutil
+import errno
+import json
+import os
+
+logger = logging.getLogger(__name__)
+
+# errors of os.link that copying can work around
+NO_LINK = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOSYS}
+
+
+def file_sha256(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with path.open("rb") as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            sha256.update(chunk)
+            chunk = f.read(chunk_size)
+    return sha256.hexdigest()
+
+
+def place(src: Path, dst: Path):
+    """make `dst` a hardlink of `src` (a copy if that is impossible), replacing it atomically"""
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f"{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        os.link(src, tmp)
+    except OSError as e:
+        if e.errno not in NO_LINK:
+            raise
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class SegmentStore:
+    def __init__(self, root: Path, max_bytes: int = None) -> None:
+        self.root = root
+        self.objects = root / "objects"
+        self.index_file = root / "urls.jsonl"
+        self.max_bytes = max_bytes
+        self.urls: Dict[str, Tuple[str, int]] = dict()
+        self.sizes: Dict[str, int] = dict()
+        self.total = 0
+        self.hits = 0
+        self.evicting = False
+        self.lock = threading.Lock()
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.scan()
+        self.load_index()
+
+    def object_path(self, sha256: str) -> Path:
+        return self.objects / sha256[:2] / sha256
+
+    def scan(self):
+        for sub in os.scandir(self.objects):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                self.sizes[entry.name] = entry.stat().st_size
+        self.total = sum(self.sizes.values())
+
+    def load_index(self):
+        if not self.index_file.exists():
+            return
+        lines = self.index_file.read_text(encoding="utf8").splitlines()
+        for line in lines:
+            try:
+                key, sha256, size = json.loads(line)
+            except ValueError:
+                logger.warning(f"Ignore broken line in {self.index_file}: {line!r}")
+                continue
+            self.urls[key] = (sha256, size)
+        # urls of evicted objects are dropped
+        self.urls = {key: entry for key, entry in self.urls.items() if entry[0] in self.sizes}
+        if len(self.urls) < len(lines):
+            self.compact_index()
+
+    def compact_index(self):
+        tmp = self.index_file.with_name(self.index_file.name + ".tmp")
+        with tmp.open("w", encoding="utf8") as f:
+            f.write("".join(self.index_line(key, *entry) for key, entry in self.urls.items()))
+        os.replace(tmp, self.index_file)
+
+    @staticmethod
+    def index_line(key: str, sha256: str, size: int) -> str:
+        return json.dumps([key, sha256, size], ensure_ascii=False) + "\n"
+
+    def __contains__(self, key: str):
+        return key in self.urls
+
+    def link(self, key: str, path: Path) -> Optional[Tuple[int, str]]:
+        """
+        Hardlink the stored file of `key` to `path`.
+        Return its size and sha256, or None if it is not in the store.
+        """
+        with self.lock:
+            entry = self.urls.get(key)
+        if entry is None:
+            return None
+        sha256, size = entry
+        obj = self.object_path(sha256)
+        try:
+            place(obj, path)
+            os.utime(obj)
+        except FileNotFoundError:
+            # evicted by another process
+            with self.lock:
+                self.urls.pop(key, None)
+            return None
+        with self.lock:
+            self.hits += 1
+        return size, sha256
+
+    def put(self, key: str, path: Path, sha256: str = None):
+        """
+        Add the downloaded file `path` of `key`. If the same content is already stored,
+        `path` is replaced by a hardlink of it.
+        Hashing, linking and evicting files are done outside the lock, it is only held to update the index.
+        """
+        if sha256 is None:
+            sha256 = file_sha256(path)
+        size = path.stat().st_size
+        obj = self.object_path(sha256)
+        # place replaces its target atomically, threads putting the same content at once just link it twice
+        try:
+            place(obj, path)
+            os.utime(obj)
+        except FileNotFoundError:
+            place(path, obj)
+        with self.lock:
+            self.total += size - self.sizes.get(sha256, 0)
+            self.sizes[sha256] = size
+            if self.urls.get(key) != (sha256, size):
+                self.urls[key] = (sha256, size)
+                with self.index_file.open("a", encoding="utf8") as f:
+                    f.write(self.index_line(key, sha256, size))
+            evict = self.max_bytes is not None and self.total > self.max_bytes and not self.evicting
+            if evict:
+                self.evicting = True
+        if evict:
+            try:
+                self.evict(int(self.max_bytes * 0.9))
+            finally:
+                self.evicting = False
+
+    def evict(self, target: int):
+        """
+        delete the least recently used objects until they take at most `target` bytes.
+        An object put again while it is being deleted is missing from the store until it is put once more:
+        link() finds it gone and forgets its urls
+        """
+        with self.lock:
+            stored = list(self.sizes)
+        used = []
+        for sha256 in stored:
+            try:
+                used.append((self.object_path(sha256).stat().st_mtime, sha256))
+            except FileNotFoundError:
+                used.append((0, sha256))
+        used.sort()
+        evicted = []
+        with self.lock:
+            for _, sha256 in used:
+                if self.total <= target:
+                    break
+                if sha256 in self.sizes:
+                    self.total -= self.sizes.pop(sha256)
+                    evicted.append(sha256)
+            self.urls = {key: entry for key, entry in self.urls.items() if entry[0] in self.sizes}
+            self.compact_index()
+            total = self.total
+        for sha256 in evicted:
+            self.object_path(sha256).unlink(missing_ok=True)
+        logger.info(f"Evicted {len(evicted)} files from {self.root}, {total} bytes left")
@@ -1,12 +1,11 @@
 from dataclasses import dataclass
-from typing import Mapping, Optional, Any, List, Dict
-import string
+from typing import Mapping, Optional, Any, List, Dict, Tuple, Callable
 import re
-from io import StringIO
 
 
 @dataclass
 class Attribute:
+    __slots__ = ("key", "value")
     key: str
     value: Any
 
@@ -14,39 +13,91 @@ class Attribute:
         return f"{self.key}={self.value}"
 
 
+def decimal_integer(value: str) -> int:
+    return int(value)
+
+
+def decimal_float(value: str) -> float:
+    return float(value)
+
+
+def quoted_string(value: str) -> str:
+    return value.strip('"')
+
+
+def resolution(value: str) -> Tuple[int, int]:
+    """decimal-resolution: WIDTHxHEIGHT"""
+    width, height = value.lower().split("x", 1)
+    return int(width), int(height)
+
+
 class AttributeList:
-    name_charset = string.ascii_uppercase + string.digits + "-"
+    """
+    The attributes in their original order, with an index from key to position
+    (the first one if a key is repeated).
+    get_int / get_float / get_str / get_resolution decode a value once and remember it.
+    """
+
+    __slots__ = ("attr_text", "attr_list", "index", "decoded")
+    # one well-formed attribute and the comma after it. Anything else is left to parse_slow
+    attr_re = re.compile(r'([A-Z0-9-]*)=("[^"\r\n]*"|(?!")[^,]+)(?:,|\Z)')
+    name_re = re.compile(r"[A-Z0-9-]*")
 
     def __init__(self, attr_text: str) -> None:
         self.attr_text = attr_text
         self.attr_list: List[Attribute] = []
+        self.index: Dict[str, int] = dict()
+        self.decoded: Optional[Dict[Tuple[str, Callable], Any]] = None
         self.parse(attr_text)
 
     def parse(self, attr_text: str):
+        match = self.attr_re.match
+        attr_list = self.attr_list
+        index = self.index
         pivot = 0
-        state = "KEY"
         while pivot < len(attr_text):
-            c = attr_text[pivot]
-            if state == "KEY":
-                attr_obj = Attribute(None, None)
-                attr_obj.key, pivot = self.get_until_assigner(pivot)
-                state = "KEY_END"
-            elif state == "KEY_END":
-                if c != "=":
-                    self.__error_position(pivot, "Here should be a assigner")
-                state = "VALUE"
-            elif state == "VALUE":
-                if c == '"':
-                    attr_obj.value, pivot = self.get_quoted_str(pivot)
-                else:
-                    attr_obj.value, pivot = self.get_until_comma(pivot)
-                self.attr_list.append(attr_obj)
-                state = "VALUE_END"
-            elif state == "VALUE_END":
-                if c != ",":
-                    self.__error_position(pivot, "Here should be a comma.")
-                state = "KEY"
-            pivot += 1
+            m = match(attr_text, pivot)
+            if m is None:
+                pivot = self.parse_slow(pivot)
+            else:
+                key, value = m.group(1, 2)
+                if key not in index:
+                    index[key] = len(attr_list)
+                attr_list.append(Attribute(key, value))
+                pivot = m.end()
+
+    def append(self, key: str, value: str):
+        if key not in self.index:
+            self.index[key] = len(self.attr_list)
+        self.attr_list.append(Attribute(key, value))
+
+    def parse_slow(self, pivot: int) -> int:
+        """
+        Parse the attribute at `pivot` that attr_re does not match:
+        raise the error, or accept what the spec tolerates (an unclosed quoted string,
+        a name without value at the end, an empty value). Return the pivot of the next attribute.
+        """
+        attr_text = self.attr_text
+        assigner = self.name_re.match(attr_text, pivot).end()
+        if assigner == len(attr_text):
+            return assigner
+        if attr_text[assigner] != "=":
+            self.__error_position(
+                f"{attr_text[assigner]!r} is not a valid character in attribute name", assigner
+            )
+        key = attr_text[pivot:assigner]
+        if assigner + 1 == len(attr_text):
+            # "KEY=" at the end has no attribute, as the legacy parser had it
+            return assigner + 1
+        if attr_text[assigner + 1] == ",":
+            self.append(key, "")
+            return assigner + 2
+        value, pivot = self.get_quoted_str(assigner + 1)
+        self.append(key, value)
+        pivot += 1
+        if pivot < len(attr_text) and attr_text[pivot] != ",":
+            self.__error_position("Here should be a comma.", pivot)
+        return pivot + 1
 
     def __error_position(self, reason, start, end=None):
         if end is None or end - start <= 0:
@@ -68,62 +119,13 @@ class AttributeList:
         text starts from the first quote to the first close quote
         pivot is pointing at the close quote.
         """
-        buf = StringIO()
-        c = self.attr_text[pivot]
-        assert c == '"'
-        buf.write(c)
-        pivot += 1
-        forbidden_char = {"\x0A", "\x0D"}
-        while pivot < len(self.attr_text):
-            c = self.attr_text[pivot]
-            if c in forbidden_char:
-                self.__error_position("forbidden character", pivot)
-            else:
-                buf.write(c)
-                if c == '"':
-                    break
-            pivot += 1
-        return buf.getvalue(), pivot
-
-    def get_until_comma(self, pivot: int):
-        """
-        Return text and end pivot.
-        text starts from the pivot to (the position that just
-        before the first comma) or (the end of the text)
-        pivot is pointing at the last character of the text.
-        """
-        buf = StringIO()
-        while pivot < len(self.attr_text):
-            c = self.attr_text[pivot]
-            if c == ",":
-                pivot -= 1
-                break
-            else:
-                buf.write(c)
-            pivot += 1
-        return buf.getvalue(), pivot
-
-    def get_until_assigner(self, pivot: int):
-        """
-        Return text and end pivot.
-        text starts from the pivot to (the position that just
-        before the first assignment sign)
-        pivot is pointing at the last character of the text.
-        """
-        buf = StringIO()
-        while pivot < len(self.attr_text):
-            c = self.attr_text[pivot]
-            if c == "=":
-                pivot -= 1
-                break
-            else:
-                if c not in self.name_charset:
-                    self.__error_position(
-                        f"{c!r} is not a valid character in attribute name", pivot
-                    )
-                buf.write(c)
-            pivot += 1
-        return buf.getvalue(), pivot
+        assert self.attr_text[pivot] == '"'
+        close = self.attr_text.find('"', pivot + 1)
+        end = len(self.attr_text) if close == -1 else close + 1
+        for i in range(pivot + 1, end):
+            if self.attr_text[i] in "\x0A\x0D":
+                self.__error_position("forbidden character", i)
+        return self.attr_text[pivot:end], end - 1
 
     def __str__(self):
         attr_list = []
@@ -132,27 +134,75 @@ class AttributeList:
         return f'{",".join(attr_list)}'
 
     def __getitem__(self, key: str):
-        for attr in self.attr_list:
-            if attr.key == key:
-                return attr.value
-        raise KeyError(f"{key} does not exists in attribute list")
+        i = self.index.get(key)
+        if i is None:
+            raise KeyError(f"{key} does not exists in attribute list")
+        return self.attr_list[i].value
 
     def __setitem__(self, key: str, value: str):
-        attr_list = self.attr_list
-        for attr in attr_list:
-            if attr.key == key:
-                attr.value = value
-                return
-        raise KeyError(f"{key} does not exists in attribute list")
+        i = self.index.get(key)
+        if i is None:
+            raise KeyError(f"{key} does not exists in attribute list")
+        self.attr_list[i].value = value
+        if self.decoded:
+            for decoded_key in [k for k in self.decoded if k[0] == key]:
+                del self.decoded[decoded_key]
 
     def __contains__(self, key: str):
+        return key in self.index
+
+    def get(self, key: str, default=None):
+        i = self.index.get(key)
+        return default if i is None else self.attr_list[i].value
+
+    def decode(self, key: str, decoder: Callable[[str], Any], default=None):
+        """decoder(value of `key`), computed once. `default` if there is no `key`"""
+        i = self.index.get(key)
+        if i is None:
+            return default
+        if self.decoded is None:
+            self.decoded = dict()
+        cache_key = (key, decoder)
+        if cache_key not in self.decoded:
+            self.decoded[cache_key] = decoder(self.attr_list[i].value)
+        return self.decoded[cache_key]
+
+    def get_int(self, key: str, default: Optional[int] = None) -> Optional[int]:
+        return self.decode(key, decimal_integer, default)
+
+    def get_float(self, key: str, default: Optional[float] = None) -> Optional[float]:
+        return self.decode(key, decimal_float, default)
+
+    def get_str(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """a quoted-string without its quotes"""
+        return self.decode(key, quoted_string, default)
+
+    def get_resolution(self, key: str, default: Optional[Tuple[int, int]] = None) -> Optional[Tuple[int, int]]:
+        return self.decode(key, resolution, default)
+
+    def replaced(self, key: str, value: str) -> str:
+        """the text of this attribute list with `key` set to `value`, without changing it"""
+        i = self.index.get(key)
+        if i is None:
+            raise KeyError(f"{key} does not exists in attribute list")
+        return ",".join(
+            f"{attr.key}={value}" if j == i else str(attr) for j, attr in enumerate(self.attr_list)
+        )
+
+    def rendered(self, changes: Dict[str, Optional[str]]) -> str:
+        """the text of this attribute list with the values of `changes` set (None leaves the attribute out)"""
+        attrs = []
         for attr in self.attr_list:
-            if attr.key == key:
-                return True
-        return False
+            if attr.key not in changes:
+                attrs.append(str(attr))
+            elif changes[attr.key] is not None:
+                attrs.append(f"{attr.key}={changes[attr.key]}")
+        return ",".join(attrs)
 
 
 class Tag:
+    # a playlist can hold tens of thousands of tags, so tags (and lines, attributes) have no __dict__
+    __slots__ = ("line_text",)
     pattern: str
 
     def __init__(self, line_text: str) -> None:
@@ -186,18 +236,30 @@ class TagManager:
 
 
 class TagWithAttrList(Tag):
+    __slots__ = ("attr_text", "_attr_list")
     attribute_list_placeholder = "<attribute-list>"
+    prefix: str
 
-    def __init__(self, line_text):
-        tag_name, tail_text = self.pattern.split(":", 1)
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        tag_name, tail_text = cls.pattern.split(":", 1)
         assert (
-            tail_text == self.attribute_list_placeholder
+            tail_text == cls.attribute_list_placeholder
         ), f"{tag_name} has no attribute list"
-        re_pattern = self.pattern.replace(
-            self.attribute_list_placeholder, "(?P<attr_list>.*)"
-        )
-        attr_text = re.match(re_pattern, line_text, re.S).group("attr_list")
-        self.attr_list = AttributeList(attr_text)
+        cls.prefix = f"{tag_name}:"
+
+    def __init__(self, line_text):
+        if not line_text.startswith(self.prefix):
+            raise ValueError(f"{line_text!r} does not match {self.pattern!r}")
+        self.attr_text = line_text[len(self.prefix) :]
+        self._attr_list: Optional[AttributeList] = None
+
+    @property
+    def attr_list(self) -> AttributeList:
+        """parsed on first access, so a syntax error is raised here instead of by the constructor"""
+        if self._attr_list is None:
+            self._attr_list = AttributeList(self.attr_text)
+        return self._attr_list
     
     def __getitem__(self, key: str):
         return self.attr_list[key]
@@ -208,10 +270,31 @@ class TagWithAttrList(Tag):
     def __contains__(self, key: str):
         return key in self.attr_list
 
+    def get(self, key: str, default=None):
+        return self.attr_list.get(key, default)
+
+    def get_int(self, key: str, default: Optional[int] = None) -> Optional[int]:
+        return self.attr_list.get_int(key, default)
+
+    def get_float(self, key: str, default: Optional[float] = None) -> Optional[float]:
+        return self.attr_list.get_float(key, default)
+
+    def get_str(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        return self.attr_list.get_str(key, default)
+
+    def get_resolution(self, key: str, default: Optional[Tuple[int, int]] = None) -> Optional[Tuple[int, int]]:
+        return self.attr_list.get_resolution(key, default)
+
+    def replaced(self, key: str, value: str) -> str:
+        return self.prefix + self.attr_list.replaced(key, value)
+
+    def rendered(self, changes: Dict[str, Optional[str]]) -> str:
+        return self.prefix + self.attr_list.rendered(changes)
+
     def __str__(self):
-        return re.sub(
-            self.attribute_list_placeholder, str(self.attr_list), self.pattern
-        )
+        if self._attr_list is None:
+            return self.prefix + self.attr_text
+        return self.prefix + str(self._attr_list)
 
     @property
     def line_text(self):
@@ -219,46 +302,55 @@ class TagWithAttrList(Tag):
 
 @TagManager.register
 class EXT_X_KEY(TagWithAttrList):
+    __slots__ = ()
     pattern = "#EXT-X-KEY:<attribute-list>"
 
 
 @TagManager.register
 class EXT_X_MAP(TagWithAttrList):
+    __slots__ = ()
     pattern = "#EXT-X-MAP:<attribute-list>"
 
 
 @TagManager.register
 class EXT_X_DATERANGE(TagWithAttrList):
+    __slots__ = ()
     pattern = "#EXT-X-DATERANGE:<attribute-list>"
 
 
 @TagManager.register
 class EXT_X_MEDIA(TagWithAttrList):
+    __slots__ = ()
     pattern = "#EXT-X-MEDIA:<attribute-list>"
 
 
 @TagManager.register
 class EXT_X_STREAM_INF(TagWithAttrList):
+    __slots__ = ()
     pattern = "#EXT-X-STREAM-INF:<attribute-list>"
 
 
 @TagManager.register
 class EXT_X_I_FRAME_STREAM_INF(TagWithAttrList):
+    __slots__ = ()
     pattern = "EXT-X-I-FRAME-STREAM-INF:<attribute-list>"
 
 
 @TagManager.register
 class EXT_X_SESSION_DATA(TagWithAttrList):
+    __slots__ = ()
     pattern = "#EXT-X-SESSION-DATA:<attribute-list>"
 
 
 @TagManager.register
 class EXT_X_SESSION_KEY(TagWithAttrList):
+    __slots__ = ()
     pattern = "#EXT-X-SESSION-KEY:<attribute-list>"
 
 
 @TagManager.register
 class EXT_X_START(TagWithAttrList):
+    __slots__ = ()
     pattern = "#EXT-X-START:<attribute-list>"
 
 
@@ -0,0 +1,96 @@
+"""
+segment 完整性校验
+
+download_to_file 每写入一块数据就交给 SegmentCheck.update，sha256 边下载边计算，不需要下载完再把文件读一遍
+    响应体的长度必须等于 Content-Length（由 download_to_file 检查）
+    .ts 文件不能是空的，每 188 字节的第一个字节必须是同步字节 0x47，服务器返回的 HTML 错误页通不过。
+    最后一个 TS 包不完整只记一条警告：不少源站的 segment 就是这样，被截断的响应体已经由 Content-Length 发现
+校验失败的文件被删除，retrying 只重新下载一次：同样的响应体多半还是错的，
+而且这不是网络或服务器过载的问题，不计入熔断器和并发控制的失败次数
+
+sha256 和大小记录在 task 的 completed.jsonl 中，续传和合并直接相信这个清单，不需要再扫描磁盘
+
+AES-128 加密、下载时又不解密的 segment 是密文，不检查同步字节
+"""
+from . import download_core
+from .playlist import Playlist, URILine, range_key
+from .tag import EXT_X_KEY
+from typing import Iterable, Set
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+
+
+def aes128_segments(playlist: Playlist) -> Set[str]:
+    """cache keys (see range_key) of the segments encrypted with METHOD=AES-128"""
+    keys: Set[str] = set()
+    encrypted = False
+    for text, line, fq_uri, byterange in playlist.scan_uris():
+        if text.startswith(EXT_X_KEY.prefix):
+            encrypted = line is not None and line.tag["METHOD"] == "AES-128"
+        elif encrypted and isinstance(line, URILine):
+            keys.add(range_key(fq_uri, byterange))
+    return keys
+
+
+class SegmentCheck:
+    """sha256 and size of the bytes written to disk, and their TS sync bytes if `ts` is True"""
+
+    def __init__(self, url: str, ts: bool = False) -> None:
+        self.url = url
+        self.ts = ts
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data: bytes):
+        if self.ts:
+            # the packet boundaries of this chunk continue from the previous ones
+            start = -self.size % TS_PACKET_SIZE
+            sync = data[start::TS_PACKET_SIZE]
+            if sync.count(TS_SYNC_BYTE) != len(sync):
+                bad = next(i for i, b in enumerate(sync) if b != TS_SYNC_BYTE)
+                raise download_core.IntegrityError(
+                    f"{self.url} has no TS sync byte at offset {self.size + start + bad * TS_PACKET_SIZE}"
+                )
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def finalize(self):
+        if not self.ts:
+            return
+        if self.size == 0:
+            raise download_core.IntegrityError(f"{self.url} is empty")
+        if self.size % TS_PACKET_SIZE:
+            logger.warning(
+                f"{self.url} is {self.size} bytes long, its last TS packet is {self.size % TS_PACKET_SIZE} bytes"
+            )
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+
+class SegmentVerifier:
+    """
+    SegmentDownloader verify hook: called with a DownloadJob, returns a factory of SegmentChecks.
+    `decrypted` tells that AES-128 segments are decrypted while downloading (decrypt.SegmentDecrypter),
+    otherwise the playlists must be added so that their encrypted segments are not checked as TS
+    """
+
+    def __init__(self, playlists: Iterable[Playlist] = (), decrypted: bool = False, ts_sync: bool = True) -> None:
+        self.decrypted = decrypted
+        self.ts_sync = ts_sync
+        self.encrypted: Set[str] = set()
+        for playlist in playlists:
+            self.add_playlist(playlist)
+
+    def add_playlist(self, playlist: Playlist):
+        if not self.decrypted:
+            self.encrypted.update(aes128_segments(playlist))
+
+    def __call__(self, job):
+        ts = self.ts_sync and job.cache.ext == "ts" and job.key not in self.encrypted
+        return lambda: SegmentCheck(job.url, ts)